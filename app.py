@@ -12,6 +12,7 @@ import sys
 # --- 1. SETUP & IMPORTS ---
 try:
     from lib.layout.layout import MangaLayout
+    from lib.scoring.debug import debug_image_path, penalty_debug_record, render_penalty_debug
 except ModuleNotFoundError:
     st.error("Error: 'lib' module not found. Please run 'pip install -e .' in your terminal.")
     st.stop()
@@ -193,6 +194,7 @@ if view_path and os.path.exists(view_path):
             )
         with col_filter:
             show_best_only = st.checkbox("Show Only Best Candidate per Panel")
+            show_penalty_debug = st.checkbox("Show Penalty Debug")
 
     # Find images
     search_path = os.path.join(view_path, "*", "images", "panel*", "*_onlyname.png")
@@ -236,7 +238,9 @@ if view_path and os.path.exists(view_path):
                                             "final": layout.get("final_score", -999),
                                             "clip": clip,
                                             "sim": layout.get("sim_score", 0),
-                                            "geom": layout.get("geom_penalty", 999)
+                                            "geom": layout.get("geom_penalty", 999),
+                                            "debug": penalty_debug_record(var.get("penalty_debug"), rank),
+                                            "debug_path": debug_image_path(layout.get("generated_image_path") or ""),
                                         }
                         except Exception: pass
 
@@ -307,6 +311,12 @@ if view_path and os.path.exists(view_path):
                                     </div>
                                 </div>
                                 """, unsafe_allow_html=True)
+
+                            # デバッグ画像はパイプラインでは描かないので、必要になったときに描く
+                            if show_penalty_debug and s.get("debug"):
+                                if not os.path.exists(s["debug_path"]):
+                                    render_penalty_debug(s["debug"], s["debug_path"])
+                                col.image(s["debug_path"], caption="Penalty Debug", width='stretch')
                         except Exception as e:
                             col.error(f"Error: {e}")
 
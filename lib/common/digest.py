@@ -0,0 +1,12 @@
+import hashlib
+
+# ファイルの中身の sha256 (データベースの digest、CLIP 埋め込みのキーなど)
+# lib.layout と lib.scoring の両方から使うので、scipy などの重い依存を持たないここに置く
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -0,0 +1,90 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# メモリ上の LRU + ディスク (1エントリ1ファイル) の2段キャッシュ
+#
+# QueryCache (similar_layouts) と PoseCache (OpenPose) の共通部分。サブクラスはキーからパスを決める _path と、
+# ファイルを読み書きする _read / _write を実装し、_get / _put を使って自分の get / put を定義する。
+# 書き込みは一時ファイル + os.replace なので、複数のスレッド・プロセスが同じキーを書いても壊れたファイルは読まれない。
+
+
+class DiskLRUCache(ABC):
+    """
+    LRU + on-disk cache, one file per entry.
+
+    Args:
+        cache_dir: ディスクキャッシュの保存先 (None の場合はメモリのみ)
+        max_entries: メモリ上に保持するエントリ数
+    """
+
+    # 壊れたファイルを読んだときに _read が投げる例外
+    read_errors = (OSError, ValueError)
+
+    def __init__(self, cache_dir: str = None, max_entries: int = 256):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def _path(self, key) -> str:
+        """File of the entry of key."""
+
+    @abstractmethod
+    def _read(self, path: str):
+        """The entry saved at path; raises one of read_errors for a broken file."""
+
+    @abstractmethod
+    def _write(self, path: str, entry):
+        """Saves entry at path (a temporary file, moved into place by _put)."""
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get(self, key):
+        """The cached entry or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        entry = None
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.isfile(path):
+                try:
+                    entry = self._read(path)
+                except self.read_errors:
+                    # 書き込み途中などで壊れたファイルは無視して計算し直す
+                    entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._remember(key, entry)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._write(tmp_path, entry)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -4,9 +4,12 @@ from tqdm import tqdm
 import os
 import base64
 import json
-import requests
+import numpy as np
 from PIL import Image
 
+from lib.image.pose_cache import pose_key
+from lib.image.sd_client import get_client, response_images, response_seeds
+
 class People:
     def __init__(self):
         self.pose_keypoints_2d :Optional[List[Tuple[float, float]]]= None
@@ -21,6 +24,16 @@ class People:
                 f"hand_right_keyoints_2d={self.hand_right_keypoints_2d})"
 
 
+def _keypoints_bbox(keypoints):
+    """Normalized bbox of the detected (> 0) keypoints, or None"""
+    if not keypoints:
+        return None
+    xs = [kp[0] for kp in keypoints if kp[0] > 0]
+    ys = [kp[1] for kp in keypoints if kp[1] > 0]
+    if not xs or not ys:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
 class ControlNetResult:
     def __init__(self, json_response, base_image_path=""):
         self.canvas_height:int = None
@@ -28,8 +41,24 @@ class ControlNetResult:
         self.image: Image = None
         self.people: List[People] = []
         self.base_image_path = base_image_path
+        self._person_boxes = None
         self._parse_response(json_response)
 
+    def person_boxes(self):
+        """
+        Body and face bboxes of every person in canvas pixels, computed once per result.
+        Returns:
+            (body (P, 4), face (P, 4)) float64, NaN rows where the keypoints are missing
+        """
+        if self._person_boxes is None:
+            scale = np.array([self.canvas_width, self.canvas_height, self.canvas_width, self.canvas_height], dtype=np.float64)
+            boxes = []
+            for attr in ("pose_keypoints_2d", "face_keypoints_2d"):
+                rows = [_keypoints_bbox(getattr(person, attr)) for person in self.people]
+                boxes.append(np.array([row if row is not None else [np.nan] * 4 for row in rows], dtype=np.float64).reshape(-1, 4) * scale)
+            self._person_boxes = tuple(boxes)
+        return self._person_boxes
+
     def _parse_response(self, json_response):
         self.canvas_height = json_response["poses"][0]["canvas_height"]
         self.canvas_width = json_response["poses"][0]["canvas_width"]
@@ -81,7 +110,8 @@ def controlnet2bboxes(controlnet_results: ControlNetResult):
     return bboxes
 
 
-def detect_human(image_dir):
+def detect_human(image_dir, client=None):
+    client = client or get_client()
     dict = {}
     for panel_name in tqdm(os.listdir(image_dir), desc="Processing Panels for detect human"):
         panel_dir = os.path.join(image_dir, panel_name)
@@ -96,7 +126,7 @@ def detect_human(image_dir):
                 "controlnet_input_images": [img_data],
             }
 
-            response = requests.post("http://127.0.0.1:7860/controlnet/detect", json=payload).json()
+            response = client.detect(payload)
             with open("response.txt", "w") as f:
                 json.dump(response, f, indent=2)
 
@@ -105,16 +135,54 @@ def detect_human(image_dir):
         dict[panel_name] = results
     return dict
 
-def run_controlnet_openpose(image_path, controlnetres_image_path=None,output_path=None):
-    with open(image_path, "rb") as f:
-        img_data = base64.b64encode(f.read()).decode("utf-8")
+OPENPOSE_MODULE = "openpose_full"
+
+
+def detect_openpose(image_paths, client=None, cache=None, module=OPENPOSE_MODULE):
+    """
+    Single-image /controlnet/detect responses ({"poses": [...], "images": [...]}) of every image.
+    Images found in cache (PoseCache) are not sent; the others are detected in one request
+    (controlnet_input_images), identical images only once.
+    """
+    responses = [None] * len(image_paths)
+    keys = []
+    pending = {}
+    for k, image_path in enumerate(image_paths):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        key = pose_key(image_bytes, module)
+        keys.append(key)
+        responses[k] = cache.get(key) if cache is not None else None
+        if responses[k] is None and key not in pending:
+            pending[key] = base64.b64encode(image_bytes).decode("utf-8")
+
+    if pending:
+        payload = {
+            "controlnet_module": module,
+            "controlnet_input_images": list(pending.values()),
+        }
+        response = (client or get_client()).detect(payload)
+        detected = {}
+        for index, key in enumerate(pending):
+            detected[key] = {
+                "poses": response["poses"][index:index + 1],
+                "images": response["images"][index:index + 1],
+            }
+            if cache is not None:
+                cache.put(key, detected[key])
+        responses = [detected[key] if cached is None else cached for key, cached in zip(keys, responses)]
+    return responses
 
-    payload = {
-        "controlnet_module": "openpose_full",
-        "controlnet_input_images": [img_data],
-    }
 
-    response = requests.post("http://127.0.0.1:7860/controlnet/detect", json=payload).json()
+def run_controlnet_openpose_batch(image_paths, controlnetres_image_paths=None, client=None, cache=None):
+    """ControlNetResult of every image from one /controlnet/detect request (see detect_openpose)."""
+    controlnetres_image_paths = controlnetres_image_paths or [None] * len(image_paths)
+    responses = detect_openpose(image_paths, client, cache)
+    return [ControlNetResult(response, path) for response, path in zip(responses, controlnetres_image_paths)]
+
+
+def run_controlnet_openpose(image_path, controlnetres_image_path=None,output_path=None, client=None, cache=None):
+    response = detect_openpose([image_path], client, cache)[0]
     if output_path is not None:
         with open(os.path.join(output_path, "response.json"), "w") as f:
             json.dump(response, f, indent=2)
@@ -122,7 +190,7 @@ def run_controlnet_openpose(image_path, controlnetres_image_path=None,output_pat
     return ControlNetResult(response, controlnetres_image_path)
 
 
-def generate_with_controlnet_openpose(pose_image_path, prompt, save_path, model="tAnimeV4Pruned_v40", width=512, height=512):
+def generate_with_controlnet_openpose(pose_image_path, prompt, save_path, model="tAnimeV4Pruned_v40", width=512, height=512, seed=-1, client=None):
     negative_prompt = (
     "nsfw, (easynegative:0.8), (photorealistic:1.5), (color:1.5), (shading:1.4), (smooth:1.4), 3d, render, sharp focus, nice, pretty, masterpiece, best quality, text, error, fewer, extra, missing,chromatic aberration, signature, extra digits, artistic error, username, scan, [abstract]"
     )
@@ -141,7 +209,7 @@ def generate_with_controlnet_openpose(pose_image_path, prompt, save_path, model=
         "cfg_scale" : 5,
         "width": width,
         "height": height,
-        "seed" : -1,
+        "seed" : seed,
         "alwayson_scripts": {
             "controlnet": {
                 "args": [{
@@ -155,21 +223,10 @@ def generate_with_controlnet_openpose(pose_image_path, prompt, save_path, model=
             }
         }
     }
-    response = requests.post("http://127.0.0.1:7860/sdapi/v1/txt2img", json=payload).json()
-    image_base64 = response["images"][0]
-    image_bytes = io.BytesIO(base64.b64decode(image_base64))
-    image = Image.open(image_bytes)
-    image.save(save_path)
-    return
-
-
-def check_open():
-    url = "http://127.0.0.1:7860"
-    try:
-        response = requests.get(url, timeout=2)
-        if response.status_code == 200:
-            return True
-        else:
-            return False
-    except requests.exceptions.RequestException:
-        return False
+    response = (client or get_client()).txt2img(payload)
+    response_images(response)[0].save(save_path)
+    return response_seeds(response)[0]
+
+
+def check_open(client=None):
+    return (client or get_client()).is_open()
@@ -1,13 +1,11 @@
 import os
-import io
-from PIL import Image
-import base64
 import json
 import time
 import requests
 from tqdm import tqdm, trange
 from datetime import datetime
 from lib.image.prompt import generate_prompt_prompt, enhancement_prompt
+from lib.image.sd_client import get_client, response_images, response_seeds
 
 def enhance_prompts(client, prompts, output_path):
     if os.path.exists(os.path.join(output_path, "enhanced_image_prompts.json")):
@@ -117,7 +115,11 @@ def generate_image(client, prompt, image_path,num_retry=5):
                 raise Exception("Failed to generate images")
     return
 
-def generate_image_with_sd(prompt, image_path, width=512, height=512):
+def generate_images_with_sd(prompt, image_paths, width=512, height=512, seed=-1, client=None):
+    """
+    Generates len(image_paths) images of one prompt in a single txt2img request (batch_size).
+    Returns the seed of each image (seed, seed + 1, ... for a fixed seed) to reproduce it.
+    """
     negative_prompt = (
     "nsfw, (easynegative:1), 3d, lowres, (bad), text, error, fewer, extra, missing, worst quality, jpeg artifacts, low quality, watermark, unfinished, displeasing, oldest, early, chromatic aberration, signature, extra digits, artistic error, username, scan, [abstract]"
     )
@@ -130,10 +132,16 @@ def generate_image_with_sd(prompt, image_path, width=512, height=512):
         },
         "width": width,
         "height": height,
+        "seed": seed,
+        "batch_size": len(image_paths),
+        "n_iter": 1,
     }
-    response = requests.post("http://127.0.0.1:7860/sdapi/v1/txt2img", json=payload).json()
-    image_base64 = response["images"][0]
-    image_bytes = io.BytesIO(base64.b64decode(image_base64))
-    image = Image.open(image_bytes)
-    image.save(image_path)
-    return
\ No newline at end of file
+    response = (client or get_client()).txt2img(payload)
+    for image, image_path in zip(response_images(response, len(image_paths)), image_paths):
+        image.save(image_path)
+    return response_seeds(response, len(image_paths))
+
+
+def generate_image_with_sd(prompt, image_path, width=512, height=512, seed=-1, client=None):
+    """Generates one image; returns its seed."""
+    return generate_images_with_sd(prompt, [image_path], width, height, seed, client)[0]
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+
+from lib.common.disk_cache import DiskLRUCache
+
+# OpenPose (/controlnet/detect) の結果のキャッシュ
+#
+# 同じ画像 (リトライで生成し直さなかった画像、resume した run、Web UI での再実行) を何度も検出しないように、
+# 画像ファイルの中身の sha256 と ControlNet のモジュール名をキーにして、1画像分のレスポンス
+# ({"poses": [...], "images": [...]}) をメモリ上の LRU とディスク (cache_dir/<key>.json) に保持する。
+
+
+def pose_key(image_bytes: bytes, module: str) -> str:
+    digest = hashlib.sha256(image_bytes)
+    digest.update(module.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PoseCache(DiskLRUCache):
+    """
+    LRU + on-disk cache of single-image /controlnet/detect responses.
+
+    Args:
+        cache_dir: ディスクキャッシュの保存先 (None の場合はメモリのみ)
+        max_entries: メモリ上に保持するエントリ数
+    """
+
+    def __init__(self, cache_dir: str = None, max_entries: int = 256):
+        super().__init__(cache_dir, max_entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, path, response):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(response, f)
+
+    def get(self, key: str):
+        """The cached response or None."""
+        return self._get(key)
+
+    def put(self, key: str, response: dict):
+        self._put(key, response)
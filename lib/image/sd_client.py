@@ -0,0 +1,310 @@
+import base64
+import io
+import json
+import os
+import threading
+import time
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# HTTP client of the Stable Diffusion WebUI (AUTOMATIC1111) API
+#
+# txt2img / ControlNet の呼び出しは全てここを通す。requests.Session の接続プールで TCP 接続を使い回し、
+# タイムアウトと、接続失敗・502/503/504 のときのリトライ (指数バックオフ) をまとめて設定する。
+#
+#   SD_WEBUI_URL=http://192.168.0.10:7860    # 接続先 (既定 http://127.0.0.1:7860)
+#   SD_WEBUI_URLS=http://a:7860,http://b:7860  # 複数の WebUI に振り分ける (SDPool)
+#   SD_TIMEOUT=600                           # 1リクエストの読み込みタイムアウト (秒)
+
+DEFAULT_SD_URL = "http://127.0.0.1:7860"
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 600
+RETRY_STATUS = (502, 503, 504)
+
+
+def sd_url():
+    return os.getenv("SD_WEBUI_URL", DEFAULT_SD_URL)
+
+
+def sd_urls():
+    """Base URLs of the WebUI instances: SD_WEBUI_URLS (comma separated), else SD_WEBUI_URL."""
+    urls = [url.strip() for url in os.getenv("SD_WEBUI_URLS", "").split(",") if url.strip()]
+    return urls or [sd_url()]
+
+
+class SDClient:
+    """
+    Pooled keep-alive session against one WebUI instance.
+    Args:
+        base_url: defaults to SD_WEBUI_URL
+        timeout: read timeout of API calls in seconds, defaults to SD_TIMEOUT
+        retries: retries of failed connections and 502/503/504 responses
+        backoff: seconds before the first retry, doubled on each retry
+        pool_size: connections kept open, at least the number of threads sharing the client
+        max_in_flight: requests sent at once from all threads (None for no limit), others wait for a free slot
+    """
+
+    def __init__(self, base_url=None, timeout=None, retries=3, backoff=0.5, pool_size=8, connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_in_flight=None):
+        self.base_url = (base_url or sd_url()).rstrip("/")
+        self.timeout = (connect_timeout, float(timeout or os.getenv("SD_TIMEOUT", DEFAULT_READ_TIMEOUT)))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __repr__(self):
+        return f"SDClient({self.base_url})"
+
+    def post(self, path, payload, timeout=None):
+        """POST payload as JSON and return the JSON response. Raises requests.RequestException."""
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self._send(url, payload, timeout or self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                # 読み込みタイムアウト (ReadTimeout) は送り直さない (WebUI 側では生成が続いている)
+                if last_attempt:
+                    raise
+                print(f"[SD] {url} failed: {e}. Retrying... ({attempt + 1}/{self.retries})")
+            else:
+                if response.status_code not in RETRY_STATUS or last_attempt:
+                    response.raise_for_status()
+                    return response.json()
+                print(f"[SD] {url} returned {response.status_code}. Retrying... ({attempt + 1}/{self.retries})")
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _send(self, url, payload, timeout):
+        if self._in_flight is None:
+            return self.session.post(url, json=payload, timeout=timeout)
+        # リトライ待ちの間は枠を空ける
+        with self._in_flight:
+            return self.session.post(url, json=payload, timeout=timeout)
+
+    def txt2img(self, payload):
+        return self.post("/sdapi/v1/txt2img", payload)
+
+    def detect(self, payload):
+        return self.post("/controlnet/detect", payload)
+
+    def is_open(self, timeout=2):
+        # ヘルスチェックはリトライしない
+        try:
+            response = self.session.get(self.base_url, timeout=timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def close(self):
+        self.session.close()
+
+
+def _retry_elsewhere(error):
+    """
+    Whether a request that failed on one backend may be sent to another: connection errors and 5xx only.
+    Not for a read timeout (the backend is still generating, like SDClient's own retries) or 4xx (the request itself is bad).
+    """
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code >= 500
+
+
+class SDPool:
+    """
+    Several WebUI instances behind the SDClient interface (post / txt2img / detect / is_open).
+    Each request goes to the healthy backend with the fewest requests in flight. A request that fails there
+    (connection error or 5xx after the client's own retries) is sent to another backend,
+    and the failed backend is skipped for recheck_interval seconds. Read timeouts are raised as is.
+    """
+
+    def __init__(self, clients, recheck_interval=30):
+        if not clients:
+            raise ValueError("SDPool needs at least one backend")
+        self.clients = list(clients)
+        self.recheck_interval = recheck_interval
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._state = [
+            {"in_flight": 0, "completed": 0, "failed": 0, "busy_seconds": 0.0, "down_since": None}
+            for _ in self.clients
+        ]
+
+    def __repr__(self):
+        return f"SDPool({', '.join(client.base_url for client in self.clients)})"
+
+    @property
+    def max_in_flight(self):
+        limits = [client.max_in_flight for client in self.clients]
+        return None if None in limits else sum(limits)
+
+    def _is_up(self, state, now):
+        return state["down_since"] is None or now - state["down_since"] >= self.recheck_interval
+
+    def _acquire(self, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [k for k in range(len(self.clients)) if k not in tried]
+            # 全て落ちているときも試しはする
+            up = [k for k in candidates if self._is_up(self._state[k], now)] or candidates
+            if not up:
+                return None
+            k = min(up, key=lambda k: (self._state[k]["in_flight"], self._state[k]["completed"]))
+            self._state[k]["in_flight"] += 1
+            return k
+
+    def _release(self, k, start, failed=False, down=False):
+        with self._lock:
+            state = self._state[k]
+            state["in_flight"] -= 1
+            state["busy_seconds"] += time.monotonic() - start
+            if failed:
+                state["failed"] += 1
+            else:
+                state["completed"] += 1
+            if down:
+                state["down_since"] = time.monotonic()
+            elif not failed:
+                state["down_since"] = None
+
+    def post(self, path, payload, timeout=None):
+        tried = set()
+        error = None
+        while True:
+            k = self._acquire(tried)
+            if k is None:
+                raise error
+            tried.add(k)
+            start = time.monotonic()
+            try:
+                result = self.clients[k].post(path, payload, timeout)
+            except requests.exceptions.RequestException as e:
+                error = e
+                retry = _retry_elsewhere(e)
+                self._release(k, start, failed=True, down=retry)
+                if not retry:
+                    raise
+                print(f"[SD] {self.clients[k].base_url} failed: {e}. Trying another backend...")
+                continue
+            self._release(k, start)
+            return result
+
+    def txt2img(self, payload):
+        return self.post("/sdapi/v1/txt2img", payload)
+
+    def detect(self, payload):
+        return self.post("/controlnet/detect", payload)
+
+    def health_check(self, timeout=2):
+        """{base_url: reachable} of every backend; unreachable ones are skipped until they pass again."""
+        health = {}
+        for client, state in zip(self.clients, self._state):
+            ok = client.is_open(timeout)
+            with self._lock:
+                state["down_since"] = None if ok else time.monotonic()
+            health[client.base_url] = ok
+        return health
+
+    def is_open(self, timeout=2):
+        health = self.health_check(timeout)
+        for url, ok in health.items():
+            print(f"[SD] {url}: {'ok' if ok else 'unreachable'}")
+        return any(health.values())
+
+    def stats(self):
+        """Requests and throughput of every backend since the pool was created."""
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "url": client.base_url,
+                    "healthy": self._is_up(state, now),
+                    "in_flight": state["in_flight"],
+                    "completed": state["completed"],
+                    "failed": state["failed"],
+                    "busy_seconds": state["busy_seconds"],
+                    "per_minute": state["completed"] * 60 / elapsed,
+                }
+                for client, state in zip(self.clients, self._state)
+            ]
+
+    def format_stats(self):
+        lines = [f"{'backend':<32} {'done':>6} {'failed':>6} {'busy s':>8} {'per min':>8}"]
+        for stat in self.stats():
+            lines.append(f"{stat['url']:<32} {stat['completed']:>6} {stat['failed']:>6} {stat['busy_seconds']:>8.1f} {stat['per_minute']:>8.2f}")
+        return "\n".join(lines)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+def create_client(urls=None, max_in_flight=None, **kwargs):
+    """SDClient of one URL, or SDPool of several (default sd_urls()). max_in_flight is per backend."""
+    urls = urls or sd_urls()
+    pool_size = max(8, (max_in_flight or 0) + 1)
+    clients = [SDClient(url, max_in_flight=max_in_flight, pool_size=pool_size, **kwargs) for url in urls]
+    return clients[0] if len(clients) == 1 else SDPool(clients)
+
+
+def _response_info(response):
+    """The info of a txt2img response as a dict (the WebUI sends it as a JSON string), {} when it is missing or broken."""
+    try:
+        info = response.get("info") or {}
+        if isinstance(info, str):
+            info = json.loads(info)
+    except (ValueError, TypeError, AttributeError):
+        return {}
+    return info if isinstance(info, dict) else {}
+
+
+def response_images(response, count=1):
+    """
+    The count generated images of a txt2img response.
+    They start at info.index_of_first_image (after the grid of the batch, when the WebUI returns one);
+    extensions such as ControlNet append their detected maps at the end.
+    Without that field, a batch with more images than count is assumed to start with the grid.
+    """
+    images = response["images"]
+    offset = _response_info(response).get("index_of_first_image")
+    if not isinstance(offset, int):
+        offset = 1 if count > 1 and len(images) > count else 0
+    return [Image.open(io.BytesIO(base64.b64decode(image))) for image in images[offset:offset + count]]
+
+
+def response_seeds(response, count=1):
+    """Seeds of the count generated images (info.all_seeds), None where the response does not tell."""
+    info = _response_info(response)
+    try:
+        seeds = info.get("all_seeds") or [info["seed"] + k for k in range(count)]
+    except (KeyError, TypeError):
+        return [None] * count
+    return [int(seed) for seed in seeds[:count]] + [None] * (count - len(seeds))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The SDClient (or SDPool) shared by lib.image, created on first use from SD_WEBUI_URL(S)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+
+def set_client(client):
+    """Replaces the shared client (e.g. another base URL); returns the previous one."""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
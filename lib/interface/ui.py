@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from lib.layout.layout import MangaLayout, Speaker, NonSpeaker
+from lib.layout.index import DEFAULT_ANNFILE, LayoutIndex
 
 def create_drag_interface():
     # セッション状態の初期化
@@ -818,6 +819,11 @@ def create_manga_layout(bbox_data, canvas_width, canvas_height, unrelated_text_l
     
     st.success("レイアウトが正常に作成されました！")
 
+@st.cache_resource
+def get_layout_index(annfile=DEFAULT_ANNFILE):
+    """レイアウトDBをプロセス内で共有する (ファイルの mtime が変わった時のみ再読み込み)"""
+    return LayoutIndex.get(annfile)
+
 def run_similarity_calculation(layout, aspect_ratio_threshold, text_length_threshold):
     """類似度計算を実行"""
     try:
@@ -828,7 +834,7 @@ def run_similarity_calculation(layout, aspect_ratio_threshold, text_length_thres
         st.subheader("類似度計算結果")
         
         # 条件を設定
-        annfile = "./curated_dataset/database.json"
+        annfile = get_layout_index()
         num_speakers = sum(1 for elem in layout.elements if isinstance(elem, Speaker))
         num_non_speakers = sum(1 for elem in layout.elements if isinstance(elem, NonSpeaker))
         base_text_length = sum(getattr(elem, 'text_length', 0) for elem in layout.elements if isinstance(elem, Speaker))
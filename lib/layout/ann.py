@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Approximate nearest-neighbour search over layout feature vectors
+#
+# 各レイアウトを固定長のベクトルに埋め込む (同じバケット内では要素数が同じなので長さも同じ):
+#   [正規化 bbox (E*4), 種類フラグ (E), セリフ長 (S), 関連しないテキスト長 (1)]
+# 要素は Speaker / NonSpeaker ごとに中心の x 座標の降順 (右から左) に並べる。
+# bbox は各レイアウトの幅・高さで [0, 1] に正規化するので、MangaLayout.adjust による拡大縮小の影響を受けない。
+
+# テキスト長をこの値で割って bbox 座標とスケールを揃える (calc_similarity のテキスト長の類似度の σ = 10文字)
+TEXT_LENGTH_SCALE = 10.0
+
+
+def _sort_group(boxes: np.ndarray, values: np.ndarray = None):
+    """(N, k, 4) の bbox を中心の x 座標の降順に並べ替える"""
+    order = np.argsort(-(boxes[..., 0] + boxes[..., 2]), axis=-1, kind="stable")
+    boxes = np.take_along_axis(boxes, order[..., None], axis=-2)
+    if values is not None:
+        values = np.take_along_axis(values, order, axis=-1)
+    return boxes, values
+
+
+def features_from_arrays(normalized_boxes, num_speakers: int, text_length, unrelated_text_length) -> np.ndarray:
+    """
+    Args:
+        normalized_boxes: (N, E, 4) [0, 1] に正規化した bbox (Speaker が先頭 S 個)
+        text_length: (N, S)
+        unrelated_text_length: (N,)
+
+    Returns:
+        (N, E*4 + E + S + 1) float64
+    """
+    normalized_boxes = np.asarray(normalized_boxes, dtype=np.float64)
+    n, num_elements = normalized_boxes.shape[0], normalized_boxes.shape[1]
+    text_length = np.asarray(text_length, dtype=np.float64).reshape(n, num_speakers)
+
+    speaker_boxes, text_length = _sort_group(normalized_boxes[:, :num_speakers], text_length)
+    non_speaker_boxes, _ = _sort_group(normalized_boxes[:, num_speakers:])
+    type_flags = np.broadcast_to(np.arange(num_elements) < num_speakers, (n, num_elements))
+    return np.concatenate([
+        speaker_boxes.reshape(n, -1),
+        non_speaker_boxes.reshape(n, -1),
+        type_flags.astype(np.float64),
+        text_length / TEXT_LENGTH_SCALE,
+        np.asarray(unrelated_text_length, dtype=np.float64).reshape(n, 1) / TEXT_LENGTH_SCALE,
+    ], axis=1)
+
+
+def bucket_features(columns: dict, num_speakers: int) -> np.ndarray:
+    """Feature vectors of every row of a bucket (database.build_bucket の列, bbox は正規化済み)."""
+    return features_from_arrays(
+        columns["bboxes"],
+        num_speakers,
+        columns["text_length"],
+        columns["unrelated_text_length"],
+    )
+
+
+def query_features(layout) -> np.ndarray:
+    """Feature vector (1, D) of a query MangaLayout."""
+    from lib.layout.score import layout_arrays
+
+    boxes, is_speaker, text_length = layout_arrays(layout)
+    order = np.concatenate([np.flatnonzero(is_speaker), np.flatnonzero(~is_speaker)])
+    scale = np.array([layout.width, layout.height, layout.width, layout.height], dtype=np.float64)
+    return features_from_arrays(
+        (boxes[order] / scale)[None],
+        int(is_speaker.sum()),
+        text_length[is_speaker][None],
+        [layout.unrelated_text_length],
+    )
+
+
+def build_tree(features: np.ndarray) -> cKDTree:
+    return cKDTree(np.asarray(features, dtype=np.float64))
+
+
+def shortlist(tree: cKDTree, query: np.ndarray, allowed_rows: np.ndarray, num_candidates: int) -> np.ndarray:
+    """
+    Nearest rows of the tree that are also in allowed_rows (the prefilter survivors).
+    Widens the search until num_candidates survivors are found or the bucket is exhausted.
+    """
+    total = tree.n
+    num_candidates = min(num_candidates, len(allowed_rows))
+    if num_candidates <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    allowed = np.zeros(total, dtype=bool)
+    allowed[allowed_rows] = True
+    k = num_candidates
+    while True:
+        k = min(k, total)
+        _, neighbours = tree.query(query, k=k)
+        neighbours = np.atleast_1d(np.asarray(neighbours).reshape(-1))
+        neighbours = neighbours[neighbours < total]
+        hits = neighbours[allowed[neighbours]]
+        if len(hits) >= num_candidates or k == total:
+            return np.sort(hits[:num_candidates])
+        k *= 4
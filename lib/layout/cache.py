@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from lib.common.disk_cache import DiskLRUCache
+
+# similar_layouts の結果 (上位K件の行番号・スコア・割り当て) のキャッシュ
+#
+# 同じ台本の再実行やバリエーション間では、要素数・OpenPose の bbox・SD の解像度がほぼ同じクエリが繰り返される。
+# クエリの bbox を grid ピクセル単位に丸めたシグネチャと検索パラメータ、データベースの digest をキーにして、
+# メモリ上の LRU とディスク (cache_dir/<digest>/<key>.npz) の2段で保持する。
+# データベースを作り直すと digest が変わるので古いエントリは使われない。
+
+# データセットのディレクトリ (dataprepare が走査する) の外に置く。キーに DB の digest を含むので DB 間で共有してよい
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mangabubble", "query_cache")
+DEFAULT_GRID = 8
+
+
+def query_signature(layout, grid: int = DEFAULT_GRID) -> dict:
+    """Quantized description of a query layout (element order is kept, it defines the assignment)."""
+    from lib.layout.score import layout_arrays
+
+    boxes, is_speaker, text_length = layout_arrays(layout)
+    return {
+        "canvas": [int(layout.width), int(layout.height)],
+        "speaker": is_speaker.astype(int).tolist(),
+        "bboxes": np.rint(boxes / grid).astype(int).tolist(),
+        "text_length": text_length.astype(int).tolist(),
+        "unrelated_text_length": int(layout.unrelated_text_length),
+        "grid": grid,
+    }
+
+
+def cache_key(signature: dict, **params) -> str:
+    payload = json.dumps({"query": signature, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class QueryCache(DiskLRUCache):
+    """
+    LRU + on-disk cache of similar_layouts results.
+
+    Args:
+        cache_dir: ディスクキャッシュの保存先 (None の場合はメモリのみ)
+        max_entries: メモリ上に保持するエントリ数
+        grid: シグネチャの bbox を丸める単位 (ピクセル)
+    """
+
+    read_errors = (OSError, ValueError, KeyError)
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_entries: int = 1024, grid: int = DEFAULT_GRID):
+        super().__init__(cache_dir, max_entries)
+        self.grid = grid
+
+    def _path(self, memory_key) -> str:
+        digest, key = memory_key
+        return os.path.join(self.cache_dir, digest[:16], f"{key}.npz")
+
+    def _read(self, path):
+        with np.load(path) as data:
+            return (data["rows"], data["scores"].tolist(), data["assignment"])
+
+    def _write(self, path, entry):
+        with open(path, "wb") as f:
+            np.savez(f, rows=entry[0], scores=np.asarray(entry[1], dtype=np.float64), assignment=entry[2])
+
+    def get(self, digest: str, key: str):
+        """(rows, scores, assignment) or None."""
+        return self._get((digest, key))
+
+    def put(self, digest: str, key: str, rows, scores, assignment):
+        self._put((digest, key), (np.asarray(rows), list(scores), np.asarray(assignment)))
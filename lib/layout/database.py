@@ -0,0 +1,331 @@
+import json
+import os
+import pickle
+from typing import Dict, List
+
+import numpy as np
+
+from lib.common.digest import file_digest
+from lib.layout.ann import bucket_features, build_tree
+
+# Compiled layout database
+#
+# database.json ({"{speakers}_{non_speakers}": [metadata, ...]}) を
+# バケットごとの列指向 numpy 配列に変換して保存する。
+#
+#   database/
+#     manifest.json
+#     1_1/
+#       image_path.npy             (N,)        str
+#       size.npy                   (N, 2)      int32   [width, height]
+#       bboxes.npy                 (N, E, 4)   float64 speakers first, then non-speakers
+#       text_length.npy            (N, S)      int32
+#       unrelated_text_length.npy  (N,)        int32
+#       text_bboxes.npy            (T, 4)      float64 text_info of every speaker, flattened
+#       text_lengths.npy           (T,)        int32
+#       text_offsets.npy           (N*S + 1,)  int64   speaker k of row i -> [offsets[i*S+k], offsets[i*S+k+1])
+#       unrelated_bboxes.npy       (U, 4)      float64
+#       unrelated_lengths.npy      (U,)        int32
+#       unrelated_offsets.npy      (N + 1,)    int64
+#       features.npy               (N, D)      float64 ANN feature vectors (lib/layout/ann.py)
+#       kdtree.pkl                             cKDTree over features
+#
+# Every row of a bucket has exactly S speakers and E - S non-speakers, so no padding is needed.
+# All bboxes are stored normalized to [0, 1] by the layout's width/height: scaling a candidate to the
+# query canvas is a single multiply, and the loaded (read-only) arrays are never rewritten per query.
+# float64 なので、元のピクセル座標は rint(正規化座標 * 元のサイズ) で正確に戻せる (canvas_bboxes)。
+
+FORMAT_VERSION = 4
+MANIFEST_NAME = "manifest.json"
+TREE_NAME = "kdtree.pkl"
+
+COLUMNS = [
+    "image_path",
+    "size",
+    "bboxes",
+    "text_length",
+    "unrelated_text_length",
+    "text_bboxes",
+    "text_lengths",
+    "text_offsets",
+    "unrelated_bboxes",
+    "unrelated_lengths",
+    "unrelated_offsets",
+    "features",
+]
+
+
+def parse_key(key: str):
+    num_speakers, num_non_speakers = key.split("_")
+    return int(num_speakers), int(num_non_speakers)
+
+
+def adjust_scale(original_width: int, original_height: int, base_width: int, base_height: int):
+    """(x, y) scale of MangaLayout.adjust, computed in the same order so that the truncated pixels match."""
+    target_aspect_ratio = base_width / base_height
+    original_aspect_ratio = original_width / original_height
+
+    if original_aspect_ratio > target_aspect_ratio:
+        new_width = original_width
+        new_height = int(original_width / target_aspect_ratio)
+    else:
+        new_height = original_height
+        new_width = int(original_height * target_aspect_ratio)
+
+    total_width_scale = (new_width / original_width) * (base_width / new_width)
+    total_height_scale = (new_height / original_height) * (base_height / new_height)
+    return total_width_scale, total_height_scale
+
+
+def canvas_bboxes(boxes: np.ndarray, size, width: int = None, height: int = None) -> np.ndarray:
+    """
+    Integer bboxes of normalized boxes of a layout of the given (width, height) size.
+    Without width/height the original pixels (database.json); otherwise the pixels MangaLayout.adjust(width, height) gives.
+    """
+    original_width, original_height = int(size[0]), int(size[1])
+    pixels = np.rint(np.asarray(boxes, dtype=np.float64) * np.array([original_width, original_height] * 2, dtype=np.float64))
+    if width is None:
+        return pixels.astype(np.int64)
+    scale_x, scale_y = adjust_scale(original_width, original_height, width, height)
+    return np.trunc(pixels * np.array([scale_x, scale_y, scale_x, scale_y])).astype(np.int64)
+
+
+def _ragged(groups: List[List[dict]], sizes: np.ndarray):
+    """
+    Flattens a list of [{"bbox": [...], "length": n}, ...] into (bboxes, lengths, offsets).
+    bboxes are normalized by the (width, height) of their group.
+    """
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    bboxes = []
+    lengths = []
+    for i, group in enumerate(groups):
+        for item in group or []:
+            bboxes.append(item["bbox"])
+            lengths.append(item["length"])
+        offsets[i + 1] = len(bboxes)
+    owner_sizes = np.repeat(np.asarray(sizes, dtype=np.float64).reshape(-1, 2), np.diff(offsets), axis=0)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4) / np.tile(owner_sizes, 2)
+    lengths = np.asarray(lengths, dtype=np.int32)
+    return bboxes, lengths, offsets
+
+
+def build_bucket(key: str, metadatum: List[dict]) -> Dict[str, np.ndarray]:
+    """Converts the metadata list of one bucket into its column arrays."""
+    num_speakers, num_non_speakers = parse_key(key)
+    num_elements = num_speakers + num_non_speakers
+    n = len(metadatum)
+
+    image_path = np.array([m["image_path"] for m in metadatum], dtype=str)
+    size = np.array([[m["width"], m["height"]] for m in metadatum], dtype=np.int32).reshape(n, 2)
+    bboxes = np.array(
+        [
+            [s["bbox"] for s in m["speaker_objects"]] + [s["bbox"] for s in m["non_speaker_objects"]]
+            for m in metadatum
+        ],
+        dtype=np.float64,
+    ).reshape(n, num_elements, 4)
+    bboxes = bboxes / np.tile(size, 2)[:, None, :]
+    text_length = np.array(
+        [[s["text_length"] for s in m["speaker_objects"]] for m in metadatum], dtype=np.int32
+    ).reshape(n, num_speakers)
+    unrelated_text_length = np.array([m["unrelated_text_length"] for m in metadatum], dtype=np.int32)
+
+    text_bboxes, text_lengths, text_offsets = _ragged(
+        [s["text_info"] for m in metadatum for s in m["speaker_objects"]],
+        np.repeat(size, num_speakers, axis=0),
+    )
+    unrelated_bboxes, unrelated_lengths, unrelated_offsets = _ragged(
+        [m["unrelated_text_bbox"] for m in metadatum],
+        size,
+    )
+
+    columns = {
+        "image_path": image_path,
+        "size": size,
+        "bboxes": bboxes,
+        "text_length": text_length,
+        "unrelated_text_length": unrelated_text_length,
+        "text_bboxes": text_bboxes,
+        "text_lengths": text_lengths,
+        "text_offsets": text_offsets,
+        "unrelated_bboxes": unrelated_bboxes,
+        "unrelated_lengths": unrelated_lengths,
+        "unrelated_offsets": unrelated_offsets,
+    }
+    columns["features"] = bucket_features(columns, num_speakers)
+    for array in columns.values():
+        array.flags.writeable = False
+    return columns
+
+
+class LayoutBucket:
+    """Column arrays of all layouts sharing the same "{speakers}_{non_speakers}" key."""
+
+    def __init__(self, key: str, columns: Dict[str, np.ndarray], path: str = None):
+        self.key = key
+        self.path = path
+        self.num_speakers, self.num_non_speakers = parse_key(key)
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self._aspect_ratio = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self.image_path)
+
+    @property
+    def aspect_ratio(self) -> np.ndarray:
+        if self._aspect_ratio is None:
+            self._aspect_ratio = self.size[:, 0] / self.size[:, 1]
+        return self._aspect_ratio
+
+    @property
+    def tree(self):
+        """KD-tree over the feature vectors (pickled by compile_database, otherwise built on first use)."""
+        if self._tree is None:
+            tree_path = os.path.join(self.path, TREE_NAME) if self.path else None
+            if tree_path and os.path.isfile(tree_path):
+                with open(tree_path, "rb") as f:
+                    self._tree = pickle.load(f)
+            else:
+                self._tree = build_tree(self.features)
+        return self._tree
+
+    def filter(self, base_text_length: int, text_length_threshold: int, base_aspect_ratio: float, aspect_ratio_threshold: float) -> np.ndarray:
+        """Row indices whose unrelated text length and aspect ratio are within the thresholds."""
+        unrelated_text_length = self.unrelated_text_length
+        aspect_ratio = self.aspect_ratio
+        mask = (
+            (unrelated_text_length >= base_text_length - text_length_threshold)
+            & (unrelated_text_length <= base_text_length + text_length_threshold)
+            & (aspect_ratio >= base_aspect_ratio - aspect_ratio_threshold)
+            & (aspect_ratio <= base_aspect_ratio + aspect_ratio_threshold)
+        )
+        return np.flatnonzero(mask)
+
+    def scaled_bboxes(self, rows: np.ndarray, base_width: int, base_height: int) -> np.ndarray:
+        """Element bboxes of the given rows on a base_width x base_height canvas, (R, E, 4) float64."""
+        return self.bboxes[rows] * np.array([base_width, base_height, base_width, base_height], dtype=np.float64)
+
+    def _to_canvas(self, boxes: np.ndarray, row: int, width: int, height: int) -> List[List[int]]:
+        """
+        正規化された bbox を width x height のキャンバスの整数座標に戻す。
+        width/height が None の場合は元画像の座標 (database.json と同じ値)。
+        """
+        return canvas_bboxes(boxes, self.size[row], width, height).tolist()
+
+    def text_info(self, row: int, speaker: int, width: int = None, height: int = None) -> List[dict]:
+        k = row * self.num_speakers + speaker
+        start, end = self.text_offsets[k], self.text_offsets[k + 1]
+        bboxes = self._to_canvas(self.text_bboxes[start:end], row, width, height)
+        return [
+            {"bbox": bbox, "length": int(length)}
+            for bbox, length in zip(bboxes, self.text_lengths[start:end])
+        ]
+
+    def unrelated_text_bbox(self, row: int, width: int = None, height: int = None) -> List[dict]:
+        start, end = self.unrelated_offsets[row], self.unrelated_offsets[row + 1]
+        bboxes = self._to_canvas(self.unrelated_bboxes[start:end], row, width, height)
+        return [
+            {"bbox": bbox, "length": int(length)}
+            for bbox, length in zip(bboxes, self.unrelated_lengths[start:end])
+        ]
+
+    def metadata(self, row: int, width: int = None, height: int = None) -> dict:
+        """
+        Rebuilds the database.json style metadata dict of one row.
+        width/height を指定すると、bbox をそのキャンバスに拡大縮小した新しい dict を返す
+        (MangaLayout.adjust 相当。バケットの配列は変更しない)。
+        """
+        bboxes = self._to_canvas(self.bboxes[row], row, width, height)
+        return {
+            "image_path": str(self.image_path[row]),
+            "width": int(self.size[row, 0]) if width is None else width,
+            "height": int(self.size[row, 1]) if height is None else height,
+            "speaker_objects": [
+                {
+                    "bbox": bboxes[k],
+                    "text_length": int(self.text_length[row, k]),
+                    "text_info": self.text_info(row, k, width, height),
+                }
+                for k in range(self.num_speakers)
+            ],
+            "non_speaker_objects": [{"bbox": bbox} for bbox in bboxes[self.num_speakers:]],
+            "unrelated_text_length": int(self.unrelated_text_length[row]),
+            "unrelated_text_bbox": self.unrelated_text_bbox(row, width, height),
+        }
+
+
+def compile_database(ann: Dict[str, List[dict]], output_dir: str, source_path: str = None):
+    """
+    Writes the compiled database (one directory of .npy columns per bucket).
+
+    Args:
+        ann: database.json の内容
+        output_dir: 出力先ディレクトリ
+        source_path: 元の database.json (digest を manifest に記録する)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    buckets = {}
+    for key, metadatum in ann.items():
+        columns = build_bucket(key, metadatum)
+        bucket_dir = os.path.join(output_dir, key)
+        os.makedirs(bucket_dir, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(bucket_dir, f"{name}.npy"), columns[name])
+        with open(os.path.join(bucket_dir, TREE_NAME), "wb") as f:
+            pickle.dump(build_tree(columns["features"]), f)
+        num_speakers, num_non_speakers = parse_key(key)
+        buckets[key] = {
+            "count": len(metadatum),
+            "num_speakers": num_speakers,
+            "num_non_speakers": num_non_speakers,
+        }
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "source": os.path.basename(source_path) if source_path else None,
+        "source_digest": file_digest(source_path) if source_path else None,
+        "buckets": buckets,
+    }
+    # manifest は最後に書く (途中で失敗した場合に不完全な DB を読まないように)
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+    return manifest
+
+
+def read_manifest(db_dir: str) -> dict:
+    manifest_path = os.path.join(db_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        raise FileNotFoundError(f"Compiled layout database not found: {manifest_path}")
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported layout database version {manifest.get('version')} in {db_dir} "
+            f"(expected {FORMAT_VERSION}). Re-run src/dataprepare.py --compile-only"
+        )
+    return manifest
+
+
+def load_bucket(db_dir: str, key: str, manifest: dict = None) -> LayoutBucket:
+    """Memory-maps the columns of a single bucket. Other buckets are never touched."""
+    if manifest is None:
+        manifest = read_manifest(db_dir)
+    if key not in manifest["buckets"]:
+        raise ValueError(f"Annotation file does not contain key: {key}")
+    bucket_dir = os.path.join(db_dir, key)
+    columns = {
+        name: np.load(os.path.join(bucket_dir, f"{name}.npy"), mmap_mode="r")
+        for name in COLUMNS
+    }
+    return LayoutBucket(key, columns, bucket_dir)
+
+
+def compiled_path(annfile: str) -> str:
+    """database.json に対応するコンパイル済み DB のディレクトリ (database/)"""
+    return os.path.splitext(annfile)[0]
+
+
+def is_compiled(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
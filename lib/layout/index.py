@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+
+from lib.common.digest import file_digest
+from lib.layout.database import (
+    LayoutBucket,
+    MANIFEST_NAME,
+    build_bucket,
+    compiled_path,
+    is_compiled,
+    load_bucket,
+    read_manifest,
+)
+
+DEFAULT_ANNFILE = "./curated_dataset/database.json"
+
+
+class LayoutIndex:
+    """
+    Process-wide, lazily loaded view of the layout database.
+
+    Use LayoutIndex.get(annfile) instead of the constructor so that the pipeline and the UI share
+    one instance per database. Buckets are loaded on first use and kept until the database file's
+    mtime changes (e.g. after re-running src/dataprepare.py).
+
+    annfile may be database.json or a compiled database directory. For database.json, the compiled
+    sibling directory (database/) is used whenever it is at least as new as the JSON file.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, annfile: str = DEFAULT_ANNFILE):
+        key = os.path.abspath(annfile)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(annfile)
+            return cls._instances[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._instances_lock:
+            cls._instances.clear()
+
+    def __init__(self, annfile: str = DEFAULT_ANNFILE):
+        self.annfile = annfile
+        self._lock = threading.Lock()
+        self._source = None  # (path, compiled, mtime) of the currently loaded database
+        self._manifest = None
+        self._buckets = {}
+        self._digest = None
+        self.load_count = 0
+
+    def _resolve(self):
+        if not os.path.exists(self.annfile):
+            raise FileNotFoundError(f"Annotation file not found: {self.annfile}")
+        if os.path.isdir(self.annfile):
+            manifest_path = os.path.join(self.annfile, MANIFEST_NAME)
+            return self.annfile, True, os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else None
+
+        db_dir = compiled_path(self.annfile)
+        json_mtime = os.path.getmtime(self.annfile)
+        if is_compiled(db_dir):
+            manifest_mtime = os.path.getmtime(os.path.join(db_dir, MANIFEST_NAME))
+            if manifest_mtime >= json_mtime:
+                return db_dir, True, manifest_mtime
+        return self.annfile, False, json_mtime
+
+    def _load(self, source):
+        path, compiled, _ = source
+        self._buckets = {}
+        self._manifest = None
+        self._digest = None
+        if compiled:
+            self._manifest = read_manifest(path)
+        else:
+            # JSON は一度だけパースして全バケットを列形式に変換しておく
+            with open(path, "r", encoding="utf-8") as f:
+                ann = json.load(f)
+            self._buckets = {key: LayoutBucket(key, build_bucket(key, metadatum)) for key, metadatum in ann.items()}
+        self._source = source
+        self.load_count += 1
+
+    def _ensure_loaded(self):
+        source = self._resolve()
+        if source != self._source:
+            self._load(source)
+
+    def keys(self):
+        with self._lock:
+            self._ensure_loaded()
+            if self._manifest is not None:
+                return list(self._manifest["buckets"].keys())
+            return list(self._buckets.keys())
+
+    def bucket(self, key: str) -> LayoutBucket:
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._buckets:
+                path, compiled, _ = self._source
+                if not compiled:
+                    raise ValueError(f"Annotation file does not contain key: {key}")
+                self._buckets[key] = load_bucket(path, key, self._manifest)
+            return self._buckets[key]
+
+    def digest(self) -> str:
+        """
+        Content hash of the currently loaded database (sha256 of database.json).
+        Changes whenever the database is rebuilt, so it can key caches derived from it.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._digest is None:
+                path, compiled, mtime = self._source
+                if compiled:
+                    # コンパイル元の digest がなければ manifest と更新時刻で代用する
+                    self._digest = self._manifest.get("source_digest") or f"{file_digest(os.path.join(path, MANIFEST_NAME))}:{mtime}"
+                else:
+                    self._digest = file_digest(path)
+            return self._digest
@@ -1,14 +1,21 @@
-import json
 import os
+from collections.abc import Sequence
 from typing import List, Dict
 
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.patches import Rectangle
 from PIL import Image
 
-from lib.layout.score import calc_similarity
+from lib.layout.score import calc_similarity, calc_similarity_batch
+from lib.layout.database import adjust_scale, canvas_bboxes
+from lib.layout.index import DEFAULT_ANNFILE, LayoutIndex
+from lib.layout.ann import query_features, shortlist
+from lib.layout.cache import cache_key, query_signature
 
 class Element:
+    __slots__ = ("bbox",)
+
     def __init__(self, bbox: List[int]):
         self.bbox = bbox
 
@@ -16,6 +23,8 @@ class Element:
         return (self.bbox[2] - self.bbox[0]) * (self.bbox[3] - self.bbox[1])
 
 class Speaker(Element):
+    __slots__ = ("text_length", "text_info")
+
     def __init__(self, bbox: List[int], text_length: int, text_info=None):
         super().__init__(bbox)
         self.text_length = text_length
@@ -25,12 +34,99 @@ class Speaker(Element):
         return f'Speaker(bbox: {self.bbox}, text_length: {self.text_length})'
 
 class NonSpeaker(Element):
+    __slots__ = ()
+
     def __init__(self, bbox: List[int]):
         super().__init__(bbox)
 
     def __repr__(self):
         return f'NonSpeaker(bbox: {self.bbox})'
 
+# ArrayLayout.elements の構造化配列
+ELEMENT_SPEAKER = 1
+ELEMENT_NON_SPEAKER = 2
+ELEMENT_DTYPE = np.dtype([("type", np.uint8), ("bbox", np.int32, (4,)), ("text_length", np.int32)])
+
+class ArrayLayout:
+    """
+    Compact MangaLayout: all elements in one ELEMENT_DTYPE structured array and the text boxes in flat arrays.
+    similar_layouts returns these; calc_similarity, generate_name and calculate_geometric_penalty take them as is.
+
+    Args:
+        elements: (E,) ELEMENT_DTYPE
+        text_bboxes: (T, 4) Speaker のセリフの bbox
+        text_owner: (T,) text_bboxes が属する elements のインデックス
+        unrelated_bboxes: (U, 4) 関連しないテキストの bbox
+        unrelated_lengths: (U,)
+    """
+    __slots__ = ("image_path", "width", "height", "elements", "unrelated_text_length", "text_bboxes", "text_owner", "unrelated_bboxes", "unrelated_lengths")
+
+    def __init__(self, image_path: str, width: int, height: int, elements: np.ndarray, unrelated_text_length: int, text_bboxes: np.ndarray, text_owner: np.ndarray, unrelated_bboxes: np.ndarray, unrelated_lengths: np.ndarray):
+        self.image_path = image_path
+        self.width = width
+        self.height = height
+        self.elements = elements
+        self.unrelated_text_length = unrelated_text_length
+        self.text_bboxes = text_bboxes
+        self.text_owner = text_owner
+        self.unrelated_bboxes = unrelated_bboxes
+        self.unrelated_lengths = unrelated_lengths
+
+    @property
+    def unrelated_text_bbox(self):
+        return [{"bbox": bbox, "length": int(length)} for bbox, length in zip(self.unrelated_bboxes.tolist(), self.unrelated_lengths)]
+
+    def to_manga_layout(self):
+        speaker_texts = iter(speaker_text_bboxes(self))
+        elements = []
+        for element in self.elements:
+            if element["type"] == ELEMENT_SPEAKER:
+                text_info = [{"bbox": bbox} for bbox in next(speaker_texts)]
+                elements.append(Speaker(element["bbox"].tolist(), int(element["text_length"]), text_info))
+            else:
+                elements.append(NonSpeaker(element["bbox"].tolist()))
+        return MangaLayout(self.image_path, self.width, self.height, elements, self.unrelated_text_length, self.unrelated_text_bbox)
+
+    def __repr__(self):
+        return f'''
+        ArrayLayout:
+            image_path: {self.image_path}
+            width: {self.width}
+            height: {self.height}
+            elements: {self.elements.tolist()}
+            unrelated_text_length: {self.unrelated_text_length}
+        '''
+
+def count_speakers(layout) -> int:
+    if isinstance(layout.elements, np.ndarray):
+        return int((layout.elements["type"] == ELEMENT_SPEAKER).sum())
+    return sum(1 for element in layout.elements if type(element) == Speaker)
+
+def speaker_text_bboxes(layout) -> List[List[List[int]]]:
+    """Speaker ごとのセリフの bbox のリスト (要素の並び順)。MangaLayout と ArrayLayout の両方に対応"""
+    if isinstance(layout.elements, np.ndarray):
+        speakers = np.flatnonzero(layout.elements["type"] == ELEMENT_SPEAKER)
+        bboxes = layout.text_bboxes.tolist()
+        return [[bbox for bbox, owner in zip(bboxes, layout.text_owner) if owner == index] for index in speakers]
+    return [
+        [text_obj["bbox"] for text_obj in element.text_info or []]
+        for element in layout.elements
+        if type(element) == Speaker
+    ]
+
+def speaker_text_bboxes_in_reading_order(layout) -> List[List[List[int]]]:
+    """speaker_text_bboxes を吹き出しの登場順 (セリフの中心の x 座標の最大値の降順, 右から左) に並べたもの"""
+    def custom_sort(bboxes):
+        return max(((bbox[0] + bbox[2]) / 2 for bbox in bboxes), default=0)
+
+    return sorted(speaker_text_bboxes(layout), key=custom_sort, reverse=True)
+
+def unrelated_text_bboxes(layout) -> List[List[int]]:
+    """関連しないテキスト (モノローグ) の bbox のリスト。MangaLayout と ArrayLayout の両方に対応"""
+    if isinstance(layout, ArrayLayout):
+        return layout.unrelated_bboxes.tolist()
+    return [item["bbox"] for item in getattr(layout, "unrelated_text_bbox", None) or []]
+
 class MangaLayout:
     def __init__(self, image_path: str, width: int, height: int, elements: List[Element], unrelated_text_length: int, unrelated_text_bbox: List[Dict[str, int]]):
         self.image_path = image_path
@@ -41,28 +137,8 @@ class MangaLayout:
         self.unrelated_text_bbox = unrelated_text_bbox
 
     def adjust(self, base_width: int, base_height: int):
-        original_width = self.width
-        original_height = self.height
-        target_aspect_ratio = base_width / base_height
-        original_aspect_ratio = original_width / original_height
-        
-        if original_aspect_ratio > target_aspect_ratio:
-            new_width = original_width
-            new_height = int(original_width / target_aspect_ratio)
-        else:
-            new_height = original_height
-            new_width = int(original_height * target_aspect_ratio)
-        
-        width_scale_1 = new_width / original_width
-        height_scale_1 = new_height / original_height
-        
-        final_width_scale = base_width / new_width
-        final_height_scale = base_height / new_height
-        
-        total_width_scale = width_scale_1 * final_width_scale
-        total_height_scale = height_scale_1 * final_height_scale
-        
-        
+        total_width_scale, total_height_scale = adjust_scale(self.width, self.height, base_width, base_height)
+
         self.width = base_width
         self.height = base_height
         
@@ -139,7 +215,7 @@ def from_condition(annfile: str, num_speakers: int, num_non_speakers: int, base_
     話者の数の条件に一致するLayoutオブジェクトのリストを生成する
 
     Args:
-        annfile: アノテーションファイルのパス
+        annfile: アノテーションファイル (database.json)、コンパイル済み DB ディレクトリのパス、または LayoutIndex
         num_speakers: 話者数
         num_non_speakers: 非話者数
 
@@ -147,36 +223,44 @@ def from_condition(annfile: str, num_speakers: int, num_non_speakers: int, base_
         Layout: レイアウト
     '''
 
-    if not os.path.exists(annfile):
-        raise FileNotFoundError(f"Annotation file not found: {annfile}")
+    index = annfile if isinstance(annfile, LayoutIndex) else LayoutIndex.get(annfile)
+    key = f"{num_speakers}_{num_non_speakers}"
+    bucket = index.bucket(key)
+
+    rows = bucket.filter(base_text_length, text_length_threshold, base_width / base_height, aspect_ratio_threshold)
+    return [_generate_layout_from_bucket(bucket, row, base_width, base_height, adjust) for row in rows]
 
-    if not os.path.isfile(annfile):
-        raise IsADirectoryError(f"Annotation file is a directory: {annfile}")
+def _generate_array_layout_from_bucket(bucket, row: int, base_width: int, base_height: int):
+    """バケットの1行をキャンバスサイズの ArrayLayout にする (Python オブジェクトは要素ごとに作らない)"""
+    size = bucket.size[row]
+    num_speakers = bucket.num_speakers
 
-    with open(annfile, 'r', encoding='utf-8') as f:
-        ann = json.load(f)
+    elements = np.zeros(num_speakers + bucket.num_non_speakers, dtype=ELEMENT_DTYPE)
+    elements["type"] = ELEMENT_NON_SPEAKER
+    elements["type"][:num_speakers] = ELEMENT_SPEAKER
+    elements["bbox"] = canvas_bboxes(bucket.bboxes[row], size, base_width, base_height)
+    elements["text_length"][:num_speakers] = bucket.text_length[row]
 
-    key = f"{num_speakers}_{num_non_speakers}"
+    start, end = bucket.text_offsets[row * num_speakers], bucket.text_offsets[(row + 1) * num_speakers]
+    counts = np.diff(bucket.text_offsets[row * num_speakers:(row + 1) * num_speakers + 1])
+    unrelated_start, unrelated_end = bucket.unrelated_offsets[row], bucket.unrelated_offsets[row + 1]
+    return ArrayLayout(
+        str(bucket.image_path[row]),
+        base_width,
+        base_height,
+        elements,
+        int(bucket.unrelated_text_length[row]),
+        canvas_bboxes(bucket.text_bboxes[start:end], size, base_width, base_height).astype(np.int32),
+        np.repeat(np.arange(num_speakers), counts),
+        canvas_bboxes(bucket.unrelated_bboxes[unrelated_start:unrelated_end], size, base_width, base_height).astype(np.int32),
+        np.array(bucket.unrelated_lengths[unrelated_start:unrelated_end]),
+    )
 
-    if not key in ann:
-        raise ValueError(f"Annotation file does not contain key: {key}")
-
-    layouts = []
-    base_aspect_ratio = base_width / base_height
-    for metadata in ann[key]:
-        unrelated_text_length = metadata['unrelated_text_length']
-        if unrelated_text_length < base_text_length - text_length_threshold or unrelated_text_length > base_text_length + text_length_threshold:
-            continue
-        width, height = metadata['width'], metadata['height']
-        aspect_ratio = width / height
-        if aspect_ratio < base_aspect_ratio - aspect_ratio_threshold or aspect_ratio > base_aspect_ratio + aspect_ratio_threshold:
-            continue
-        layout = _generate_layout_from_metadata(metadata)
-        if adjust:
-            layout.adjust(base_width, base_height)
-        layouts.append(layout)
-
-    return layouts
+def _generate_layout_from_bucket(bucket, row: int, base_width: int, base_height: int, adjust: bool):
+    # 正規化座標から直接キャンバスサイズの MangaLayout を作る (adjust で既存のオブジェクトを書き換えない)
+    if adjust:
+        return _generate_layout_from_metadata(bucket.metadata(row, base_width, base_height))
+    return _generate_layout_from_metadata(bucket.metadata(row))
 
 def is_valid_layout(bboxes: List[List[int]], panel):
     speaker_count = 0
@@ -208,7 +292,47 @@ def generate_layout(bboxes: List[List[int]], panel, width, height):
     manga_layout = MangaLayout("", width, height, manga_elements, unrelated_text_length, None)
     return manga_layout
 
-def similar_layouts(layout: MangaLayout, text_length_threshold=5, aspect_ratio_threshold=0.3, annfile="./curated_dataset/database.json"):
+class ScoredLayouts(Sequence):
+    """
+    similar_layouts の結果 (layout, score, pairs) をスコアの降順で保持する。
+    layout (ArrayLayout) と pairs はアクセスされた順位の分だけ生成される (scored_layouts[:K] なら上位K件のみ)。
+    """
+    def __init__(self, bucket, rows, scores, assignment, base_width: int, base_height: int):
+        self.bucket = bucket
+        self.rows = rows
+        self.scores = scores
+        self.assignment = assignment
+        self.base_width = base_width
+        self.base_height = base_height
+        self._layouts = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("ScoredLayouts index out of range")
+        if i not in self._layouts:
+            self._layouts[i] = _generate_array_layout_from_bucket(self.bucket, self.rows[i], self.base_width, self.base_height)
+        return self._layouts[i], self.scores[i], zip(range(self.assignment.shape[1]), self.assignment[i].tolist())
+
+def similar_layouts(layout: MangaLayout, text_length_threshold=5, aspect_ratio_threshold=0.3, annfile=DEFAULT_ANNFILE, top_k=None, ann=False, ann_candidates=256, cache=None):
+    '''
+    layout に類似した参照レイアウトをスコアの降順で返す
+
+    Args:
+        top_k: 上位 top_k 件のみを保持する (None の場合は全件)
+        ann: True の場合、特徴ベクトルの KD-tree で ann_candidates 件に絞り込んでから正確なスコアで並べ替える
+        ann_candidates: ANN で絞り込む候補数
+        cache: QueryCache。bbox を丸めたクエリが同じなら前回の結果を返す (スコアは前回のクエリに対するもの)
+
+    Returns:
+        ScoredLayouts: (ArrayLayout, score, pairs) のシーケンス
+    '''
     num_speakers = 0
     num_non_speakers = 0
     unrelated_text_length = layout.unrelated_text_length
@@ -217,15 +341,60 @@ def similar_layouts(layout: MangaLayout, text_length_threshold=5, aspect_ratio_t
             num_speakers += 1
         elif type(element) == NonSpeaker:
             num_non_speakers += 1
-    filtered_layouts = from_condition(annfile, num_speakers, num_non_speakers, unrelated_text_length, text_length_threshold, layout.width, layout.height, aspect_ratio_threshold, True)
 
-    layout_scores = []
-    for filtered_layout in filtered_layouts:
-        score, pairs = calc_similarity(layout, filtered_layout, 0.4)
-        layout_scores.append((filtered_layout, score, pairs))
-    
-    layout_scores.sort(key=lambda x: x[1], reverse=True)
-    return layout_scores
+    index = annfile if isinstance(annfile, LayoutIndex) else LayoutIndex.get(annfile)
+    bucket = index.bucket(f"{num_speakers}_{num_non_speakers}")
+    if cache is not None:
+        digest = index.digest()
+        key = cache_key(
+            query_signature(layout, cache.grid),
+            text_length_threshold=text_length_threshold,
+            aspect_ratio_threshold=aspect_ratio_threshold,
+            top_k=top_k,
+            ann_candidates=ann_candidates if ann else None,
+        )
+        cached = cache.get(digest, key)
+        if cached is not None:
+            rows, scores, assignment = cached
+            return ScoredLayouts(bucket, rows, scores, assignment, layout.width, layout.height)
+
+    rows = bucket.filter(unrelated_text_length, text_length_threshold, layout.width / layout.height, aspect_ratio_threshold)
+    if ann and len(rows) > ann_candidates:
+        rows = shortlist(bucket.tree, query_features(layout)[0], rows, ann_candidates)
+
+    # 候補は MangaLayout を組み立てずに、バケット全体をまとめてスコア計算する
+    scores, assignment = calc_similarity_batch(
+        layout,
+        bucket.scaled_bboxes(rows, layout.width, layout.height),
+        bucket.text_length[rows],
+        bucket.unrelated_text_length[rows],
+        0.4,
+    )
+
+    order = _top_k_order(scores, top_k)
+    result = ScoredLayouts(
+        bucket,
+        rows[order],
+        scores[order].tolist(),
+        assignment[order],
+        layout.width,
+        layout.height,
+    )
+    if cache is not None:
+        cache.put(digest, key, result.rows, result.scores, result.assignment)
+    return result
+
+def _top_k_order(scores: np.ndarray, top_k=None) -> np.ndarray:
+    """スコアの降順 (同点は元の順序) で上位 top_k 件のインデックス"""
+    if top_k is None or top_k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    # argpartition は同点の扱いが不定なので、K 番目と同点の候補は元の順序で選び直す
+    threshold = scores[candidates].min()
+    candidates = np.concatenate([np.flatnonzero(scores > threshold), np.flatnonzero(scores == threshold)])[:top_k]
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
 
 
 # test function for from_num_speakers
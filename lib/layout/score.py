@@ -1,11 +1,8 @@
-from torchvision.ops import box_iou
 from scipy.optimize import linear_sum_assignment
 from typing import List, Dict, Tuple, Any, Optional
 import numpy as np
-import torch
-import json
-import os
-import math
+import functools
+import itertools
 import random
 import matplotlib.pyplot as plt
 
@@ -13,33 +10,74 @@ import matplotlib.pyplot as plt
 # from lib.layout.layout import MangaLayout, from_condition, Speaker, NonSpeaker
 
 
+def _box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """IoU of (..., n, 4) and (..., m, 4) boxes in xyxy format, returns (..., n, m)."""
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    lt = np.maximum(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = np.minimum(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = area1[..., :, None] + area2[..., None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter, dtype=np.float64), where=union > 0)
+
+def _text_weight(text_len1, text_len2):
+    sigma = 10 ** 2
+    return np.exp(-(np.asarray(text_len1, dtype=np.float64) - text_len2) ** 2 / (2 * sigma))
+
+def layout_arrays(layout):
+    """(bboxes (n, 4), is_speaker (n,), text_length (n,)) of a layout's elements (MangaLayout or ArrayLayout)."""
+    from lib.layout.layout import ELEMENT_SPEAKER, Speaker
+
+    elements = layout.elements
+    if isinstance(elements, np.ndarray):
+        is_speaker = elements["type"] == ELEMENT_SPEAKER
+        return elements["bbox"].astype(np.float64), is_speaker, np.where(is_speaker, elements["text_length"], 0).astype(np.float64)
+    boxes = np.array([elem.bbox for elem in elements], dtype=np.float64).reshape(len(elements), 4)
+    is_speaker = np.array([type(elem) == Speaker for elem in elements], dtype=bool)
+    text_length = np.array([elem.text_length if type(elem) == Speaker else 0 for elem in elements], dtype=np.float64)
+    return boxes, is_speaker, text_length
+
+def _weight_matrix_from_arrays(boxes1, speaker1, text1, boxes2, speaker2, text2, iou_weight: float):
+    """
+    要素間の重み行列 (n, m)
+    同じ種類の要素同士のみ重みを持つ。Speaker同士は IoU とセリフ長の類似度の加重平均、NonSpeaker同士は IoU
+    """
+    iou = _box_iou(boxes1, boxes2)
+    both_speakers = speaker1[:, None] & speaker2[None, :]
+    same_type = speaker1[:, None] == speaker2[None, :]
+    text_weight = _text_weight(text1[:, None], text2[None, :])
+    weight_matrix = np.where(both_speakers, iou_weight * iou + (1 - iou_weight) * text_weight, iou)
+    return np.where(same_type, weight_matrix, 0.0)
+
 def _calc_weight_matrix(layout1, layout2, iou_weight: float):
-    # 関数内でインポート
-    from lib.layout.layout import Speaker
-    
-    boxes1 = torch.tensor([elem.bbox for elem in layout1.elements], dtype=torch.float32)
-    boxes2 = torch.tensor([elem.bbox for elem in layout2.elements], dtype=torch.float32)
-    
-    n = len(boxes1)
-    m = len(boxes2)
-    if n == 0 or m == 0:
+    boxes1, speaker1, text1 = layout_arrays(layout1)
+    boxes2, speaker2, text2 = layout_arrays(layout2)
+    if len(boxes1) == 0 or len(boxes2) == 0:
         return None
-    
-    weight_matrix = box_iou(boxes1, boxes2).numpy()
-    for i in range(n):
-        for j in range(m):
-            type1 = type(layout1.elements[i])
-            type2 = type(layout2.elements[j])
-            if type1 != type2:
-                weight_matrix[i,j] = 0
-            if type1 == Speaker and type2 == Speaker:
-                text_len1 = layout1.elements[i].text_length
-                text_len2 = layout2.elements[j].text_length
-                sigma = 10 ** 2
-                text_weight = math.exp(-(text_len1 - text_len2)**2 / (2 * sigma))
-                weight_matrix[i,j] = iou_weight * weight_matrix[i,j] + (1 - iou_weight) * text_weight
-
-    return weight_matrix
+    return _weight_matrix_from_arrays(boxes1, speaker1, text1, boxes2, speaker2, text2, iou_weight)
+
+def similarity_from_arrays(boxes1, speaker1, text1, unrelated1, boxes2, speaker2, text2, unrelated2, iou_weight: float):
+    """
+    calc_similarity の本体。MangaLayout を組み立てずに配列から直接スコアを計算する。
+
+    Returns:
+        (score, row_indices, col_indices)
+    """
+    layout_score = float(_text_weight(unrelated1, unrelated2))
+
+    row_indices = np.zeros(0, dtype=np.int64)
+    col_indices = np.zeros(0, dtype=np.int64)
+    if len(boxes1) > 0 and len(boxes2) > 0:
+        weight_matrix = _weight_matrix_from_arrays(boxes1, speaker1, text1, boxes2, speaker2, text2, iou_weight)
+        if max(weight_matrix.shape) <= SMALL_ASSIGNMENT_MAX:
+            _, row_indices, col_indices = _assign_small(weight_matrix[None])
+            row_indices, col_indices = row_indices[0], col_indices[0]
+        else:
+            row_indices, col_indices = linear_sum_assignment(-weight_matrix)
+        layout_score += float(weight_matrix[row_indices, col_indices].sum())
+
+    return layout_score, row_indices, col_indices
 
 def calc_similarity(
         layout1,
@@ -49,26 +87,116 @@ def calc_similarity(
 
     if layout1.width != layout2.width or layout1.height != layout2.height:
         raise ValueError("Layouts must have the same width and height")
-    
-    layout_score = 0.0
-    text_len1 = layout1.unrelated_text_length
-    text_len2 = layout2.unrelated_text_length
-    sigma = 10 ** 2
-    layout_score += math.exp(-(text_len1 - text_len2)**2 / (2 * sigma))
 
-    row_indices = []
-    col_indices = []
+    boxes1, speaker1, text1 = layout_arrays(layout1)
+    boxes2, speaker2, text2 = layout_arrays(layout2)
+    layout_score, row_indices, col_indices = similarity_from_arrays(
+        boxes1, speaker1, text1, layout1.unrelated_text_length,
+        boxes2, speaker2, text2, layout2.unrelated_text_length,
+        iou_weight,
+    )
+    return layout_score, zip(row_indices, col_indices)
 
-    weight_matrix = _calc_weight_matrix(layout1, layout2, iou_weight)
-    if weight_matrix is not None:
-        cost_matrix = -weight_matrix
-        
-        row_indices, col_indices = linear_sum_assignment(cost_matrix)
-        
-        for i, j in zip(row_indices, col_indices):
-            layout_score += weight_matrix[i, j]
 
-    return layout_score, zip(row_indices, col_indices)
+# これ以下の要素数なら割り当てを全列挙で解く (3! = 6 通り)
+SMALL_ASSIGNMENT_MAX = 3
+
+@functools.lru_cache(maxsize=None)
+def _permutations(m: int, n: int) -> np.ndarray:
+    """range(m) から n 個を選ぶ順列 (P, n)"""
+    return np.array(list(itertools.permutations(range(m), n)), dtype=np.int64).reshape(-1, n)
+
+def _assign_small(weight: np.ndarray):
+    """
+    Exact maximum-weight assignment of N (n, m) matrices with n, m <= SMALL_ASSIGNMENT_MAX,
+    by scoring every injective mapping of the smaller side at once.
+
+    Returns:
+        values (N,), row_indices (N, min(n, m)), col_indices (N, min(n, m))
+    """
+    num, n, m = weight.shape
+    if n > m:
+        values, col_indices, row_indices = _assign_small(weight.transpose(0, 2, 1))
+        order = np.argsort(row_indices, axis=1)
+        return values, np.take_along_axis(row_indices, order, 1), np.take_along_axis(col_indices, order, 1)
+
+    perms = _permutations(m, n)
+    totals = weight[:, np.arange(n), perms].sum(axis=-1)
+    best = totals.argmax(axis=1)
+    values = totals[np.arange(num), best]
+    row_indices = np.broadcast_to(np.arange(n), (num, n))
+    return values, row_indices, perms[best]
+
+def _assign_block(weight: np.ndarray):
+    """
+    Maximum-weight assignment of N square (k, k) blocks at once.
+    k <= SMALL_ASSIGNMENT_MAX は全列挙、それより大きい場合のみ候補ごとに Hungarian 法を使う。
+
+    Returns:
+        values (N,): 割り当ての重みの合計
+        perm (N, k): query の k 番目の要素に対応する reference 側の要素
+    """
+    n, k = weight.shape[0], weight.shape[1]
+    if k == 0:
+        return np.zeros(n), np.zeros((n, 0), dtype=np.int64)
+    if k == 1:
+        return weight[:, 0, 0].copy(), np.zeros((n, 1), dtype=np.int64)
+    if k <= SMALL_ASSIGNMENT_MAX:
+        values, _, perm = _assign_small(weight)
+        return values, perm
+
+    values = np.empty(n)
+    perm = np.empty((n, k), dtype=np.int64)
+    for i in range(n):
+        row_indices, col_indices = linear_sum_assignment(-weight[i])
+        perm[i] = col_indices
+        values[i] = weight[i, row_indices, col_indices].sum()
+    return values, perm
+
+def calc_similarity_batch(layout, ref_boxes, ref_text_length, ref_unrelated_text_length, iou_weight: float):
+    """
+    Scores one query layout against N reference layouts of the same "{speakers}_{non_speakers}" bucket.
+
+    Speaker と NonSpeaker の間の重みは常に 0 なので、割り当て問題は Speaker 同士と NonSpeaker 同士の
+    2つのブロックに分解できる (スコアは calc_similarity と同じ)。IoU とセリフ長の重みは全候補まとめて計算し、
+    要素が1つしかないブロックは割り当てを解かずにそのまま使う。
+
+    Args:
+        layout: query MangaLayout (reference と同じ width/height)
+        ref_boxes: (N, E, 4) reference の要素 bbox (Speaker が先頭 S 個)
+        ref_text_length: (N, S) reference の Speaker のセリフ長
+        ref_unrelated_text_length: (N,)
+        iou_weight: IoU の重み
+
+    Returns:
+        scores (N,)
+        assignment (N, E): query の i 番目の要素に対応する reference の要素のインデックス
+    """
+    query_boxes, query_speaker, query_text = layout_arrays(layout)
+    ref_boxes = np.asarray(ref_boxes, dtype=np.float64)
+    n, num_elements = ref_boxes.shape[0], ref_boxes.shape[1]
+    num_speakers = np.asarray(ref_text_length).shape[1]
+    speaker_idx = np.flatnonzero(query_speaker)
+    non_speaker_idx = np.flatnonzero(~query_speaker)
+    if len(query_boxes) != num_elements or len(speaker_idx) != num_speakers:
+        raise ValueError("Query layout does not belong to the reference bucket")
+
+    scores = _text_weight(layout.unrelated_text_length, ref_unrelated_text_length).reshape(n)
+    assignment = np.empty((n, num_elements), dtype=np.int64)
+
+    # Speaker 同士: IoU とセリフ長の類似度の加重平均
+    iou = _box_iou(query_boxes[speaker_idx], ref_boxes[:, :num_speakers])
+    text_weight = _text_weight(query_text[speaker_idx][None, :, None], np.asarray(ref_text_length)[:, None, :])
+    values, perm = _assign_block(iou_weight * iou + (1 - iou_weight) * text_weight)
+    scores += values
+    assignment[:, speaker_idx] = perm
+
+    # NonSpeaker 同士: IoU のみ
+    values, perm = _assign_block(_box_iou(query_boxes[non_speaker_idx], ref_boxes[:, num_speakers:]))
+    scores += values
+    assignment[:, non_speaker_idx] = perm + num_speakers
+
+    return scores, assignment
 
 
 # test function for calc_similarity
@@ -0,0 +1,113 @@
+import math
+import threading
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Shared font cache
+#
+# NotoSansCJK-Regular.ttc は大きいので、ImageFont.truetype はフォントのパスとサイズごとに1回だけ呼ぶ。
+# ネームの描画 (lib.name.name) と吹き出しのシミュレーション (lib.scoring.geometry) で共有する。
+
+FONTPATH = "fonts/NotoSansCJK-Regular.ttc"
+FONTSIZE = 20
+
+_fonts = {}
+_char_sizes = {}
+_atlases = {}
+_lock = threading.Lock()
+
+
+def get_font(path=FONTPATH, size=FONTSIZE):
+    """ImageFont.truetype(path, size), loaded once per (path, size). Raises OSError like truetype."""
+    key = (path, size)
+    with _lock:
+        font = _fonts.get(key)
+    if font is None:
+        font = ImageFont.truetype(path, size)
+        with _lock:
+            font = _fonts.setdefault(key, font)
+    return font
+
+
+def char_size(path=FONTPATH, size=FONTSIZE, char="あ"):
+    """(width, height) of the bbox of char, measured once per (path, size, char)."""
+    key = (path, size, char)
+    with _lock:
+        measured = _char_sizes.get(key)
+    if measured is None:
+        char_bbox = get_font(path, size).getbbox(char)
+        measured = (char_bbox[2] - char_bbox[0], char_bbox[3] - char_bbox[1])
+        with _lock:
+            _char_sizes[key] = measured
+    return measured
+
+
+class GlyphAtlas:
+    """
+    Glyph masks of one font, each rasterized once, for drawing text one character at a time.
+
+    draw(img, xy, char, fill) gives the same pixels as ImageDraw.Draw(img).text(xy, char, font=font, fill=fill):
+    the mask is rendered by Pillow's own text path for the same sub-pixel start, and Image.paste(color, box, mask)
+    blends it with the same fill routine as draw.text.
+    """
+
+    # Image.paste(color, box, mask) と draw.text の塗り方が同じになるモード
+    MODES = ("RGB", "L")
+
+    def __init__(self, font):
+        self.font = font
+        self._glyphs = {}
+        self._lock = threading.Lock()
+
+    def _rasterize(self, char, start):
+        mask, offset = self.font.getmask2(char, "L", start=start)
+        width, height = mask.size
+        if width == 0 or height == 0:
+            return None, offset
+        # マスクが (pad, pad) に来るように描いてから切り出す
+        pad = max(0, offset[0], offset[1])
+        canvas = Image.new("L", (pad + width, pad + height), 0)
+        ImageDraw.Draw(canvas).text((pad - offset[0] + start[0], pad - offset[1] + start[1]), char, font=self.font, fill=255)
+        return canvas.crop((pad, pad, pad + width, pad + height)), offset
+
+    def glyph(self, char, start=(0.0, 0.0)):
+        """(mask image or None for blank glyphs, offset) of char drawn at a position with the given fractional part."""
+        key = (char, start)
+        with self._lock:
+            glyph = self._glyphs.get(key)
+        if glyph is None:
+            glyph = self._rasterize(char, start)
+            with self._lock:
+                glyph = self._glyphs.setdefault(key, glyph)
+        return glyph
+
+    def draw(self, img, xy, char, fill="black"):
+        start = (math.modf(xy[0])[0], math.modf(xy[1])[0])
+        if img.mode not in self.MODES or start[0] < 0 or start[1] < 0:
+            ImageDraw.Draw(img).text(xy, char, font=self.font, fill=fill)
+            return
+        mask, offset = self.glyph(char, start)
+        if mask is None:
+            return
+        x = int(xy[0]) + offset[0]
+        y = int(xy[1]) + offset[1]
+        img.paste(fill, (x, y, x + mask.width, y + mask.height), mask)
+
+
+def get_atlas(path=FONTPATH, size=FONTSIZE):
+    """GlyphAtlas of get_font(path, size), shared per (path, size)."""
+    key = (path, size)
+    with _lock:
+        atlas = _atlases.get(key)
+    if atlas is None:
+        atlas = GlyphAtlas(get_font(path, size))
+        with _lock:
+            atlas = _atlases.setdefault(key, atlas)
+    return atlas
+
+
+def clear_cache():
+    with _lock:
+        _fonts.clear()
+        _char_sizes.clear()
+        _atlases.clear()
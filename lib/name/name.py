@@ -1,24 +1,24 @@
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+import functools
 import os
-from lib.layout.layout import MangaLayout, Speaker, NonSpeaker
+from lib.layout.layout import count_speakers, speaker_text_bboxes_in_reading_order, unrelated_text_bboxes
+from lib.name.font import FONTPATH, char_size, get_atlas, get_font
 from math import atan2, cos, sin, hypot
 import random
 from math import ceil
 
-FONTPATH = "fonts/NotoSansCJK-Regular.ttc"
 
-
-def draw_vertical_text(img, text, bbox, type):
+def draw_vertical_text(img, text, bbox, type, use_atlas=True):
     draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype(FONTPATH, 20)
+    font = get_font(FONTPATH, 20)
+    # 文字ごとに draw.text でラスタライズせず、一度ラスタライズしたグリフを貼り付ける (結果は同じ)
+    atlas = get_atlas(FONTPATH, 20) if use_atlas else None
     vertical_margin = 2
     horiziontal_margin = 2
     image_width, image_height = img.width, img.height
     width = bbox[2] - bbox[0]
     height = bbox[3] - bbox[1]
-    char_bbox = font.getbbox("あ")
-    char_width = char_bbox[2] - char_bbox[0]
-    char_height = char_bbox[3] - char_bbox[1]
+    char_width, char_height = char_size(FONTPATH, 20)
     chars_per_col = int(height / (char_height + vertical_margin))
 
     estimated_width = char_width * (int((len(text) / chars_per_col)) + 1)
@@ -50,7 +50,10 @@ def draw_vertical_text(img, text, bbox, type):
     cur_col = 0
     cur_position = (bbox[2] - char_width, bbox[1])
     for char in text:
-        draw.text(cur_position, char, font=font, fill="black")
+        if atlas is not None:
+            atlas.draw(img, cur_position, char, fill="black")
+        else:
+            draw.text(cur_position, char, font=font, fill="black")
         cur_col += 1
         if cur_col == chars_per_col:
             cur_col = 0
@@ -79,45 +82,28 @@ def _generate_name(pil_image, base_layout, scored_layout, panel):
     ref_layout, _, _ = scored_layout
 
     # QueryレイアウトのSpeakerの数 > 参照レイアウトのSpeakerの数 => 配置できないのでネームの生成は断念
-    num_speakers_in_ref_layout = 0
-    for layout_ele in ref_layout.elements:
-        if type(layout_ele) == Speaker:
-            num_speakers_in_ref_layout += 1
-    num_speakers = 0
-    for layout_ele in base_layout.elements:
-        if type(layout_ele) == Speaker:
-            num_speakers += 1
+    num_speakers_in_ref_layout = count_speakers(ref_layout)
+    num_speakers = count_speakers(base_layout)
     if num_speakers_in_ref_layout < num_speakers:
         print("num_speakers_in_ref_layout < num_speakers")
         return False
 
-    # 参照レイアウトのSpeakerエレメントを吹き出しの登場順に並び替え
-    def custom_sort(element):
-        if type(element) == NonSpeaker:
-            return -1
-        if element.text_info is None:
-            return 0
-        center_pos = []
-        for text_obj in element.text_info:
-            center_pos.append((text_obj["bbox"][0] + text_obj["bbox"][2]) / 2)
-        return max(center_pos)
-
-    ref_layout.elements = sorted(ref_layout.elements, key=custom_sort, reverse=True)
-
-    # セリフの位置を参照レイアウトのエレメントをもとに割り当て
-    # 1. QueryレイアウトのSpeakerの数 <= 参照レイアウトのSpeakerの数
-    # 2. 前述の並び替えでSpeakerエレメントはNonSpeakerよりも必ず前側に来る
-    # => NonSpeakerエレメントがセリフ位置の参照に使われることはない
+    # 参照レイアウトのSpeakerエレメントのセリフ位置を吹き出しの登場順に並び替え
+    # (参照レイアウトは共有されうるので並び替えた結果は別のリストに持つ)
+    ref_text_bboxes = speaker_text_bboxes_in_reading_order(ref_layout)
+
+    # セリフの位置を参照レイアウトのSpeakerエレメントをもとに割り当て
+    # QueryレイアウトのSpeakerの数 <= 参照レイアウトのSpeakerの数 なので足りなくなることはない
     panel_pointer = 0
-    for ref_layout_element in ref_layout.elements:
+    for text_bboxes in ref_text_bboxes:
         while panel_pointer < len(panel) and panel[panel_pointer]["type"] != "dialogue":
             panel_pointer += 1
         if panel_pointer >= len(panel):
             break
         bbox = [-1, -1, -1, -1]
-        for text_obj in ref_layout_element.text_info:
-            if text_obj["bbox"][2] > bbox[2]:
-                bbox = text_obj["bbox"]
+        for text_bbox in text_bboxes:
+            if text_bbox[2] > bbox[2]:
+                bbox = text_bbox
         
         draw_vertical_text(pil_image, panel[panel_pointer]["content"], bbox, "dialogue")
         panel_pointer += 1
@@ -128,35 +114,59 @@ def _generate_name(pil_image, base_layout, scored_layout, panel):
         if panel_ele["type"] == "monologue":
             total_monologue += panel_ele["content"]
 
-    unrelated_text_bboxes = [bbox["bbox"] for bbox in ref_layout.unrelated_text_bbox]
-    unrelated_text_bboxes = sorted(
-        unrelated_text_bboxes, key=lambda x: x[2], reverse=True
+    ref_unrelated_bboxes = sorted(
+        unrelated_text_bboxes(ref_layout), key=lambda x: x[2], reverse=True
     )
-    if len(ref_layout.unrelated_text_bbox) > 0:
+    if len(ref_unrelated_bboxes) > 0:
         draw_vertical_text(
-            pil_image, total_monologue, unrelated_text_bboxes[0], "monologue"
+            pil_image, total_monologue, ref_unrelated_bboxes[0], "monologue"
         )
     return
 
 
-def generate_name(controlnet_result, base_layout, scored_layout, panel, save_path):
+# 参照レイアウトの元画像 (Manga109 のページ) は同じものが何度も選ばれるので、リサイズ済みのものを保持する
+TEMPLATE_CACHE_SIZE = 64
+
+
+def load_base_image(controlnet_result):
+    """The base image of a variation, decoded and resized to the canvas once and copied per reference layout."""
+    width, height = controlnet_result.canvas_width, controlnet_result.canvas_height
+    return Image.open(controlnet_result.base_image_path).resize((width, height))
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def load_template_image(image_path, width, height):
+    """Reference layout image resized to (width, height). Shared, do not draw on it."""
+    with Image.open(image_path) as image:
+        return image.resize((width, height))
+
+
+def generate_name(controlnet_result, base_layout, scored_layout, panel, save_path, base_image=None, save_composite=True):
+    """
+    Draws the dialogue of panel on the base image following the reference layout, saved as *_onlyname.png.
+    Args:
+        base_image: load_base_image(controlnet_result), to decode the base image once per variation
+        save_composite: also save the reference layout image and the name side by side to save_path
+    """
     width, height = controlnet_result.canvas_width, controlnet_result.canvas_height
     # pose_only_pil_image = controlnetres2pil(controlnet_result)
-    original_pil_image = Image.open(controlnet_result.base_image_path).resize(
-        (width, height)
-    )
+    if base_image is None:
+        base_image = load_base_image(controlnet_result)
+    original_pil_image = base_image.copy()
     # _generate_name(pose_only_pil_image, base_layout, scored_layout, panel)
     # _generate_name(controlnet_res_pil_image, base_layout, scored_layout, panel)
     _generate_name(original_pil_image, base_layout, scored_layout, panel)
-    manga_layout_image = Image.open(scored_layout[0].image_path).resize((width, height))
-    images = [manga_layout_image, original_pil_image]
     original_pil_image.save(save_path.replace(".png", "_onlyname.png"))
-    horizontal_pasted_image = horizontal_paste(images)
-    horizontal_pasted_image.save(save_path)
+    if save_composite:
+        manga_layout_image = load_template_image(scored_layout[0].image_path, width, height)
+        images = [manga_layout_image, original_pil_image]
+        horizontal_pasted_image = horizontal_paste(images)
+        horizontal_pasted_image.save(save_path)
 
 
-def generate_animepose_image(base_image_path, prompt, save_path, width=512, height=512):
+def generate_animepose_image(base_image_path, prompt, save_path, width=512, height=512, seed=-1):
+    """Line-art (scribble ControlNet) version of base_image_path; returns its seed."""
     from lib.image.controlnet import generate_with_controlnet_openpose
 
     prefix = "(((((<lora:Pose_Sketches_SD1.5:1>))))) (messy:1.5), (scribble:1.4), (bad art:1.3), lineart, clean lines, sketches, simple,  (monochrome:2), (white background:1.5)"
-    generate_with_controlnet_openpose(base_image_path, prefix + prompt, save_path, width=width, height=height)
\ No newline at end of file
+    return generate_with_controlnet_openpose(base_image_path, prefix + prompt, save_path, width=width, height=height, seed=seed)
\ No newline at end of file
@@ -36,7 +36,8 @@ def get_best_image_for_panel(run_dir, panel_idx):
                     raw_path = opt.get('generated_image_path')
                     if raw_path:
                         # Ensure we get the name-composited version
-                        best_image_path = raw_path
+                        # (the side-by-side image at raw_path is only saved with --save_name_composite)
+                        best_image_path = raw_path[:-4] + "_onlyname.png"
                     
         if best_image_path:
             if not os.path.exists(best_image_path):
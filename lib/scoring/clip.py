@@ -0,0 +1,347 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+from lib.common.digest import file_digest
+
+# Batched CLIP encoders used by lib.scoring.scorer
+#
+# 画像はまとめて image encoder に通し、プロンプトは 75 トークンごとのチャンクをまとめて text encoder に通す。
+# チャンクは長さが揃わないので pad して attention_mask を渡す
+# (CLIP の text encoder は causal なので、EOS 位置の出力は後ろのパディングの影響を受けない)。
+
+CLIP_MODEL_ID = "openai/clip-vit-base-patch32"
+CHUNK_SIZE = 75
+
+# プロンプトの埋め込みのメモ ((model_id, prompt) -> (D,) float32)
+_text_embeddings = {}
+_text_embeddings_lock = threading.Lock()
+
+
+def _normalize(embeds):
+    return embeds / embeds.norm(p=2, dim=-1, keepdim=True)
+
+
+def prompt_chunks(text_prompt, processor, chunk_size=CHUNK_SIZE):
+    """Token ids of a prompt split into chunks of chunk_size tokens, each wrapped in BOS/EOS."""
+    # Tokenize without truncation first (to handle long prompts manually)
+    inputs_text = processor(text=[text_prompt], return_tensors="pt", padding=False, truncation=False)
+    input_ids = inputs_text["input_ids"][0]
+    # 先頭と末尾の BOS/EOS も含めて 75 トークンずつに分ける (calculate_clip_score の元の実装と同じ分け方)
+    bos_id = processor.tokenizer.bos_token_id
+    eos_id = processor.tokenizer.eos_token_id
+    return [
+        torch.cat([torch.tensor([bos_id]), input_ids[i:i + chunk_size], torch.tensor([eos_id])])
+        for i in range(0, len(input_ids), chunk_size)
+    ]
+
+
+def encode_prompts(prompts, model, processor, device, batch_size=32):
+    """
+    Averaged, normalized text embedding of each prompt.
+
+    Returns:
+        list: prompt ごとの (D,) tensor (チャンクがない場合は None)
+    """
+    chunks = []
+    owners = []
+    for p, prompt in enumerate(prompts):
+        for chunk in prompt_chunks(prompt, processor):
+            chunks.append(chunk)
+            owners.append(p)
+
+    pad_id = processor.tokenizer.pad_token_id
+    if pad_id is None:
+        pad_id = processor.tokenizer.eos_token_id
+    chunk_embeds = []
+    with torch.no_grad():
+        for start in range(0, len(chunks), batch_size):
+            batch = chunks[start:start + batch_size]
+            length = max(len(chunk) for chunk in batch)
+            input_ids = torch.full((len(batch), length), pad_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+            for k, chunk in enumerate(batch):
+                input_ids[k, :len(chunk)] = chunk
+                attention_mask[k, :len(chunk)] = 1
+            text_outputs = model.get_text_features(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+            chunk_embeds.append(_normalize(text_outputs))
+
+    results = [None] * len(prompts)
+    if not chunks:
+        return results
+    chunk_embeds = torch.cat(chunk_embeds)
+    owners = torch.tensor(owners)
+    for p in range(len(prompts)):
+        selected = chunk_embeds[owners == p]
+        if len(selected) > 0:
+            # Average the chunk embeddings and normalize again
+            results[p] = _normalize(selected.mean(dim=0))
+    return results
+
+
+def encode_images(image_paths, model, processor, device, batch_size=16):
+    """
+    Normalized image embedding of each image.
+
+    Returns:
+        list: 画像ごとの (D,) tensor (存在しない/読めない画像は None)
+    """
+    results = [None] * len(image_paths)
+    images = []
+    indices = []
+    for i, image_path in enumerate(image_paths):
+        if not os.path.exists(image_path):
+            continue
+        try:
+            images.append(Image.open(image_path).convert("RGB"))
+            indices.append(i)
+        except Exception as e:
+            print(f"[Scoring] Error loading image {image_path}: {e}")
+
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            image_inputs = processor(images=images[start:start + batch_size], return_tensors="pt").to(device)
+            image_embeds = _normalize(model.get_image_features(**image_inputs))
+            for i, embed in zip(indices[start:start + batch_size], image_embeds):
+                results[i] = embed
+    return results
+
+
+def clip_scores(image_embeds, text_embeds, pairs):
+    """
+    Cosine similarity of each (image index, text index) pair, computed as one matrix product.
+    Pairs whose image or text embedding is missing score 0.0.
+    """
+    valid_images = [i for i, embed in enumerate(image_embeds) if embed is not None]
+    valid_texts = [t for t, embed in enumerate(text_embeds) if embed is not None]
+    if not valid_images or not valid_texts:
+        return [0.0] * len(pairs)
+    image_row = {i: k for k, i in enumerate(valid_images)}
+    text_col = {t: k for k, t in enumerate(valid_texts)}
+    image_matrix = torch.stack([image_embeds[i] for i in valid_images]).float()
+    text_matrix = torch.stack([text_embeds[t] for t in valid_texts]).float().to(image_matrix.device)
+    similarity = image_matrix @ text_matrix.t()
+    similarity = similarity.tolist()
+    return [
+        similarity[image_row[i]][text_col[t]] if i in image_row and t in text_col else 0.0
+        for i, t in pairs
+    ]
+
+
+def image_key(image_path, model_id):
+    """Embedding store key of an image: model id + sha256 of the file contents."""
+    return f"image:{model_id}:{file_digest(image_path)}"
+
+
+def encode_images_cached(image_paths, model, processor, device, model_id, stores=(), batch_size=16, flush=True):
+    """
+    encode_images that only encodes images whose embedding is in none of the stores.
+    Stores are searched in order; embeddings found in a later store (or newly encoded) are added to the earlier ones.
+    With flush=False the stores are not written; the caller flushes them once after all additions.
+    """
+    results = [None] * len(image_paths)
+    keys = {}
+    for i, image_path in enumerate(image_paths):
+        if os.path.exists(image_path):
+            keys[i] = image_key(image_path, model_id)
+
+    found = {}
+    for k, store in enumerate(stores):
+        missing = [key for key in dict.fromkeys(keys.values()) if key not in found]
+        hits = store.get(missing)
+        if hits and k > 0:
+            for earlier in stores[:k]:
+                earlier.add(hits)
+        found.update(hits)
+
+    # 同じ内容の画像は1回だけエンコードする
+    to_encode = {}
+    for i, key in keys.items():
+        if key not in found and key not in to_encode:
+            to_encode[key] = image_paths[i]
+    if to_encode:
+        encoded = encode_images(list(to_encode.values()), model, processor, device, batch_size)
+        new_items = {key: embed.float().cpu().numpy() for key, embed in zip(to_encode, encoded) if embed is not None}
+        for store in stores:
+            store.add(new_items)
+        found.update(new_items)
+    if flush:
+        for store in stores:
+            store.flush()
+
+    for i, key in keys.items():
+        if key in found:
+            results[i] = torch.from_numpy(np.asarray(found[key])).to(device)
+    return results
+
+
+def text_key(text_prompt, model_id):
+    """Embedding store key of a prompt: model id + sha256 of the prompt."""
+    return f"text:{model_id}:{hashlib.sha256(text_prompt.encode('utf-8')).hexdigest()}"
+
+
+def encode_prompts_cached(prompts, model, processor, device, model_id, stores=(), batch_size=32, flush=True):
+    """
+    encode_prompts memoized per unique prompt, in memory and in the stores.
+    Known prompts are neither tokenized nor encoded again. flush as in encode_images_cached.
+    """
+    with _text_embeddings_lock:
+        found = {prompt: _text_embeddings[(model_id, prompt)] for prompt in prompts if (model_id, prompt) in _text_embeddings}
+
+    missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in found]
+    for k, store in enumerate(stores):
+        if not missing:
+            break
+        keys = {text_key(prompt, model_id): prompt for prompt in missing}
+        hits = store.get(keys)
+        if hits and k > 0:
+            for earlier in stores[:k]:
+                earlier.add(hits)
+        found.update({keys[key]: embed for key, embed in hits.items()})
+        missing = [prompt for prompt in missing if prompt not in found]
+
+    if missing:
+        encoded = encode_prompts(missing, model, processor, device, batch_size)
+        new_items = {prompt: embed.float().cpu().numpy() for prompt, embed in zip(missing, encoded) if embed is not None}
+        for store in stores:
+            store.add({text_key(prompt, model_id): embed for prompt, embed in new_items.items()})
+        found.update(new_items)
+    if flush:
+        for store in stores:
+            store.flush()
+
+    with _text_embeddings_lock:
+        for prompt, embed in found.items():
+            _text_embeddings[(model_id, prompt)] = embed
+    return [torch.from_numpy(np.asarray(found[prompt])).to(device) if prompt in found else None for prompt in prompts]
+
+
+def clear_text_embeddings():
+    with _text_embeddings_lock:
+        _text_embeddings.clear()
+
+
+def calculate_clip_scores(pairs, model, processor, device, image_batch_size=16, text_batch_size=32, model_id=CLIP_MODEL_ID, stores=()):
+    """
+    Batched calculate_clip_score.
+    Every unique image and prompt is encoded once, in batches, and all scores come from one matrix product.
+    Args:
+        pairs: list of (image_path, text_prompt)
+        stores: EmbeddingStores of image and text embeddings. Only images and prompts found in none of them
+            (nor in the in-memory prompt memo) are encoded. Each store is written once, after both.
+    Returns:
+        list of scores (0.0 for missing images)
+    """
+    if model is None or not pairs: return [0.0] * len(pairs)
+    image_paths = list(dict.fromkeys(image_path for image_path, _ in pairs))
+    prompts = list(dict.fromkeys(text_prompt for _, text_prompt in pairs))
+    try:
+        image_embeds = encode_images_cached(image_paths, model, processor, device, model_id, stores, image_batch_size, flush=False)
+        text_embeds = encode_prompts_cached(prompts, model, processor, device, model_id, stores, text_batch_size, flush=False)
+        for store in stores:
+            store.flush()
+    except Exception as e:
+        print(f"[Scoring] Error calculating CLIP scores: {e}")
+        return [0.0] * len(pairs)
+    image_index = {image_path: i for i, image_path in enumerate(image_paths)}
+    prompt_index = {prompt: t for t, prompt in enumerate(prompts)}
+    return clip_scores(
+        image_embeds,
+        text_embeds,
+        [(image_index[image_path], prompt_index[text_prompt]) for image_path, text_prompt in pairs],
+    )
+
+
+# ---   CPU BACKENDS   ---
+#
+#   fp32:        transformers の CLIPModel そのまま
+#   int8:        Linear 層を動的量子化 (torch.ao.quantization.quantize_dynamic)、CPU のみ
+#   torchscript: export_torchscript で書き出した image/text encoder を読み込む (transformers のモデル定義を使わない)
+
+BACKENDS = ("fp32", "int8", "torchscript")
+IMAGE_ENCODER_NAME = "image_encoder.pt"
+TEXT_ENCODER_NAME = "text_encoder.pt"
+
+
+def clip_backend(backend=None):
+    """backend, else $CLIP_BACKEND, else fp32; raises ValueError for an unknown backend."""
+    backend = backend or os.getenv("CLIP_BACKEND", "fp32")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CLIP backend: {backend} (expected one of {BACKENDS})")
+    return backend
+
+
+def backend_id(model_id, backend):
+    """Model id used in embedding store keys (embeddings of a quantized model drift from fp32)."""
+    return model_id if backend in (None, "fp32") else f"{model_id}+{backend}"
+
+
+def set_num_threads(num_threads=None, num_interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(int(num_interop_threads))
+        except RuntimeError as e:
+            # inter-op のスレッド数は並列処理が始まる前にしか変更できない
+            print(f"[Scoring] Could not set inter-op threads: {e}")
+
+
+def quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
+def export_torchscript(model, processor, output_dir, image_size=224):
+    """Traces the image and text encoders of a CLIP model into output_dir (loaded by TorchScriptCLIP)."""
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.float().cpu().eval()
+    pixel_values = torch.rand(2, 3, image_size, image_size)
+    input_ids = torch.full((2, CHUNK_SIZE + 2), processor.tokenizer.eos_token_id, dtype=torch.long)
+    input_ids[:, 0] = processor.tokenizer.bos_token_id
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, CHUNK_SIZE // 2:] = 0
+    with torch.no_grad():
+        image_encoder = torch.jit.trace(_ImageEncoder(model), (pixel_values,), check_trace=False)
+        text_encoder = torch.jit.trace(_TextEncoder(model), (input_ids, attention_mask), check_trace=False)
+    torch.jit.save(image_encoder, os.path.join(output_dir, IMAGE_ENCODER_NAME))
+    torch.jit.save(text_encoder, os.path.join(output_dir, TEXT_ENCODER_NAME))
+    if hasattr(processor, "save_pretrained"):
+        processor.save_pretrained(output_dir)
+
+
+class TorchScriptCLIP:
+    """get_image_features / get_text_features backed by the files written by export_torchscript."""
+
+    def __init__(self, directory, device="cpu"):
+        self.image_encoder = torch.jit.load(os.path.join(directory, IMAGE_ENCODER_NAME), map_location=device).eval()
+        self.text_encoder = torch.jit.load(os.path.join(directory, TEXT_ENCODER_NAME), map_location=device).eval()
+
+    def get_image_features(self, pixel_values):
+        return self.image_encoder(pixel_values)
+
+    def get_text_features(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return self.text_encoder(input_ids, attention_mask)
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.scoring.clip import CLIP_MODEL_ID, backend_id, calculate_clip_scores, clip_backend
+from lib.scoring.embedding_store import EmbeddingStore
+
+# Long-lived CLIP scoring worker
+#
+# CLIP のモデルを読み込んだままにしておき、run_panel_scoring からの CLIP スコア計算を HTTP (localhost) で受け付ける。
+#
+#   python -m lib.scoring.daemon --backend int8 --threads 8
+#
+#   GET  /health -> {"model_id", "backend"}
+#   POST /score  {"pairs": [[image_path, prompt], ...], "model_id", "backend", "store_dirs", "image_batch_size", "text_batch_size"}
+#             -> {"scores": [...]}
+#
+# 画像はパスで渡すので、デーモンは同じマシンで動かす。SCORING_DAEMON_URL で接続先を変えられる。
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7861
+DEFAULT_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {"model_id": self.server.model_id, "backend": self.server.backend})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            pairs = [(image_path, prompt) for image_path, prompt in request["pairs"]]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        # 別のモデル/バックエンドのスコアを返すと run 間でスコアが比較できなくなるので断る
+        if (request.get("model_id", self.server.model_id), request.get("backend", self.server.backend)) != (self.server.model_id, self.server.backend):
+            self._send_json(409, {"error": "model mismatch", "model_id": self.server.model_id, "backend": self.server.backend})
+            return
+        self._send_json(200, {"scores": self.server.score(
+            pairs,
+            request.get("store_dirs", []),
+            request.get("image_batch_size", 16),
+            request.get("text_batch_size", 32),
+        )})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model, processor, device, model_id=CLIP_MODEL_ID, backend="fp32"):
+        super().__init__(address, ScoringHandler)
+        self.model = model
+        self.processor = processor
+        self.device = device
+        self.model_id = model_id
+        self.backend = backend
+        self._stores = {}
+        # モデルは1つなので推論は1リクエストずつ
+        self._lock = threading.Lock()
+
+    def _store(self, directory):
+        if directory not in self._stores:
+            self._stores[directory] = EmbeddingStore(directory)
+        return self._stores[directory]
+
+    def score(self, pairs, store_dirs, image_batch_size, text_batch_size):
+        with self._lock:
+            stores = [self._store(directory) for directory in store_dirs]
+            return calculate_clip_scores(
+                pairs, self.model, self.processor, self.device, image_batch_size, text_batch_size,
+                backend_id(self.model_id, self.backend), stores,
+            )
+
+
+def daemon_url():
+    return os.getenv("SCORING_DAEMON_URL", DEFAULT_URL)
+
+
+def score_with_daemon(pairs, model_id=CLIP_MODEL_ID, backend="fp32", store_dirs=(), image_batch_size=16, text_batch_size=32, url=None, timeout=600):
+    """
+    CLIP scores from a running scoring daemon.
+    Returns None when no daemon is reachable or it serves another model, so callers can fall back to loading CLIP themselves.
+    """
+    url = url or daemon_url()
+    try:
+        with urllib.request.urlopen(f"{url}/health", timeout=0.5) as response:
+            health = json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+    if (health.get("model_id"), health.get("backend")) != (model_id, backend):
+        print(f"[Scoring] Daemon at {url} serves {health.get('model_id')} ({health.get('backend')}), not {model_id} ({backend})")
+        return None
+
+    payload = json.dumps({
+        "pairs": [[os.path.abspath(image_path), prompt] for image_path, prompt in pairs],
+        "model_id": model_id,
+        "backend": backend,
+        "store_dirs": [os.path.abspath(directory) for directory in store_dirs],
+        "image_batch_size": image_batch_size,
+        "text_batch_size": text_batch_size,
+    }).encode("utf-8")
+    request = urllib.request.Request(f"{url}/score", data=payload, headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())["scores"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[Scoring] Scoring daemon request failed: {e}")
+        return None
+
+
+def main():
+    from lib.scoring.scorer import load_clip_model
+
+    parser = argparse.ArgumentParser(description="Keep CLIP loaded and serve panel scoring requests")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--model_id", default=CLIP_MODEL_ID)
+    parser.add_argument("--backend", default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--torchscript_path", default=None)
+    args = parser.parse_args()
+
+    backend = clip_backend(args.backend)
+    model, processor, device = load_clip_model(args.model_id, backend, args.threads, args.torchscript_path)
+    if model is None:
+        raise SystemExit("Failed to load CLIP model")
+    server = ScoringServer((args.host, args.port), model, processor, device, args.model_id, backend)
+    print(f"[Scoring] Daemon listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Debug images of the geometric penalty
+#
+# スコア計算中は描画せず、描画に必要な幾何情報だけを scores.json に残しておく。
+# 人物 (関節・body/face の bbox) はバリエーションの全参照レイアウトで同じなので、バリエーションごとに1回だけ
+# ("penalty_debug": {"width", "height", "people", "layouts": [{"bubbles", "penalty"}, ...]}) 保存する。
+# 画像は後からまとめて (プロセスプールで) 描くか、UI で必要になったときに描く。
+#
+#   python -m lib.scoring.debug output/<run>/<timestamp>      # run 内の全パネルの *_bbox.png を描画
+#
+# Green (dotted) = Body Box, Blue Dots = Joints, Orange = Face, Red (dashed) = Text Bubble.
+
+BODY_COLOR = (0, 128, 0)
+JOINT_COLOR = (0, 0, 255)
+FACE_COLOR = (255, 165, 0)
+BUBBLE_COLOR = (255, 0, 0)
+DEBUG_SUFFIX = "_bbox.png"
+
+
+def _box_or_none(box):
+    return None if np.isnan(box).any() else [float(v) for v in box]
+
+
+def penalty_debug_data(people_result, bubbles, penalties):
+    """
+    JSON-serializable geometry needed to draw the debug images of K reference layouts against one OpenPose result.
+    The people are stored once; layouts[k] holds the bubbles and penalty of reference k (None where there is no reference layout).
+    """
+    width, height = people_result.canvas_width, people_result.canvas_height
+    body_boxes, face_boxes = people_result.person_boxes()
+    people = []
+    for person, body, face in zip(people_result.people, body_boxes, face_boxes):
+        joints = [
+            [kp[0] * width, kp[1] * height]
+            for kp in person.pose_keypoints_2d or []
+            # Exception if OpenPose returns 0,0 for undetected points
+            if kp[0] > 0 and kp[1] > 0
+        ]
+        people.append({"joints": joints, "body": _box_or_none(body), "face": _box_or_none(face)})
+    return {
+        "width": width,
+        "height": height,
+        "people": people,
+        "layouts": [
+            {"bubbles": [[float(v) for v in bubble] for bubble in b], "penalty": float(penalty)} if b is not None else None
+            for b, penalty in zip(bubbles, penalties)
+        ],
+    }
+
+
+def penalty_debug_record(debug, k):
+    """The record render_penalty_debug draws for reference layout k of penalty_debug_data, or None."""
+    if not debug or k is None or not 0 <= k < len(debug["layouts"]) or debug["layouts"][k] is None:
+        return None
+    return {"width": debug["width"], "height": debug["height"], "people": debug["people"], **debug["layouts"][k]}
+
+
+def _dashed_rectangle(draw, box, color, dash, gap, width=2):
+    x1, y1, x2, y2 = box
+    for (sx, sy), (ex, ey) in [((x1, y1), (x2, y1)), ((x2, y1), (x2, y2)), ((x2, y2), (x1, y2)), ((x1, y2), (x1, y1))]:
+        length = max(abs(ex - sx), abs(ey - sy))
+        if length == 0:
+            continue
+        for start in np.arange(0, length, dash + gap):
+            end = min(start + dash, length)
+            draw.line(
+                [(sx + (ex - sx) * start / length, sy + (ey - sy) * start / length),
+                 (sx + (ex - sx) * end / length, sy + (ey - sy) * end / length)],
+                fill=color, width=width,
+            )
+
+
+def render_penalty_debug(record, save_path, max_size=600):
+    """Draws a debug record (penalty_debug_record: width, height, people, bubbles, penalty) with Pillow."""
+    width, height = record["width"], record["height"]
+    scale = min(1.0, max_size / max(width, height))
+    title_height = 24
+    image = Image.new("RGB", (max(1, round(width * scale)), max(1, round(height * scale)) + title_height), "white")
+    draw = ImageDraw.Draw(image)
+
+    def to_canvas(box):
+        return [box[0] * scale, box[1] * scale + title_height, box[2] * scale, box[3] * scale + title_height]
+
+    draw.rectangle([0, title_height, image.width - 1, image.height - 1], outline=(200, 200, 200))
+    for person in record["people"]:
+        # A. Joints (Blue Dots)
+        for x, y in person["joints"]:
+            cx, cy = x * scale, y * scale + title_height
+            draw.ellipse([cx - 2, cy - 2, cx + 2, cy + 2], fill=JOINT_COLOR)
+        # B. Body Box (Green, dotted)
+        if person["body"]:
+            _dashed_rectangle(draw, to_canvas(person["body"]), BODY_COLOR, 2, 3)
+        # C. Face Box (Orange)
+        if person["face"]:
+            draw.rectangle(to_canvas(person["face"]), outline=FACE_COLOR, width=2)
+
+    # Bubbles (Red Dashed)
+    for bubble in record["bubbles"]:
+        box = to_canvas(bubble)
+        _dashed_rectangle(draw, box, BUBBLE_COLOR, 6, 4)
+        draw.text((box[0], box[1] - 12), "Text", fill=BUBBLE_COLOR)
+
+    draw.text((6, 6), f"Penalty = {record['penalty']}", fill="black")
+    image.save(save_path)
+    return save_path
+
+
+def _render_job(job):
+    record, save_path = job
+    try:
+        return render_penalty_debug(record, save_path)
+    except Exception as e:
+        print(f"[Scoring] Failed to visualize geometric penalty: {e}")
+        return None
+
+
+def render_penalty_debug_images(jobs, max_workers=None):
+    """
+    Draws many debug images, in a process pool when there is more than one.
+    Args:
+        jobs: list of (record, save_path)
+        max_workers: 1 to draw in this process
+    """
+    jobs = list(jobs)
+    if len(jobs) <= 1 or max_workers == 1:
+        return [_render_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_render_job, jobs, chunksize=8))
+
+
+def debug_image_path(generated_image_path):
+    return os.path.splitext(generated_image_path)[0] + DEBUG_SUFFIX
+
+
+def panel_debug_jobs(panel_dir, overwrite=False):
+    """(record, save_path) of every layout option recorded in a panel's scores.json."""
+    score_file = os.path.join(panel_dir, "scores.json")
+    if not os.path.exists(score_file):
+        return []
+    with open(score_file, "r", encoding="utf-8") as f:
+        panel_entry = json.load(f)
+    jobs = []
+    for var in panel_entry.get("variations", []):
+        for layout_opt in var.get("layout_options", []):
+            record = penalty_debug_record(var.get("penalty_debug"), layout_opt.get("rank"))
+            if not record or not layout_opt.get("generated_image_path"):
+                continue
+            save_path = debug_image_path(layout_opt["generated_image_path"])
+            if overwrite or not os.path.exists(save_path):
+                jobs.append((record, save_path))
+    return jobs
+
+
+def render_run_debug_images(base_dir, overwrite=False, max_workers=None):
+    """Draws the debug images of every panel of a pipeline run (base_dir/images/panel*/)."""
+    jobs = []
+    for panel_dir in sorted(glob.glob(os.path.join(base_dir, "images", "panel*"))):
+        jobs += panel_debug_jobs(panel_dir, overwrite)
+    print(f"[Scoring] Rendering {len(jobs)} penalty debug images...")
+    return render_penalty_debug_images(jobs, max_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render geometric penalty debug images of a pipeline run")
+    parser.add_argument("base_dir", help="Run directory (contains images/panel*/scores.json)")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--max_workers", type=int, default=None)
+    args = parser.parse_args()
+    render_run_debug_images(args.base_dir, args.overwrite, args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
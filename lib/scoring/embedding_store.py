@@ -0,0 +1,140 @@
+import glob
+import os
+import re
+import threading
+
+import numpy as np
+
+# Content-addressed store of embedding vectors
+#
+#   <directory>/store_<D>.npy  (N,) structured array {"key": str, "embedding": (D,) float32} (mmap で読む)
+#
+# キーは呼び出し側で決める (画像なら "image:<model_id>:<画像の sha256>")。
+# 埋め込みの次元ごとに別のファイルにするので、次元の違うモデル (ViT-B/32 と ViT-L/14 など) が同じディレクトリを共有しても互いのエントリを消さない。
+# キーとベクトルを1つのファイルに入れ、一時ファイル + os.replace で丸ごと置き換えるので、
+# 途中で落ちても、複数のプロセス (デーモン・パイプライン・UI) が同時に書き込んでも、キーが別のベクトルを指すことはない。
+# 書き込み直前にディスク上の store を読み直してマージする (同時に書いた分が落ちることはあるが、次回また計算されるだけ)。
+# 書き込みはファイル全体の書き直しなので、1回のスコアリングで追加する分は add で溜めて最後に flush で1回だけ書く。
+# 1ファイルは max_entries 件までで、超えた分は古いものから捨てる (グローバルの store が際限なく大きくならないように)。
+
+STORE_PATTERN = re.compile(r"store_(\d+)\.npy")
+DEFAULT_GLOBAL_STORE = os.path.join(os.path.expanduser("~"), ".cache", "mangabubble", "clip_embeddings")
+DEFAULT_MAX_ENTRIES = 20000
+
+
+class EmbeddingStore:
+    def __init__(self, directory: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index = None
+        self._shards = {}
+        self._pending = {}
+
+    def path(self, dim: int) -> str:
+        return os.path.join(self.directory, f"store_{dim}.npy")
+
+    def _read_shard(self, dim):
+        path = self.path(dim)
+        if not os.path.isfile(path):
+            return None
+        try:
+            rows = np.load(path, mmap_mode="r")
+            if rows.dtype.names != ("key", "embedding") or rows.dtype["embedding"].shape != (dim,):
+                raise ValueError(f"unexpected dtype {rows.dtype}")
+        except (OSError, ValueError) as e:
+            print(f"[Scoring] Ignoring broken embedding store {path}: {e}")
+            return None
+        return rows
+
+    def _reindex(self):
+        self._index = {}
+        for dim, rows in self._shards.items():
+            self._index.update({key: (dim, row) for row, key in enumerate(rows["key"].tolist())})
+
+    def _load(self):
+        if self._index is not None:
+            return
+        self._shards = {}
+        for path in glob.glob(os.path.join(glob.escape(self.directory), "store_*.npy")):
+            match = STORE_PATTERN.fullmatch(os.path.basename(path))
+            if match is None:
+                continue
+            rows = self._read_shard(int(match.group(1)))
+            if rows is not None:
+                self._shards[int(match.group(1))] = rows
+        self._reindex()
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._index.keys() | self._pending.keys())
+
+    def get(self, keys) -> dict:
+        """{key: (D,) float32} for the keys that are in the store."""
+        with self._lock:
+            self._load()
+            found = {}
+            for key in keys:
+                if key in self._pending:
+                    found[key] = self._pending[key].copy()
+                elif key in self._index:
+                    dim, row = self._index[key]
+                    found[key] = np.array(self._shards[dim][row]["embedding"])
+            return found
+
+    def add(self, items: dict):
+        """Adds {key: (D,) vector} in memory; they are written by the next flush."""
+        with self._lock:
+            self._load()
+            for key, value in items.items():
+                if key not in self._index:
+                    self._pending[key] = np.asarray(value, dtype=np.float32).reshape(-1)
+
+    def flush(self):
+        """Writes the added vectors back to disk, one file write per dimension."""
+        with self._lock:
+            if not self._pending:
+                return
+            by_dim = {}
+            for key, value in self._pending.items():
+                by_dim.setdefault(value.shape[0], {})[key] = value
+            for dim, shard_items in by_dim.items():
+                self._write_shard(dim, shard_items)
+            self._pending = {}
+            self._reindex()
+
+    def put(self, items: dict):
+        """add + flush."""
+        self.add(items)
+        self.flush()
+
+    def _write_shard(self, dim, items):
+        # 他のプロセスが書き込んだ分を取り込んでから追加する
+        old = self._read_shard(dim)
+        old_keys = old["key"].tolist() if old is not None else []
+        known = set(old_keys)
+        items = {key: value for key, value in items.items() if key not in known}
+        if not items:
+            if old is not None:
+                self._shards[dim] = old
+            return
+        keys = old_keys + list(items)
+        embeddings = np.stack(list(items.values()))
+        if old is not None:
+            embeddings = np.concatenate([np.asarray(old["embedding"]), embeddings])
+        if self.max_entries and len(keys) > self.max_entries:
+            keys = keys[-self.max_entries:]
+            embeddings = embeddings[-self.max_entries:]
+        dtype = np.dtype([("key", f"U{max(len(key) for key in keys)}"), ("embedding", np.float32, (dim,))])
+        rows = np.empty(len(keys), dtype=dtype)
+        rows["key"] = keys
+        rows["embedding"] = embeddings
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(dim)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, rows)
+        os.replace(tmp_path, path)
+        self._shards[dim] = rows
@@ -0,0 +1,157 @@
+import numpy as np
+from lib.layout.layout import speaker_text_bboxes_in_reading_order, unrelated_text_bboxes
+from lib.name.font import FONTPATH, char_size, get_font
+from lib.scoring.debug import penalty_debug_data, penalty_debug_record, render_penalty_debug_images
+
+BODY_WEIGHT = 1.0
+FACE_WEIGHT = 5.0
+
+# ---   GEOMETRIC PENALTY LOGIC   ---
+
+def _get_font_metrics():
+    """Returns font object and estimated char size for bubble simulation."""
+    try:
+        # フォントと文字サイズは lib.name.font でキャッシュされる
+        char_width, char_height = char_size(FONTPATH, 20)
+        return get_font(FONTPATH, 20), char_width, char_height
+    except OSError:
+        return None, 20, 20
+
+def _simulate_dialogue_bboxes(ref_layout, dialogues):
+    """Simulate bubbles placement for characters (Speakers)."""
+    bubbles = []
+    _, char_width, char_height = _get_font_metrics()
+    vertical_margin = 2
+
+    ref_text_bboxes = speaker_text_bboxes_in_reading_order(ref_layout)
+    
+    panel_pointer = 0
+    for text_bboxes in ref_text_bboxes:
+        if panel_pointer >= len(dialogues): break
+        
+        ref_bbox = [-1, -1, -1, -1]
+        for text_bbox in text_bboxes:
+            if text_bbox[2] > ref_bbox[2]:
+                ref_bbox = text_bbox
+        
+        if ref_bbox[0] == -1:
+            panel_pointer += 1
+            continue
+
+        text_content = dialogues[panel_pointer]
+        box_height = ref_bbox[3] - ref_bbox[1]
+        chars_per_col = int(box_height / (char_height + vertical_margin))
+        if chars_per_col < 1: chars_per_col = 1
+        
+        num_cols = int(len(text_content) / chars_per_col) + 1
+        estimated_width = char_width * num_cols
+        
+        bubbles.append([ref_bbox[2] - estimated_width, ref_bbox[1], ref_bbox[2], ref_bbox[3]])
+        panel_pointer += 1
+        
+    return bubbles
+
+def _simulate_monologue_bbox(ref_layout, monologue_text):
+    """Simulates the bubble placement for the Monologue (Unrelated Text)."""
+    if not monologue_text:
+        return None
+
+    _, char_width, char_height = _get_font_metrics()
+    vertical_margin = 2
+
+    # Find the best slot for monologue
+    unrelated_bboxes = sorted(unrelated_text_bboxes(ref_layout), key=lambda x: x[2], reverse=True)
+    
+    if not unrelated_bboxes:
+        return None
+        
+    target_bbox = unrelated_bboxes[0]
+    
+    box_height = target_bbox[3] - target_bbox[1]
+    chars_per_col = int(box_height / (char_height + vertical_margin))
+    if chars_per_col < 1: chars_per_col = 1
+    
+    num_cols = int(len(monologue_text) / chars_per_col) + 1
+    estimated_width = char_width * num_cols
+    
+    # Monologues are also anchored right
+    return [target_bbox[2] - estimated_width, target_bbox[1], target_bbox[2], target_bbox[3]]
+
+def _intersection_area(boxes1, boxes2):
+    """Broadcasted intersection area of (..., 4) boxes (0 where they do not overlap or a box is NaN)."""
+    width = np.minimum(boxes1[..., 2], boxes2[..., 2]) - np.maximum(boxes1[..., 0], boxes2[..., 0])
+    height = np.minimum(boxes1[..., 3], boxes2[..., 3]) - np.maximum(boxes1[..., 1], boxes2[..., 1])
+    return np.nan_to_num(np.clip(width, 0, None) * np.clip(height, 0, None))
+
+def simulate_bubbles(ref_layout, panel_data):
+    """Simulated dialogue bubbles (and the monologue box, last) of panel_data placed on ref_layout."""
+    # 1. Extract Texts
+    dialogues = [ele["content"] for ele in panel_data if ele["type"] == "dialogue"]
+    monologues = [ele["content"] for ele in panel_data if ele["type"] == "monologue"]
+    total_monologue = "".join(monologues)
+
+    # 2. Simulate All Bubbles
+    bubbles = _simulate_dialogue_bboxes(ref_layout, dialogues)
+    mono_bbox = _simulate_monologue_bbox(ref_layout, total_monologue)
+    if mono_bbox:
+        bubbles.append(mono_bbox) # Add monologue to the check list
+    return bubbles
+
+def calculate_geometric_penalties(ref_layouts, panel_data, people_result, bbox_save_paths=None, return_debug=False):
+    """
+    calculate_geometric_penalty for several reference layouts against the same OpenPose result.
+    Person boxes are extracted once and all bubbles of all references are checked in one broadcast.
+    Args:
+        ref_layouts: K MangaLayout/ArrayLayout templates.
+        bbox_save_paths: K debug image paths (or None). Drawn immediately; prefer return_debug and
+            lib.scoring.debug to draw them later.
+        return_debug: also return the debug geometry of all K references (lib.scoring.debug.penalty_debug_data,
+            None when there is nothing to draw)
+    Returns:
+        list of K penalties (, debug geometry)
+    """
+    penalties = np.zeros(len(ref_layouts))
+    if not people_result or not people_result.people:
+        return (penalties.tolist(), None) if return_debug else penalties.tolist()
+
+    bubbles = [simulate_bubbles(ref_layout, panel_data) if ref_layout else [] for ref_layout in ref_layouts]
+    max_bubbles = max((len(b) for b in bubbles), default=0)
+    if max_bubbles > 0:
+        # (K, B, 4), 足りない分は面積 0 の bbox で埋める
+        bubble_boxes = np.zeros((len(ref_layouts), max_bubbles, 4), dtype=np.float64)
+        for k, b in enumerate(bubbles):
+            if b:
+                bubble_boxes[k, :len(b)] = b
+        areas = (bubble_boxes[..., 2] - bubble_boxes[..., 0]) * (bubble_boxes[..., 3] - bubble_boxes[..., 1])
+
+        body_boxes, face_boxes = people_result.person_boxes()
+        # Body Overlap (Weight: 1.0) + Face Overlap (Weight: 5.0), (K, B, P) -> (K, B)
+        overlap = (
+            _intersection_area(bubble_boxes[:, :, None, :], body_boxes[None, None]).sum(axis=-1) * BODY_WEIGHT
+            + _intersection_area(bubble_boxes[:, :, None, :], face_boxes[None, None]).sum(axis=-1) * FACE_WEIGHT
+        )
+        valid = areas > 0
+        penalties = np.where(valid, overlap / np.where(valid, areas, 1) * 100, 0).sum(axis=-1)
+
+    penalties = penalties.tolist()
+    debug = None
+    if return_debug or bbox_save_paths:
+        debug = penalty_debug_data(
+            people_result, [b if ref_layout else None for b, ref_layout in zip(bubbles, ref_layouts)], penalties
+        )
+    if bbox_save_paths:
+        render_penalty_debug_images(
+            [(penalty_debug_record(debug, k), path) for k, path in enumerate(bbox_save_paths) if path and ref_layouts[k]],
+            max_workers=1,
+        )
+    return (penalties, debug) if return_debug else penalties
+
+def calculate_geometric_penalty(ref_layout, panel_data, people_result, bbox_save_path=None):
+    """
+    Calculates penalty for both Dialogues and Monologues overlapping faces/bodies.
+    Args:
+        ref_layout: The MangaLayout template.
+        panel_data: The list of dictionaries (the raw panel content).
+        people_result: OpenPose result.
+    """
+    return calculate_geometric_penalties([ref_layout], panel_data, people_result, [bbox_save_path])[0]
@@ -4,6 +4,7 @@ import json
 from tqdm import tqdm
 from collections import defaultdict
 from typing import Dict, List, Tuple, Any
+from lib.layout.database import compile_database, compiled_path
 
 def _analyze_metadata(manga_path: str, metadata: dict):
     image_path = os.path.join(manga_path, f"{metadata['id']}.png")
@@ -56,32 +57,53 @@ def _analyze_metadata(manga_path: str, metadata: dict):
 
 
 
-def main():
-    DATASET_PATH = "./curated_dataset"
-    
-    result = {}
-    for manga_dir in tqdm(os.listdir(DATASET_PATH), desc="Processing manga directories"):
-        manga_path = os.path.join(DATASET_PATH, manga_dir)
-        if not os.path.isdir(manga_path):
-            continue
-            
-        annotation_file = os.path.join(manga_path, 'annotation.json')
-        with open(annotation_file, 'r', encoding='utf-8') as f:
-            metadatum = json.load(f)
-        
-        for metadata in metadatum:
-            num_speakers, num_non_speakers, content = _analyze_metadata(manga_path, metadata)
-            key = f"{num_speakers}_{num_non_speakers}"
-            if key not in result:
-                result[key] = []
-            result[key].append(content)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the layout database from the curated dataset")
+    parser.add_argument("--dataset_path", default="./curated_dataset")
+    parser.add_argument("--compile-only", dest="compile_only", action="store_true",
+                        help="Skip curation and only compile an existing database.json")
+    return parser.parse_args()
 
+def main():
+    args = parse_args()
+    DATASET_PATH = args.dataset_path
     output_path = os.path.join(DATASET_PATH, "database.json")
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, indent=4, ensure_ascii=False)
-    
-    print(f"Database saved to {output_path}")
-    
+
+    if args.compile_only:
+        with open(output_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+    else:
+        result = {}
+        # コンパイル済み DB (database/) などの出力も DATASET_PATH に置かれるので、漫画のディレクトリだけを読む
+        skip_dirs = {os.path.abspath(compiled_path(output_path))}
+        for manga_dir in tqdm(os.listdir(DATASET_PATH), desc="Processing manga directories"):
+            manga_path = os.path.join(DATASET_PATH, manga_dir)
+            if not os.path.isdir(manga_path) or os.path.abspath(manga_path) in skip_dirs:
+                continue
+
+            annotation_file = os.path.join(manga_path, 'annotation.json')
+            if not os.path.isfile(annotation_file):
+                continue
+            with open(annotation_file, 'r', encoding='utf-8') as f:
+                metadatum = json.load(f)
+
+            for metadata in metadatum:
+                num_speakers, num_non_speakers, content = _analyze_metadata(manga_path, metadata)
+                key = f"{num_speakers}_{num_non_speakers}"
+                if key not in result:
+                    result[key] = []
+                result[key].append(content)
+
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+
+        print(f"Database saved to {output_path}")
+
+    # Compiled (memory-mappable) database used by lib.layout.layout.from_condition
+    compiled_dir = compiled_path(output_path)
+    compile_database(result, compiled_dir, source_path=output_path)
+    print(f"Compiled database saved to {compiled_dir}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from datetime import datetime
 import json
@@ -8,13 +9,17 @@ from dotenv import load_dotenv
 #from openai import OpenAI
 from lib.llm.geminiadapter import GeminiClient
 from lib.layout.layout import generate_layout, similar_layouts
+from lib.layout.cache import DEFAULT_CACHE_DIR, QueryCache
 from lib.script.divide import divide_script, ele2panels, refine_elements
 from lib.script.analyze import analyze_storyboard
-from lib.image.image import generate_image_prompts, enhance_prompts, generate_image_with_sd
-from lib.image.controlnet import check_open, controlnet2bboxes, run_controlnet_openpose
+from lib.image.image import generate_image_prompts, enhance_prompts, generate_image_with_sd, generate_images_with_sd
+from lib.image.controlnet import check_open, controlnet2bboxes, run_controlnet_openpose, run_controlnet_openpose_batch
+from lib.image.pose_cache import PoseCache
 from lib.image.resolution import get_optimal_resolution
-from lib.name.name import generate_name, generate_animepose_image
-from lib.scoring.scorer import calculate_geometric_penalty, run_panel_scoring
+from lib.image.sd_client import SDPool, create_client, set_client
+from lib.name.name import generate_name, generate_animepose_image, load_base_image
+from lib.scoring.scorer import calculate_geometric_penalties, run_panel_scoring
+from lib.scoring.debug import render_run_debug_images
 from lib.page.layout_generator import CaoInitialLayout
 from lib.page.layout_optimizer import LayoutOptimizer
 from lib.page.composite_page import PageCompositor
@@ -27,6 +32,15 @@ def parse_args():
     parser.add_argument("--resume_latest", action="store_true", help="Debug mode")
     parser.add_argument("--num_images", type=int, default=3)
     parser.add_argument("--num_names", type=int, default=5)
+    parser.add_argument("--render_debug", action="store_true", help="Render the geometric penalty debug images (*_bbox.png) after scoring")
+    parser.add_argument("--layout_cache_dir", default=DEFAULT_CACHE_DIR, help="Cache of similar layout search results ('' to disable)")
+    parser.add_argument("--openpose_detect", choices=["both", "once"], default="both", help="'both': detect the SD image and its line art in one request, 'once': reuse the SD image's poses for the penalty")
+    parser.add_argument("--openpose_cache_dir", default=None, help="Cache OpenPose results on disk, keyed by image content (default: no cache)")
+    parser.add_argument("--txt2img_batch_size", type=int, default=None, help="Variations generated per txt2img request (default: all --num_images at once)")
+    parser.add_argument("--sd_urls", default=None, help="Comma separated Stable Diffusion WebUI URLs (default: SD_WEBUI_URLS or SD_WEBUI_URL)")
+    parser.add_argument("--max_in_flight", type=int, default=1, help="Stable Diffusion requests sent at once per WebUI")
+    parser.add_argument("--panel_workers", type=int, default=None, help="Panels processed in parallel (default: 1, or total max_in_flight + 1 when more than one SD request can be in flight)")
+    parser.add_argument("--save_name_composite", action="store_true", help="Also save each name next to its reference layout image (*_name_<k>.png)")
     args = parser.parse_args()
     return args
 
@@ -55,14 +69,151 @@ def get_best_image_path(panel_dir):
         print(f"Error reading scores for {panel_dir}: {e}")
         return os.path.join(panel_dir, "00_anime.png")
 
+def generate_panel(args, i, prompt, panel, panel_dir, sd_w, sd_h, layout_cache=None, pose_cache=None):
+    """
+    Images, layouts and names of every variation of panel i, saved in panel_dir/scores.json.
+    Panels may run in parallel (run_panels), so everything a panel writes stays in its own panel_dir
+    and every log line starts with the panel id.
+    """
+    panel_entry = {
+        "panel_index": i,
+        "panel_dir": panel_dir,
+        "prompt": prompt, 
+        "width":sd_w,
+        "height":sd_h,
+        "variations": []
+    }
+
+
+    # 全バリエーションの画像を batch_size 枚ずつまとめて生成し、各画像の seed を記録する
+    image_paths = [os.path.join(panel_dir, f"{j:02d}.png") for j in range(args.num_images)]
+    seeds = [None] * args.num_images
+    batch_size = args.txt2img_batch_size or args.num_images
+    for start in range(0, args.num_images, batch_size):
+        print(f"  > Panel {i}: generating images {start}-{min(start + batch_size, args.num_images) - 1}...")
+        seeds[start:start + batch_size] = generate_images_with_sd(prompt, image_paths[start:start + batch_size], width=sd_w, height=sd_h)
+
+    for j in range(args.num_images):
+
+        max_retries = 3  
+        layout = None
+        openpose_result = None
+
+        for attempt in range(max_retries):
+            image_path = image_paths[j]
+            # 1回目はバッチで生成した画像を使い、レイアウトが作れなかったときだけ作り直す
+            if attempt > 0 or not os.path.exists(image_path):
+                print(f"  > Panel {i}: generating image {j} (Attempt {attempt+1}/{max_retries})...")
+                # generate_image(client, prompt, image_path)
+                seeds[j] = generate_image_with_sd(prompt, image_path, width=sd_w, height=sd_h)
+            if not os.path.exists(image_path):
+                continue
+            anime_image_path = os.path.join(panel_dir, f"{j:02d}_anime.png")
+            anime_seed = generate_animepose_image(image_path, prompt, anime_image_path, width=sd_w, height=sd_h)
+            if args.openpose_detect == "once":
+                # 線画は元画像のポーズから生成しているので、元画像の検出結果をペナルティにも使う
+                openpose_result = run_controlnet_openpose(image_path, anime_image_path, cache=pose_cache)
+                openpose_result2 = openpose_result
+            else:
+                openpose_result, openpose_result2 = run_controlnet_openpose_batch(
+                    [image_path, anime_image_path], [anime_image_path, None], cache=pose_cache
+                )
+            width, height = openpose_result.canvas_width, openpose_result.canvas_height
+            bboxes = controlnet2bboxes(openpose_result)
+            layout = generate_layout(bboxes, panel, sd_w, sd_h)
+            if layout is not None:
+                break # found a valid layout
+            else:
+                print(f"    ! Panel {i}: invalid layout detected, retrying...")
+        if layout is None:
+            print(f"    ! Panel {i}: failed to generate a valid layout after {max_retries} attempts. Skipping image {j}.")
+            continue
+
+
+        scored_layouts = similar_layouts(layout, top_k=args.num_names, cache=layout_cache)
+        layout_options = []
+        top_layouts = scored_layouts[:args.num_names]
+        # 全参照レイアウトの幾何ペナルティをまとめて計算 (デバッグ画像は描かずに幾何情報だけ残す)
+        geom_penalties, penalty_debug = calculate_geometric_penalties(
+            [scored_layout[0] for scored_layout in top_layouts],
+            panel,
+            openpose_result2,
+            return_debug=True,
+        )
+        # 元画像のデコードとリサイズはバリエーションごとに1回
+        base_image = load_base_image(openpose_result)
+        for idx_ref_layout, scored_layout in enumerate(top_layouts):
+            print(f"  > Panel {i}: {scored_layout[0].image_path}")
+            save_path = os.path.join(
+                panel_dir, f"{j:02d}_name_{idx_ref_layout:1d}.png"
+            )
+            ref_layout = scored_layout[0] 
+            sim_score = scored_layout[1]
+            geom_penalty = geom_penalties[idx_ref_layout]
+
+
+            generate_name(
+                openpose_result, layout, scored_layout, panel, save_path,
+                base_image=base_image, save_composite=args.save_name_composite,
+            )
+
+            layout_options.append({
+                    "rank": idx_ref_layout,
+                    "template_path": ref_layout.image_path,
+                    "generated_image_path": save_path, 
+                    "sim_score": sim_score,
+                    "geom_penalty": geom_penalty,
+                })
+
+        panel_entry["variations"].append({
+                "variation_id": j,
+                "image_path": image_path,        
+                "anime_image_path": anime_image_path,
+                "seed": seeds[j],
+                "anime_seed": anime_seed,
+                # 人物の幾何情報は全参照レイアウトで共通なので1回だけ (layout_options の rank で引く)
+                "penalty_debug": penalty_debug,
+                "layout_options": layout_options 
+            })
+        score_file_path = os.path.join(panel_dir, "scores.json")
+        with open(score_file_path, "w", encoding="utf-8") as f:
+            json.dump(panel_entry, f, indent=4, default=str)
+    return panel_entry
+
+
+def panel_workers(requested, max_in_flight):
+    """Panels processed at once: as requested, else sequential unless more than one SD request can be in flight."""
+    if requested:
+        return requested
+    if max_in_flight and max_in_flight > 1:
+        return max_in_flight + 1
+    return 1
+
+
+def run_panels(jobs, max_workers):
+    """Runs generate_panel(*job) for every job, max_workers panels at a time."""
+    if max_workers <= 1:
+        for job in tqdm(jobs, desc="Generating names"):
+            generate_panel(*job)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(generate_panel, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating names"):
+            future.result()
+
+
 def main():
     args = parse_args()
-    NUM_REFERENCES = args.num_names
+    layout_cache = QueryCache(args.layout_cache_dir) if args.layout_cache_dir else None
+    # 新しく生成した画像はほぼ毎回ヒットしないので、メモリだけのキャッシュは作らない
+    pose_cache = PoseCache(args.openpose_cache_dir) if args.openpose_cache_dir else None
     resume_latest = args.resume_latest
     load_dotenv()
     api_key = os.getenv("API_KEY") 
     if not api_key:
         raise ValueError("API_KEY is not set")
+    sd_client = create_client(args.sd_urls.split(",") if args.sd_urls else None, args.max_in_flight)
+    set_client(sd_client)
     if not check_open():
         raise ValueError("ControlNet is not running")
     if resume_latest:
@@ -146,99 +297,23 @@ def main():
             safe_w, safe_h = get_optimal_resolution(w_raw, h_raw)
             panel_resolutions[p['panel_index']] = (safe_w, safe_h)
 
-    num_images = args.num_images
-    for i, prompt in tqdm(enumerate(prompts), desc="Generating names"):
+    # SD へのリクエストを複数同時に送れるときはパネル単位で並列に生成し、その間に他のパネルの
+    # レイアウト検索・ネーム生成・ペナルティ計算を進める。既定 (1件) では従来どおり順番に生成する
+    jobs = []
+    for i, prompt in enumerate(prompts):
         panel_dir = os.path.join(image_base_dir, f"panel{i:03d}")
         os.makedirs(panel_dir, exist_ok=True)
-        
-        sd_w, sd_h = panel_resolutions.get(i, (512, 512)) 
+        sd_w, sd_h = panel_resolutions.get(i, (512, 512))
         print(f"  > Panel {i} Target Size: {sd_w}x{sd_h}")
+        jobs.append((args, i, prompt, panels[i], panel_dir, sd_w, sd_h, layout_cache, pose_cache))
+    run_panels(jobs, panel_workers(args.panel_workers, sd_client.max_in_flight))
+    if isinstance(sd_client, SDPool):
+        print(sd_client.format_stats())
 
-        panel_entry = {
-            "panel_index": i,
-            "panel_dir": panel_dir,
-            "prompt": prompt, 
-            "width":sd_w,
-            "height":sd_h,
-            "variations": []
-        }
-        
-
-        for j in range(num_images):
-
-            max_retries = 3  
-            layout = None
-            openpose_result = None
-
-            for attempt in range(max_retries):
-                print(f"  > Generating image {j} (Attempt {attempt+1}/{max_retries})...")
-                image_path = os.path.join(panel_dir, f"{j:02d}.png")
-                # generate_image(client, prompt, image_path)
-                generate_image_with_sd(prompt, image_path, width=sd_w, height=sd_h)
-                if not os.path.exists(image_path):
-                    continue
-                anime_image_path = os.path.join(panel_dir, f"{j:02d}_anime.png")
-                generate_animepose_image(image_path, prompt, anime_image_path, width=sd_w, height=sd_h)
-                openpose_result = run_controlnet_openpose(image_path, anime_image_path)
-                openpose_result2 = run_controlnet_openpose(anime_image_path)
-                width, height = openpose_result.canvas_width, openpose_result.canvas_height
-                bboxes = controlnet2bboxes(openpose_result)
-                layout = generate_layout(bboxes, panels[i], sd_w, sd_h)
-                if layout is not None:
-                    break # found a valid layout
-                else:
-                    print("    ! Invalid layout detected, retrying...")
-            if layout is None:
-                print(f"    ! Failed to generate a valid layout after {max_retries} attempts. Skipping this image.")
-                continue
-            
-    
-            scored_layouts = similar_layouts(layout)
-            layout_options = []
-            for idx_ref_layout, scored_layout in enumerate(
-                scored_layouts[:NUM_REFERENCES]
-            ):
-                print(scored_layout[0].image_path)
-                save_path = os.path.join(
-                    panel_dir, f"{j:02d}_name_{idx_ref_layout:1d}.png"
-                )
-                ref_layout = scored_layout[0] 
-                sim_score = scored_layout[1]
-                geom_penalty = calculate_geometric_penalty(
-                        ref_layout, 
-                        panels[i], 
-                        openpose_result2,
-                        os.path.join(
-                    panel_dir, f"{j:02d}_name_{idx_ref_layout:1d}_bbox.png"
-                )
-                    )
-
-
-                generate_name(
-                    openpose_result, layout, scored_layout, panels[i], save_path
-                )
-
-                layout_options.append({
-                        "rank": idx_ref_layout,
-                        "template_path": ref_layout.image_path,
-                        "generated_image_path": save_path, 
-                        "sim_score": sim_score,
-                        "geom_penalty": geom_penalty,
-                    })
-                
-            panel_entry["variations"].append({
-                    "variation_id": j,
-                    "image_path": image_path,        
-                    "anime_image_path": anime_image_path,
-                    "layout_options": layout_options 
-                })
-            score_file_path = os.path.join(panel_dir, "scores.json")
-            with open(score_file_path, "w", encoding="utf-8") as f:
-                json.dump(panel_entry, f, indent=4, default=str)
-
-    
     # ---   SCORING PART --- 
     run_panel_scoring(base_dir, prompts)
+    if args.render_debug:
+        render_run_debug_images(base_dir)
 
     # ---   PAGE ASSEMBLY & PDF GENERATION  ---
     print("Assembling Final Pages...")
@@ -0,0 +1,283 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class _Batch(dict):
+    def to(self, device):
+        return _Batch({k: v.to(device) for k, v in self.items()})
+
+
+class _Tokenizer:
+    bos_token_id = 1
+    eos_token_id = 2
+    pad_token_id = 0
+
+
+class _Processor:
+    """Minimal CLIPProcessor: 1文字 = 1トークン、画像は 8x8 に縮小した画素値"""
+    tokenizer = _Tokenizer()
+
+    def __call__(self, text=None, images=None, return_tensors="pt", **kwargs):
+        if text is not None:
+            ids = [[1] + [3 + ord(c) % 60 for c in t] + [2] for t in text]
+            return _Batch(input_ids=torch.tensor(ids))
+        pixels = [torch.from_numpy(np.asarray(image.resize((8, 8)), dtype=np.float32)).permute(2, 0, 1) / 255 for image in images]
+        return _Batch(pixel_values=torch.stack(pixels))
+
+
+class _Model(torch.nn.Module):
+    """text: マスクされていないトークンの埋め込みの平均、image: 線形変換"""
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.token_embedding = torch.randn(64, 16, generator=generator)
+        self.image_projection = torch.nn.Linear(8 * 8 * 3, 16, bias=False)
+        with torch.no_grad():
+            self.image_projection.weight.copy_(torch.randn(16, 8 * 8 * 3, generator=generator))
+
+    def get_text_features(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        mask = attention_mask.unsqueeze(-1).float()
+        return (self.token_embedding[input_ids] * mask).sum(dim=1) / mask.sum(dim=1)
+
+    def get_image_features(self, pixel_values):
+        return self.image_projection(pixel_values.flatten(1))
+
+
+def _make_images(tmp_path, n):
+    paths = []
+    for k in range(n):
+        path = str(tmp_path / f"{k}.png")
+        Image.effect_noise((32, 32), 20 + k * 10).convert("RGB").save(path)
+        paths.append(path)
+    return paths
+
+
+def test_batched_encoders_match_single_item(tmp_path):
+    from lib.scoring.clip import clip_scores, encode_images, encode_prompts
+
+    model, processor = _Model(), _Processor()
+    paths = _make_images(tmp_path, 5) + [str(tmp_path / "missing.png")]
+    # 75 トークンを超えるプロンプトはチャンクに分かれ、チャンクごとに長さが違う
+    prompts = ["a girl", "a boy running in the rain, " * 6, "x" * 150]
+
+    images = encode_images(paths, model, processor, "cpu", batch_size=2)
+    texts = encode_prompts(prompts, model, processor, "cpu", batch_size=3)
+    assert images[-1] is None
+    for path, embed in zip(paths[:-1], images):
+        assert torch.allclose(embed, encode_images([path], model, processor, "cpu")[0], atol=1e-5)
+    for prompt, embed in zip(prompts, texts):
+        assert torch.allclose(embed, encode_prompts([prompt], model, processor, "cpu")[0], atol=1e-5)
+
+    pairs = [(i, t) for i in range(len(paths)) for t in range(len(prompts))]
+    scores = clip_scores(images, texts, pairs)
+    for (i, t), score in zip(pairs, scores):
+        expected = 0.0 if images[i] is None else float(images[i] @ texts[t])
+        assert abs(score - expected) < 1e-5
+
+
+def test_image_embedding_store(tmp_path):
+    import shutil
+    from lib.scoring.clip import encode_images, encode_images_cached
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    model, processor = _Model(), _Processor()
+    paths = _make_images(tmp_path, 4)
+    # 内容が同じ画像は同じキーになる
+    shutil.copy(paths[0], str(tmp_path / "copy.png"))
+    paths.append(str(tmp_path / "copy.png"))
+
+    encoded = []
+    original = model.get_image_features
+    model.get_image_features = lambda **inputs: encoded.append(len(inputs["pixel_values"])) or original(**inputs)
+
+    run_store = EmbeddingStore(str(tmp_path / "run"))
+    global_store = EmbeddingStore(str(tmp_path / "global"))
+    first = encode_images_cached(paths, model, processor, "cpu", "fake-clip", [run_store, global_store], batch_size=2)
+    assert sum(encoded) == 4
+    expected = encode_images(paths, model, processor, "cpu")
+    for embed, ref in zip(first, expected):
+        assert torch.allclose(embed, ref, atol=1e-6)
+
+    # 新しいプロセス相当: ディスクから読み、エンコードはしない
+    encoded.clear()
+    again = encode_images_cached(paths, model, processor, "cpu", "fake-clip", [EmbeddingStore(str(tmp_path / "run"))])
+    assert encoded == []
+    assert all(torch.equal(a, b) for a, b in zip(first, again))
+
+    # 別の run ではグローバルの store から読み、run の store にもコピーする
+    new_run = EmbeddingStore(str(tmp_path / "run2"))
+    encode_images_cached(paths, model, processor, "cpu", "fake-clip", [new_run, EmbeddingStore(str(tmp_path / "global"))])
+    assert encoded == [] and len(EmbeddingStore(str(tmp_path / "run2"))) == 4
+
+    # モデルが違えば別のキー
+    encode_images_cached(paths[:1], model, processor, "cpu", "other-clip", [run_store])
+    assert encoded == [1]
+
+
+def test_embedding_store_concurrent_writers(tmp_path):
+    import numpy as np
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    # 同じディレクトリを別々に開いた2つの writer (デーモンとパイプライン相当)
+    directory = str(tmp_path / "store")
+    first, second = EmbeddingStore(directory), EmbeddingStore(directory)
+    assert len(first) == 0 and len(second) == 0
+    first.put({"a": np.full(3, 1.0), "b": np.full(3, 2.0)})
+    second.put({"c": np.full(3, 3.0)})
+    first.put({"d": np.full(3, 4.0)})
+
+    stored = EmbeddingStore(directory).get(["a", "b", "c", "d"])
+    assert {key: float(value[0]) for key, value in stored.items()} == {"a": 1.0, "b": 2.0, "c": 3.0, "d": 4.0}
+    assert os.listdir(directory) == ["store_3.npy"]
+
+
+def test_embedding_store_keeps_other_dimensions(tmp_path):
+    import numpy as np
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    # 次元の違う2つのモデル (ViT-B/32 の後に ViT-L/14 など) が同じディレクトリを使う
+    directory = str(tmp_path / "store")
+    EmbeddingStore(directory).put({"image:small:a": np.full(3, 1.0), "image:small:b": np.full(3, 2.0)})
+    EmbeddingStore(directory).put({"image:large:a": np.full(5, 3.0)})
+    store = EmbeddingStore(directory)
+    store.put({"image:small:c": np.full(3, 4.0)})
+
+    stored = EmbeddingStore(directory).get(["image:small:a", "image:small:b", "image:small:c", "image:large:a"])
+    assert {key: value.shape[0] for key, value in stored.items()} == {
+        "image:small:a": 3, "image:small:b": 3, "image:small:c": 3, "image:large:a": 5,
+    }
+    assert float(stored["image:large:a"][0]) == 3.0
+    assert sorted(os.listdir(directory)) == ["store_3.npy", "store_5.npy"]
+
+
+def test_clip_scores_write_each_store_once(tmp_path):
+    from lib.scoring import embedding_store
+    from lib.scoring.clip import calculate_clip_scores, clear_text_embeddings
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    clear_text_embeddings()
+    model, processor = _Model(), _Processor()
+    paths = _make_images(tmp_path, 3)
+    run_store, global_store = EmbeddingStore(str(tmp_path / "run")), EmbeddingStore(str(tmp_path / "global"))
+    # グローバルにだけある埋め込みは run の store にコピーされる
+    calculate_clip_scores([(paths[0], "a")], model, processor, "cpu", model_id="fake-clip", stores=[global_store])
+
+    clear_text_embeddings()
+
+    writes = []
+    original = embedding_store.os.replace
+    embedding_store.os.replace = lambda src, dst: writes.append(os.path.basename(os.path.dirname(dst))) or original(src, dst)
+    try:
+        pairs = [(path, prompt) for path in paths for prompt in ("a", "b")]
+        calculate_clip_scores(pairs, model, processor, "cpu", model_id="fake-clip", stores=[run_store, global_store])
+    finally:
+        embedding_store.os.replace = original
+    # 画像とプロンプトの追加をまとめて store ごとに1回だけ書く
+    assert sorted(writes) == ["global", "run"]
+    assert len(EmbeddingStore(str(tmp_path / "run"))) == 5
+    assert len(EmbeddingStore(str(tmp_path / "global"))) == 5
+
+
+def test_embedding_store_max_entries(tmp_path):
+    import numpy as np
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    directory = str(tmp_path / "store")
+    EmbeddingStore(directory, max_entries=3).put({key: np.full(2, float(k)) for k, key in enumerate("abcd")})
+    EmbeddingStore(directory, max_entries=3).put({"e": np.full(2, 4.0)})
+    # 古いものから捨てる
+    assert sorted(EmbeddingStore(directory).get("abcde")) == ["c", "d", "e"]
+
+
+def test_prompt_embeddings_are_memoized(tmp_path):
+    from lib.scoring.clip import clear_text_embeddings, encode_prompts, encode_prompts_cached
+    from lib.scoring.embedding_store import EmbeddingStore
+
+    model, processor = _Model(), _Processor()
+    prompts = ["a girl", "a boy running in the rain, " * 6, "a girl"]
+    expected = encode_prompts(prompts, model, processor, "cpu")
+
+    calls = []
+    original = model.get_text_features
+    model.get_text_features = lambda **inputs: calls.append(len(inputs["input_ids"])) or original(**inputs)
+
+    clear_text_embeddings()
+    store = str(tmp_path / "store")
+    first = encode_prompts_cached(prompts, model, processor, "cpu", "fake-clip", [EmbeddingStore(store)])
+    # 同じプロンプトは1回だけ (2つ目のプロンプトは 3 チャンク)
+    assert sum(calls) == 4
+    for embed, ref in zip(first, expected):
+        assert torch.allclose(embed, ref, atol=1e-6)
+
+    calls.clear()
+    encode_prompts_cached(prompts, model, processor, "cpu", "fake-clip")
+    assert calls == []
+
+    # メモリのメモがなくてもディスクから読む
+    clear_text_embeddings()
+    again = encode_prompts_cached(prompts, model, processor, "cpu", "fake-clip", [EmbeddingStore(store)])
+    assert calls == []
+    assert all(torch.equal(a, b) for a, b in zip(first, again))
+    clear_text_embeddings()
+
+
+def test_cpu_backends(tmp_path):
+    from lib.scoring.clip import TorchScriptCLIP, backend_id, encode_images, encode_prompts, export_torchscript, quantize_dynamic
+
+    model, processor = _Model(), _Processor()
+    paths = _make_images(tmp_path, 3)
+    prompts = ["a girl", "a boy running in the rain, " * 6]
+    images = encode_images(paths, model, processor, "cpu")
+    texts = encode_prompts(prompts, model, processor, "cpu")
+
+    export_torchscript(model, processor, str(tmp_path / "ts"), image_size=8)
+    scripted = TorchScriptCLIP(str(tmp_path / "ts"))
+    for a, b in zip(encode_images(paths, scripted, processor, "cpu"), images):
+        assert torch.allclose(a, b, atol=1e-5)
+    # トレース時と長さの違うチャンクも扱える
+    for a, b in zip(encode_prompts(prompts, scripted, processor, "cpu"), texts):
+        assert torch.allclose(a, b, atol=1e-5)
+
+    quantized = quantize_dynamic(model)
+    assert isinstance(quantized.image_projection, torch.ao.nn.quantized.dynamic.Linear)
+    for a, b in zip(encode_images(paths, quantized, processor, "cpu"), images):
+        assert float(a @ b) > 0.99
+
+    assert backend_id("clip", "fp32") == "clip"
+    assert backend_id("clip", "int8") != backend_id("clip", "torchscript")
+
+
+def test_scoring_daemon(tmp_path):
+    import threading
+    from lib.scoring.clip import calculate_clip_scores, clear_text_embeddings
+    from lib.scoring.daemon import ScoringServer, score_with_daemon
+
+    model, processor = _Model(), _Processor()
+    paths = _make_images(tmp_path, 3)
+    pairs = [(path, prompt) for path in paths for prompt in ["a girl", "a boy"]]
+    expected = calculate_clip_scores(pairs, model, processor, "cpu", model_id="fake-clip")
+
+    server = ScoringServer(("127.0.0.1", 0), model, processor, "cpu", "fake-clip", "fp32")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        store = str(tmp_path / "store")
+        scores = score_with_daemon(pairs, "fake-clip", "fp32", [store], url=url)
+        assert scores is not None
+        assert all(abs(a - b) < 1e-6 for a, b in zip(scores, expected))
+        # 埋め込みはデーモン側で store に書かれる
+        assert any(name.startswith("store_") for name in os.listdir(store))
+
+        # 別のモデル/バックエンドを要求されたら使わない (呼び出し側で CLIP を読み込む)
+        assert score_with_daemon(pairs, "fake-clip", "int8", url=url) is None
+    finally:
+        server.shutdown()
+        server.server_close()
+        clear_text_embeddings()
+    assert score_with_daemon(pairs, "fake-clip", "fp32", url=url) is None
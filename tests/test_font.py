@@ -0,0 +1,104 @@
+import os
+
+import matplotlib
+from PIL import Image, ImageFont
+
+DEJAVU = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans.ttf")
+
+
+def test_fonts_are_loaded_once(monkeypatch):
+    from lib.name import font as font_cache
+    from lib.name import name
+    from lib.scoring import geometry
+
+    font_cache.clear_cache()
+    loads = []
+    truetype = ImageFont.truetype
+    monkeypatch.setattr(ImageFont, "truetype", lambda path, size: loads.append((path, size)) or truetype(path, size))
+    monkeypatch.setattr(name, "FONTPATH", DEJAVU)
+    monkeypatch.setattr(geometry, "FONTPATH", DEJAVU)
+
+    image = Image.new("RGB", (300, 300), "white")
+    for _ in range(3):
+        name.draw_vertical_text(image, "abcdefg", [100, 20, 200, 280], "dialogue")
+        _, char_width, char_height = geometry._get_font_metrics()
+    assert loads == [(DEJAVU, 20)]
+
+    char_bbox = truetype(DEJAVU, 20).getbbox("あ")
+    assert (char_width, char_height) == (char_bbox[2] - char_bbox[0], char_bbox[3] - char_bbox[1])
+    assert font_cache.get_font(DEJAVU, 20) is font_cache.get_font(DEJAVU, 20)
+    assert font_cache.get_font(DEJAVU, 12) is not font_cache.get_font(DEJAVU, 20)
+    font_cache.clear_cache()
+
+
+def test_glyph_atlas_matches_draw_text(monkeypatch):
+    import random
+
+    from PIL import ImageDraw
+
+    from lib.name import font as font_cache
+    from lib.name import name
+
+    font_cache.clear_cache()
+    atlas = font_cache.get_atlas(DEJAVU, 20)
+    font = font_cache.get_font(DEJAVU, 20)
+    rng = random.Random(0)
+    for mode in ["RGB", "L", "RGBA"]:
+        expected = Image.effect_noise((160, 160), 60).convert(mode)
+        actual = expected.copy()
+        draw = ImageDraw.Draw(expected)
+        for k in range(200):
+            char = rng.choice("agjQ ,.!あ")
+            xy = (rng.randint(-10, 160), rng.randint(-10, 160))
+            if k % 3 == 0:
+                xy = (xy[0] + rng.random(), xy[1] - rng.random())
+            draw.text(xy, char, font=font, fill="black")
+            atlas.draw(actual, xy, char, fill="black")
+        assert actual.tobytes() == expected.tobytes()
+    # 同じグリフは一度だけラスタライズする
+    assert atlas.glyph("a") is atlas.glyph("a")
+
+    monkeypatch.setattr(name, "FONTPATH", DEJAVU)
+    for kind in ["dialogue", "monologue", "narration"]:
+        images = [Image.new("RGB", (300, 300), "white") for _ in range(2)]
+        name.draw_vertical_text(images[0], "The quick brown fox jumps over the lazy dog" * 2, [120, 20, 260, 280], kind)
+        name.draw_vertical_text(images[1], "The quick brown fox jumps over the lazy dog" * 2, [120, 20, 260, 280], kind, use_atlas=False)
+        assert images[0].tobytes() == images[1].tobytes()
+    font_cache.clear_cache()
+
+
+def test_generate_name_reuses_base_and_template(tmp_path, monkeypatch):
+    from lib.layout.layout import MangaLayout, Speaker
+    from lib.name import font as font_cache
+    from lib.name import name
+
+    class _Result:
+        canvas_width, canvas_height = 200, 300
+        base_image_path = str(tmp_path / "base.png")
+
+    Image.effect_noise((100, 150), 40).convert("RGB").save(_Result.base_image_path)
+    template_path = str(tmp_path / "template.png")
+    Image.new("RGB", (400, 600), "gray").save(template_path)
+    monkeypatch.setattr(name, "FONTPATH", DEJAVU)
+    name.load_template_image.cache_clear()
+
+    ref = MangaLayout(template_path, 400, 600, [Speaker([0, 0, 100, 100], 5, [{"bbox": [100, 20, 180, 280]}])], 0, [])
+    query = MangaLayout("", 200, 300, [Speaker([0, 0, 50, 50], 5, [])], 0, [])
+    panel = [{"type": "dialogue", "content": "abcde"}]
+    base_image = name.load_base_image(_Result)
+    before = base_image.tobytes()
+    for k in range(3):
+        name.generate_name(_Result, query, (ref, 1.0, None), panel, str(tmp_path / f"00_name_{k}.png"), base_image=base_image, save_composite=k > 0)
+    assert base_image.tobytes() == before
+    assert not (tmp_path / "00_name_0.png").exists()
+    assert (tmp_path / "00_name_1.png").exists()
+    assert name.load_template_image.cache_info().hits == 1
+
+    # base_image を渡さない従来の呼び出しと同じ画像になる
+    name.generate_name(_Result, query, (ref, 1.0, None), panel, str(tmp_path / "legacy.png"))
+    with Image.open(tmp_path / "legacy_onlyname.png") as legacy, Image.open(tmp_path / "00_name_0_onlyname.png") as reused:
+        assert legacy.tobytes() == reused.tobytes()
+    with Image.open(tmp_path / "legacy.png") as legacy, Image.open(tmp_path / "00_name_1.png") as reused:
+        assert legacy.size == (400, 300) and legacy.tobytes() == reused.tobytes()
+    name.load_template_image.cache_clear()
+    font_cache.clear_cache()
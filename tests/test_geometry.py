@@ -0,0 +1,147 @@
+import base64
+import io
+import random
+
+from PIL import Image
+
+
+def _controlnet_result(rng, width, height, num_people):
+    from lib.image.controlnet import ControlNetResult
+
+    def keypoints(n):
+        values = []
+        for _ in range(n):
+            # 未検出のキーポイントは 0
+            if rng.random() < 0.2:
+                values += [0, 0, 0]
+            else:
+                values += [rng.random(), rng.random(), 1]
+        return values
+
+    people = []
+    for _ in range(num_people):
+        people.append({
+            "pose_keypoints_2d": keypoints(18),
+            "face_keypoints_2d": keypoints(70) if rng.random() < 0.7 else None,
+            "hand_left_keypoints_2d": None,
+            "hand_right_keypoints_2d": None,
+        })
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buffer, format="PNG")
+    return ControlNetResult({
+        "poses": [{"canvas_width": width, "canvas_height": height, "people": people}],
+        "images": [base64.b64encode(buffer.getvalue()).decode()],
+    })
+
+
+def _reference_penalty(ref_layout, panel_data, people_result):
+    """calculate_geometric_penalty before vectorization"""
+    from lib.scoring.geometry import simulate_bubbles
+
+    width, height = people_result.canvas_width, people_result.canvas_height
+    total_penalty = 0.0
+    for b_bbox in simulate_bubbles(ref_layout, panel_data):
+        b_area = (b_bbox[2] - b_bbox[0]) * (b_bbox[3] - b_bbox[1])
+        if b_area <= 0:
+            continue
+        for person in people_result.people:
+            boxes = []
+            if person.pose_keypoints_2d:
+                pxs = [kp[0] for kp in person.pose_keypoints_2d if kp[0] > 0]
+                pys = [kp[1] for kp in person.pose_keypoints_2d if kp[1] > 0]
+                if pxs and pys:
+                    boxes.append(([min(pxs) * width, min(pys) * height, max(pxs) * width, max(pys) * height], 1.0))
+            if person.face_keypoints_2d:
+                fxs = [kp[0] for kp in person.face_keypoints_2d if kp[0] > 0]
+                fys = [kp[1] for kp in person.face_keypoints_2d if kp[1] > 0]
+                if fxs and fys:
+                    boxes.append(([min(fxs) * width, min(fys) * height, max(fxs) * width, max(fys) * height], 5.0))
+            for box, weight in boxes:
+                w = min(b_bbox[2], box[2]) - max(b_bbox[0], box[0])
+                h = min(b_bbox[3], box[3]) - max(b_bbox[1], box[1])
+                if w > 0 and h > 0:
+                    total_penalty += (w * h / b_area) * 100 * weight
+    return total_penalty
+
+
+def test_geometric_penalties_match_scalar_loop():
+    from lib.layout.layout import MangaLayout, NonSpeaker, Speaker
+    from lib.scoring.geometry import calculate_geometric_penalties, calculate_geometric_penalty
+
+    rng = random.Random(0)
+    width, height = 512, 768
+
+    def bbox():
+        x1, y1 = rng.randint(0, width - 60), rng.randint(0, height - 60)
+        return [x1, y1, rng.randint(x1 + 5, width), rng.randint(y1 + 5, height)]
+
+    panel = [
+        {"type": "dialogue", "content": "あいうえお" * 3},
+        {"type": "monologue", "content": "かきくけこ"},
+        {"type": "dialogue", "content": "さしす"},
+    ]
+    for num_people in [0, 1, 3]:
+        people_result = _controlnet_result(rng, width, height, num_people)
+        refs = []
+        for _ in range(8):
+            elements = [Speaker(bbox(), 10, [{"bbox": bbox()} for _ in range(rng.randint(0, 2))]) for _ in range(rng.randint(0, 3))]
+            elements.append(NonSpeaker(bbox()))
+            unrelated = [{"bbox": bbox(), "length": 5} for _ in range(rng.randint(0, 2))]
+            refs.append(MangaLayout("", width, height, elements, 5, unrelated))
+        refs.append(None)
+
+        penalties = calculate_geometric_penalties(refs, panel, people_result)
+        assert len(penalties) == len(refs)
+        assert penalties[-1] == 0.0
+        for ref, penalty in zip(refs[:-1], penalties):
+            expected = _reference_penalty(ref, panel, people_result) if num_people else 0.0
+            assert abs(penalty - expected) < 1e-6
+            assert abs(calculate_geometric_penalty(ref, panel, people_result) - penalty) < 1e-9
+        if num_people == 3:
+            assert any(penalty > 0 for penalty in penalties)
+
+
+def test_penalty_debug_records_render_later(tmp_path):
+    import json
+    import os
+    from lib.layout.layout import MangaLayout, Speaker
+    from lib.scoring.debug import debug_image_path, penalty_debug_record, render_run_debug_images
+    from lib.scoring.geometry import calculate_geometric_penalties
+
+    rng = random.Random(1)
+    people_result = _controlnet_result(rng, 512, 512, 2)
+    refs = [
+        MangaLayout("", 512, 512, [Speaker([0, 0, 200, 200], 5, [{"bbox": [100 + 50 * k, 50, 200 + 50 * k, 400]}])], 0, [])
+        for k in range(3)
+    ]
+    panel = [{"type": "dialogue", "content": "あいうえお"}]
+    penalties, debug = calculate_geometric_penalties(refs, panel, people_result, return_debug=True)
+    assert penalties == calculate_geometric_penalties(refs, panel, people_result)
+    # 人物はバリエーションで1回だけ、参照レイアウトごとには吹き出しとペナルティだけ
+    assert len(debug["people"]) == 2 and len(debug["layouts"]) == 3
+    assert [layout["penalty"] for layout in debug["layouts"]] == penalties
+    assert all(set(layout) == {"bubbles", "penalty"} for layout in debug["layouts"])
+    record = penalty_debug_record(debug, 0)
+    assert record["people"] == debug["people"] and len(record["bubbles"]) == 1
+
+    # パイプラインと同じく scores.json に記録だけ残し、後からまとめて描く
+    panel_dir = tmp_path / "images" / "panel000"
+    panel_dir.mkdir(parents=True)
+    options = [
+        {"rank": k, "generated_image_path": str(panel_dir / f"00_name_{k}.png"), "geom_penalty": penalties[k]}
+        for k in range(3)
+    ]
+    with open(panel_dir / "scores.json", "w", encoding="utf-8") as f:
+        json.dump({"variations": [{"variation_id": 0, "penalty_debug": debug, "layout_options": options}]}, f)
+
+    rendered = render_run_debug_images(str(tmp_path), max_workers=2)
+    assert sorted(rendered) == sorted(debug_image_path(option["generated_image_path"]) for option in options)
+    assert all(os.path.exists(path) for path in rendered)
+    assert os.path.basename(rendered[0]).endswith("_bbox.png")
+    # 描画済みの画像は描き直さない
+    assert render_run_debug_images(str(tmp_path)) == []
+
+    # bbox_save_paths を渡すとその場で描く
+    save_path = str(tmp_path / "now.png")
+    calculate_geometric_penalties(refs[:1], panel, people_result, [save_path])
+    assert os.path.exists(save_path)
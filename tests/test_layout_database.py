@@ -0,0 +1,372 @@
+import json
+import os
+import random
+
+import numpy as np
+
+
+def _random_metadata(rng, num_speakers, num_non_speakers, idx):
+    width = rng.randint(300, 900)
+    height = rng.randint(300, 900)
+
+    def bbox():
+        x1 = rng.randint(0, width - 50)
+        y1 = rng.randint(0, height - 50)
+        return [x1, y1, rng.randint(x1 + 10, width), rng.randint(y1 + 10, height)]
+
+    speaker_objects = []
+    for _ in range(num_speakers):
+        text_info = [{"bbox": bbox(), "length": rng.randint(1, 30)} for _ in range(rng.randint(0, 2))]
+        speaker_objects.append({
+            "bbox": bbox(),
+            "text_length": sum(t["length"] for t in text_info),
+            "text_info": text_info,
+        })
+    unrelated_text_bbox = [{"bbox": bbox(), "length": rng.randint(1, 30)} for _ in range(rng.randint(0, 2))]
+    return {
+        "image_path": f"curated_dataset/book/{idx}.png",
+        "width": width,
+        "height": height,
+        "speaker_objects": speaker_objects,
+        "non_speaker_objects": [{"bbox": bbox()} for _ in range(num_non_speakers)],
+        "unrelated_text_length": sum(t["length"] for t in unrelated_text_bbox),
+        "unrelated_text_bbox": unrelated_text_bbox,
+    }
+
+
+def make_database(path, seed=0, size=60):
+    rng = random.Random(seed)
+    ann = {}
+    idx = 0
+    for num_speakers, num_non_speakers in [(0, 0), (0, 1), (1, 0), (1, 1), (2, 1), (3, 0), (2, 3)]:
+        key = f"{num_speakers}_{num_non_speakers}"
+        ann[key] = []
+        for _ in range(size):
+            ann[key].append(_random_metadata(rng, num_speakers, num_non_speakers, idx))
+            idx += 1
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(ann, f)
+    return ann
+
+
+def test_compiled_bucket_roundtrip(tmp_path):
+    from lib.layout.database import compile_database, load_bucket
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile)
+    db_dir = str(tmp_path / "database")
+    compile_database(ann, db_dir, source_path=annfile)
+
+    for key, metadatum in ann.items():
+        bucket = load_bucket(db_dir, key)
+        assert len(bucket) == len(metadatum)
+        for row, metadata in enumerate(metadatum):
+            assert bucket.metadata(row) == metadata
+
+
+def test_from_condition_compiled_matches_json(tmp_path):
+    from lib.layout.database import compile_database
+    from lib.layout.layout import from_condition
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile)
+
+    def run(path):
+        layouts = from_condition(path, 1, 1, 10, 15, 512, 768, 0.3, True)
+        return [repr(layout) + repr([e.bbox for e in layout.elements]) for layout in layouts]
+
+    from_json = run(annfile)
+    compile_database(ann, str(tmp_path / "database"), source_path=annfile)
+    # database.json の隣にコンパイル済み DB があればそちらが使われる
+    from_compiled = run(annfile)
+    from_dir = run(str(tmp_path / "database"))
+    assert from_json
+    assert from_json == from_compiled == from_dir
+
+
+def test_missing_bucket(tmp_path):
+    import pytest
+    from lib.layout.database import compile_database
+    from lib.layout.layout import from_condition
+
+    annfile = str(tmp_path / "database.json")
+    compile_database(make_database(annfile), str(tmp_path / "database"), source_path=annfile)
+    with pytest.raises(ValueError):
+        from_condition(annfile, 9, 9, 0, 10, 512, 512, 0.3, True)
+
+
+def test_layout_index_loads_once_and_reloads_on_mtime(tmp_path):
+    from lib.layout.index import LayoutIndex
+    from lib.layout.layout import from_condition
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile)
+    index = LayoutIndex.get(annfile)
+    assert LayoutIndex.get(annfile) is index
+
+    for _ in range(3):
+        from_condition(annfile, 1, 1, 10, 15, 512, 768, 0.3, True)
+    assert index.load_count == 1
+    assert len(index.bucket("2_1")) == len(ann["2_1"])
+
+    ann["2_1"] = ann["2_1"][:5]
+    with open(annfile, "w", encoding="utf-8") as f:
+        json.dump(ann, f)
+    stat = os.stat(annfile)
+    os.utime(annfile, (stat.st_atime, stat.st_mtime + 10))
+    assert len(index.bucket("2_1")) == 5
+    assert index.load_count == 2
+
+
+def _random_query(rng, num_speakers, num_non_speakers, width, height):
+    from lib.layout.layout import generate_layout
+
+    bboxes = []
+    for _ in range(num_speakers + num_non_speakers):
+        x1 = rng.randint(0, width - 50)
+        y1 = rng.randint(0, height - 50)
+        bboxes.append([x1, y1, rng.randint(x1 + 5, width), rng.randint(y1 + 5, height)])
+    panel = [{"type": "dialogue", "content": "あ" * rng.randint(1, 30)} for _ in range(num_speakers)]
+    panel.append({"type": "monologue", "content": "い" * rng.randint(0, 40)})
+    return generate_layout(bboxes, panel, width, height)
+
+
+def test_similar_layouts_matches_object_scoring(tmp_path):
+    from lib.layout.layout import from_condition, similar_layouts
+    from lib.layout.score import calc_similarity
+
+    annfile = str(tmp_path / "database.json")
+    make_database(annfile, size=200)
+    rng = random.Random(0)
+    for num_speakers, num_non_speakers in [(0, 1), (1, 1), (2, 1), (3, 0), (2, 3)]:
+        query = _random_query(rng, num_speakers, num_non_speakers, 512, 768)
+        scored = similar_layouts(query, text_length_threshold=15, annfile=annfile)
+        candidates = from_condition(annfile, num_speakers, num_non_speakers, query.unrelated_text_length, 15, 512, 768, 0.3, False)
+        expected = []
+        for candidate in candidates:
+            # 参照レイアウトはキャンバスサイズに (整数に丸めずに) 拡大縮小して比較する
+            sx, sy = 512 / candidate.width, 768 / candidate.height
+            for element in candidate.elements:
+                element.bbox = [element.bbox[0] * sx, element.bbox[1] * sy, element.bbox[2] * sx, element.bbox[3] * sy]
+            candidate.width, candidate.height = 512, 768
+            expected.append(calc_similarity(query, candidate, 0.4)[0])
+        expected.sort(reverse=True)
+        assert len(scored) == len(expected)
+        for score, ref in zip(scored.scores, expected):
+            assert abs(score - ref) < 1e-5
+        assert len(scored._layouts) == 0
+
+        # 上位K件だけが ArrayLayout として生成される
+        top = scored[:3]
+        assert len(scored._layouts) == len(top)
+        for (layout, _, _), row in zip(top, scored.rows):
+            original = from_condition(annfile, num_speakers, num_non_speakers, 0, 1000, 1, 1, 100, False)[row]
+            assert layout.image_path == original.image_path
+            assert (layout.width, layout.height) == (512, 768)
+            for element, original_element in zip(layout.to_manga_layout().elements, original.elements):
+                assert type(element) == type(original_element)
+                sx, sy = 512 / original.width, 768 / original.height
+                scaled = [original_element.bbox[0] * sx, original_element.bbox[1] * sy, original_element.bbox[2] * sx, original_element.bbox[3] * sy]
+                assert all(isinstance(v, int) and abs(v - e) <= 1 for v, e in zip(element.bbox, scaled))
+
+
+def test_similar_layouts_top_k(tmp_path):
+    from lib.layout.layout import _top_k_order, similar_layouts
+
+    scores = np.array([0.5, 1.0, 0.5, 2.0, 0.5, 1.0, 0.1])
+    full = list(_top_k_order(scores))
+    for k in range(len(scores) + 2):
+        assert list(_top_k_order(scores, k)) == full[:k]
+
+    annfile = str(tmp_path / "database.json")
+    make_database(annfile, size=200)
+    query = _random_query(random.Random(1), 2, 1, 512, 768)
+    everything = similar_layouts(query, text_length_threshold=15, annfile=annfile)
+    top = similar_layouts(query, text_length_threshold=15, annfile=annfile, top_k=4)
+    assert len(top) == 4
+    assert list(top.rows) == list(everything.rows[:4])
+    assert top.scores == everything.scores[:4]
+    for (_, _, pairs), (_, _, expected) in zip(top, everything[:4]):
+        assert list(pairs) == list(expected)
+
+
+def test_similar_layouts_ann(tmp_path):
+    from lib.layout.database import compile_database
+    from lib.layout.index import LayoutIndex
+    from lib.layout.layout import similar_layouts
+
+    annfile = str(tmp_path / "database.json")
+    compile_database(make_database(annfile, size=300), str(tmp_path / "database"), source_path=annfile)
+    index = LayoutIndex.get(annfile)
+    rng = random.Random(2)
+    for num_speakers, num_non_speakers in [(1, 1), (2, 1)]:
+        query = _random_query(rng, num_speakers, num_non_speakers, 512, 768)
+        options = dict(text_length_threshold=40, aspect_ratio_threshold=1.0, annfile=index, top_k=5)
+        exact = similar_layouts(query, **options)
+        allowed = set(similar_layouts(query, **dict(options, top_k=None)).rows.tolist())
+
+        # 候補数がバケットより多ければ厳密解と同じ
+        assert list(similar_layouts(query, ann=True, ann_candidates=1000, **options).rows) == list(exact.rows)
+
+        approx = similar_layouts(query, ann=True, ann_candidates=20, **options)
+        assert len(approx) == 5
+        assert set(approx.rows.tolist()) <= allowed
+        # 絞り込み後は厳密なスコアで並べ替えられている
+        assert approx.scores == sorted(approx.scores, reverse=True)
+        assert index.bucket(f"{num_speakers}_{num_non_speakers}").path is not None
+
+
+def test_cached_layouts_are_immutable(tmp_path):
+    import pytest
+    from lib.layout.index import LayoutIndex
+    from lib.layout.layout import similar_layouts
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile, size=50)
+    bucket = LayoutIndex.get(annfile).bucket("1_1")
+    with pytest.raises(ValueError):
+        bucket.bboxes[0, 0, 0] = 0.5
+
+    rng = random.Random(3)
+    for width, height in [(512, 512), (896, 512), (384, 768)]:
+        query = _random_query(rng, 1, 1, width, height)
+        for layout, _, _ in similar_layouts(query, text_length_threshold=100, aspect_ratio_threshold=10, annfile=annfile, top_k=5):
+            assert (layout.width, layout.height) == (width, height)
+    assert [bucket.metadata(row) for row in range(len(bucket))] == ann["1_1"]
+
+
+def test_array_layout_matches_manga_layout(tmp_path):
+    from lib.layout.index import LayoutIndex
+    from lib.layout.layout import (
+        _generate_array_layout_from_bucket,
+        _generate_layout_from_bucket,
+        count_speakers,
+        speaker_text_bboxes_in_reading_order,
+        unrelated_text_bboxes,
+    )
+    from lib.layout.score import calc_similarity
+
+    annfile = str(tmp_path / "database.json")
+    make_database(annfile, size=20)
+    index = LayoutIndex.get(annfile)
+    rng = random.Random(4)
+    for key in ["0_1", "1_0", "2_1", "2_3"]:
+        bucket = index.bucket(key)
+        query = _random_query(rng, *map(int, key.split("_")), 512, 768)
+        for row in range(len(bucket)):
+            compact = _generate_array_layout_from_bucket(bucket, row, 512, 768)
+            layout = _generate_layout_from_bucket(bucket, row, 512, 768, True)
+            assert not hasattr(compact, "__dict__")
+            assert count_speakers(compact) == count_speakers(layout)
+            assert speaker_text_bboxes_in_reading_order(compact) == speaker_text_bboxes_in_reading_order(layout)
+            assert unrelated_text_bboxes(compact) == unrelated_text_bboxes(layout)
+            assert compact.unrelated_text_bbox == layout.unrelated_text_bbox
+            assert calc_similarity(query, compact, 0.4)[0] == calc_similarity(query, layout, 0.4)[0]
+            assert repr(compact.to_manga_layout().elements) == repr(layout.elements)
+
+
+def test_canvas_bboxes_match_adjust(tmp_path):
+    import copy
+
+    from lib.layout.database import compile_database, load_bucket
+    from lib.layout.layout import _generate_array_layout_from_bucket, _generate_layout_from_metadata
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile, seed=5, size=80)
+    # 正規化して戻すと 1px ずれやすい値 (300 / 900 * 900)
+    ann["1_0"].append({
+        "image_path": "curated_dataset/book/x.png", "width": 900, "height": 900,
+        "speaker_objects": [{"bbox": [300, 300, 600, 899], "text_length": 3,
+                             "text_info": [{"bbox": [300, 100, 700, 300], "length": 3}]}],
+        "non_speaker_objects": [], "unrelated_text_length": 2,
+        "unrelated_text_bbox": [{"bbox": [100, 300, 300, 900], "length": 2}],
+    })
+    db_dir = str(tmp_path / "database")
+    compile_database(ann, db_dir, source_path=annfile)
+
+    for key, metadatum in ann.items():
+        bucket = load_bucket(db_dir, key)
+        for row, metadata in enumerate(metadatum):
+            for width, height in [(900, 900), (512, 768), (768, 512), (640, 360)]:
+                expected = _generate_layout_from_metadata(copy.deepcopy(metadata))
+                expected.adjust(width, height)
+                actual = _generate_layout_from_metadata(bucket.metadata(row, width, height))
+                assert repr(actual) == repr(expected)
+                assert [getattr(e, "text_info", None) for e in actual.elements] == [getattr(e, "text_info", None) for e in expected.elements]
+                assert actual.unrelated_text_bbox == expected.unrelated_text_bbox
+                compact = _generate_array_layout_from_bucket(bucket, row, width, height).to_manga_layout()
+                assert repr(compact.elements) == repr(expected.elements)
+                # ArrayLayout は text_info の length を持たないので bbox だけ比べる
+                assert [[t["bbox"] for t in getattr(e, "text_info", [])] for e in compact.elements] == [[t["bbox"] for t in getattr(e, "text_info", [])] for e in expected.elements]
+                assert compact.unrelated_text_bbox == expected.unrelated_text_bbox
+
+
+def test_similar_layouts_query_cache(tmp_path):
+    from lib.layout.cache import QueryCache
+    from lib.layout.index import LayoutIndex
+    from lib.layout.layout import MangaLayout, NonSpeaker, Speaker, similar_layouts
+
+    annfile = str(tmp_path / "database.json")
+    ann = make_database(annfile, size=100)
+    index = LayoutIndex.get(annfile)
+    cache_dir = str(tmp_path / "query_cache")
+    cache = QueryCache(cache_dir, grid=8)
+    query = _random_query(random.Random(5), 2, 1, 512, 768)
+    for element in query.elements:
+        element.bbox = [v // 8 * 8 for v in element.bbox]
+    options = dict(text_length_threshold=15, annfile=index, top_k=5)
+
+    expected = similar_layouts(query, **options)
+    first = similar_layouts(query, cache=cache, **options)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert list(first.rows) == list(expected.rows) and first.scores == expected.scores
+
+    # grid 未満のずれは同じクエリとして扱う
+    jittered = MangaLayout(query.image_path, query.width, query.height, [
+        Speaker([v + 1 for v in e.bbox], e.text_length) if type(e) == Speaker else NonSpeaker([v + 1 for v in e.bbox])
+        for e in query.elements
+    ], query.unrelated_text_length, [])
+    assert list(similar_layouts(jittered, cache=cache, **options).rows) == list(expected.rows)
+    assert cache.hits == 1
+
+    # 別プロセス (新しい QueryCache) ではディスクから読む
+    reloaded = QueryCache(cache_dir, grid=8)
+    again = similar_layouts(query, cache=reloaded, **options)
+    assert reloaded.hits == 1
+    assert list(again.rows) == list(expected.rows) and again.scores == expected.scores
+    assert [list(pairs) for _, _, pairs in again] == [list(pairs) for _, _, pairs in expected]
+
+    # パラメータが違えば別のエントリ
+    similar_layouts(query, cache=reloaded, **dict(options, top_k=3))
+    assert reloaded.misses == 1
+
+    # データベースが変わると digest が変わり、キャッシュは使われない
+    ann["2_1"] = ann["2_1"][:10]
+    with open(annfile, "w", encoding="utf-8") as f:
+        json.dump(ann, f)
+    stat = os.stat(annfile)
+    os.utime(annfile, (stat.st_atime, stat.st_mtime + 10))
+    changed = similar_layouts(query, cache=reloaded, **options)
+    assert reloaded.misses == 2
+    assert all(row < 10 for row in changed.rows)
+
+
+def test_dataprepare_reruns_next_to_compiled_database(tmp_path, monkeypatch):
+    import sys
+
+    from src import dataprepare
+
+    manga_dir = tmp_path / "MangaA"
+    manga_dir.mkdir()
+    metadata = {"id": 0, "frame_width": 100, "frame_height": 80, "relations": [], "text_objects": [],
+                "body_objects": [{"id": "b0", "bbox": [10, 10, 50, 70]}]}
+    (manga_dir / "annotation.json").write_text(json.dumps([metadata]), encoding="utf-8")
+    (tmp_path / "query_cache").mkdir()
+
+    monkeypatch.setattr(sys, "argv", ["dataprepare.py", "--dataset_path", str(tmp_path)])
+    for _ in range(2):
+        # 2回目は1回目に書いたコンパイル済み DB (database/) がデータセットのディレクトリにある
+        dataprepare.main()
+        with open(tmp_path / "database.json", encoding="utf-8") as f:
+            assert list(json.load(f)) == ["0_1"]
+    assert os.path.isdir(tmp_path / "database")
@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def test_assign_small_matches_hungarian():
+    from lib.layout.score import _assign_small
+
+    rng = np.random.default_rng(0)
+    for n in range(1, 4):
+        for m in range(1, 4):
+            weight = rng.random((50, n, m))
+            # 同じ値を含む行列でも最大値は一致する
+            weight[:10] = np.round(weight[:10], 1)
+            values, row_indices, col_indices = _assign_small(weight)
+            for i in range(len(weight)):
+                rows, cols = linear_sum_assignment(-weight[i])
+                assert np.isclose(values[i], weight[i, rows, cols].sum())
+                assert np.isclose(values[i], weight[i, row_indices[i], col_indices[i]].sum())
+                assert list(row_indices[i]) == sorted(row_indices[i])
+                assert len(set(col_indices[i])) == len(col_indices[i])
+
+
+def test_calc_similarity_batch_matches_calc_similarity():
+    from lib.layout.layout import MangaLayout, Speaker, NonSpeaker
+    from lib.layout.score import calc_similarity, calc_similarity_batch
+
+    rng = np.random.default_rng(1)
+
+    def random_boxes(n):
+        xy = rng.integers(0, 400, (n, 2))
+        return np.concatenate([xy, xy + rng.integers(10, 200, (n, 2))], axis=1)
+
+    # 4 Speaker / 5 NonSpeaker のブロックは Hungarian 法、それ以外は全列挙
+    for num_speakers, num_non_speakers in [(0, 0), (1, 0), (0, 2), (2, 2), (3, 1), (4, 5)]:
+        n = 30
+        ref_boxes = np.stack([random_boxes(num_speakers + num_non_speakers) for _ in range(n)])
+        ref_text = rng.integers(0, 40, (n, num_speakers))
+        ref_unrelated = rng.integers(0, 40, n)
+
+        # query の要素の並びは Speaker/NonSpeaker が混在していてもよい
+        elements = [Speaker(list(b), int(t)) for b, t in zip(random_boxes(num_speakers), rng.integers(0, 40, num_speakers))]
+        elements += [NonSpeaker(list(b)) for b in random_boxes(num_non_speakers)]
+        rng.shuffle(elements)
+        query = MangaLayout("", 512, 512, elements, 12, [])
+
+        scores, assignment = calc_similarity_batch(query, ref_boxes, ref_text, ref_unrelated, 0.4)
+        for i in range(n):
+            ref_elements = [Speaker(list(b), int(t)) for b, t in zip(ref_boxes[i, :num_speakers], ref_text[i])]
+            ref_elements += [NonSpeaker(list(b)) for b in ref_boxes[i, num_speakers:]]
+            ref = MangaLayout("", 512, 512, ref_elements, int(ref_unrelated[i]), [])
+            expected, _ = calc_similarity(query, ref, 0.4)
+            assert np.isclose(scores[i], expected)
+            assert sorted(assignment[i]) == list(range(len(elements)))
+            for q, r in enumerate(assignment[i]):
+                assert type(elements[q]) == type(ref_elements[r])
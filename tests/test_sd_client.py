@@ -0,0 +1,341 @@
+import base64
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def _png_base64(color, size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Minimal Stable Diffusion WebUI API (txt2img and /controlnet/detect)."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self._send_json(200, {})
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append((self.path, payload))
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self._respond(payload)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def _respond(self, payload):
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self._send_json(503, {"error": "busy"})
+        elif self.path == "/sdapi/v1/txt2img":
+            # WebUI と同じく batch_size > 1 なら先頭にグリッド画像 (設定で返さないこともある)、
+            # seed=-1 ならランダムな seed から連番
+            size = (payload["width"], payload["height"])
+            count = payload.get("batch_size", 1)
+            seed = payload.get("seed", -1)
+            seed = 1000 + len(self.server.requests) if seed == -1 else seed
+            images = [_png_base64((10 + k * 40, 0, 0), size) for k in range(count)]
+            grid = count > 1 and self.server.return_grid
+            if grid:
+                images.insert(0, _png_base64("white", size))
+            if "alwayson_scripts" in payload:
+                images.append(_png_base64("black", size))
+            info = {"seed": seed, "all_seeds": [seed + k for k in range(count)], "index_of_first_image": int(grid)}
+            self._send_json(200, {"images": images, "info": json.dumps(info)})
+        elif self.path == "/controlnet/detect":
+            people = [{"pose_keypoints_2d": [0.5, 0.5, 1] * 18, "face_keypoints_2d": None,
+                       "hand_left_keypoints_2d": None, "hand_right_keypoints_2d": None}]
+            images = payload["controlnet_input_images"]
+            self._send_json(200, {
+                # canvas_height で入力画像との対応を確かめる
+                "poses": [{"canvas_width": 8, "canvas_height": len(image), "people": people} for image in images],
+                "images": [_png_base64("black") for _ in images],
+            })
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stub(failures=0):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.connections = set()
+    server.requests = []
+    server.failures = failures
+    server.delay = 0
+    server.return_grid = True
+    server.lock = threading.Lock()
+    server.active = server.max_active = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_sd_client_call_sites(tmp_path):
+    from lib.image.controlnet import check_open, generate_with_controlnet_openpose, run_controlnet_openpose
+    from lib.image.image import generate_image_with_sd
+    from lib.image.sd_client import SDClient
+
+    server, url = _start_stub()
+    client = SDClient(url, timeout=10)
+    try:
+        assert check_open(client)
+        image_path = str(tmp_path / "00.png")
+        generate_image_with_sd("a girl", image_path, width=16, height=24, client=client)
+        with Image.open(image_path) as image:
+            assert image.size == (16, 24)
+        anime_path = str(tmp_path / "00_anime.png")
+        generate_with_controlnet_openpose(image_path, "a girl", anime_path, width=16, height=24, client=client)
+        result = run_controlnet_openpose(image_path, anime_path, client=client)
+        assert len(result.people) == 1 and result.base_image_path == anime_path
+
+        assert [path for path, _ in server.requests] == ["/sdapi/v1/txt2img", "/sdapi/v1/txt2img", "/controlnet/detect"]
+        # 全てのリクエストが同じ keep-alive 接続を使う
+        assert len(server.connections) == 1
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert not check_open(client)
+
+
+def test_sd_client_retries_and_shared_client(monkeypatch):
+    import pytest
+    import requests
+
+    from lib.image import sd_client
+    from lib.image.sd_client import SDClient, get_client, set_client
+
+    server, url = _start_stub(failures=2)
+    try:
+        client = SDClient(url, retries=2, backoff=0)
+        assert client.detect({"controlnet_input_images": ["x"]})["poses"]
+        assert len(server.requests) == 3
+
+        server.failures = 5
+        with pytest.raises(requests.HTTPError):
+            SDClient(url, retries=1, backoff=0).txt2img({"width": 8, "height": 8})
+
+        monkeypatch.setattr(sd_client, "_client", None)
+        monkeypatch.setenv("SD_WEBUI_URL", url + "/")
+        assert get_client().base_url == url
+        assert get_client() is get_client()
+        other = SDClient("http://127.0.0.1:1")
+        set_client(other)
+        assert get_client() is other and not other.is_open(timeout=0.5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_sd_client_bounds_requests_in_flight():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from lib.image.sd_client import SDClient
+
+    server, url = _start_stub()
+    server.delay = 0.1
+    client = SDClient(url, max_in_flight=2, pool_size=4)
+    try:
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(lambda k: client.txt2img({"width": 8, "height": 8, "seed": k}), range(6)))
+        assert len(results) == 6
+        assert server.max_active == 2
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_batched_txt2img_records_seeds(tmp_path):
+    from lib.image.controlnet import generate_with_controlnet_openpose
+    from lib.image.image import generate_image_with_sd, generate_images_with_sd
+    from lib.image.sd_client import SDClient, response_seeds
+
+    server, url = _start_stub()
+    client = SDClient(url)
+    try:
+        paths = [str(tmp_path / f"{j:02d}.png") for j in range(3)]
+        seeds = generate_images_with_sd("a girl", paths, width=8, height=8, seed=42, client=client)
+        assert seeds == [42, 43, 44]
+        assert len(server.requests) == 1 and server.requests[0][1]["batch_size"] == 3
+        # グリッド画像は保存しない
+        for k, path in enumerate(paths):
+            with Image.open(path) as image:
+                assert image.getpixel((0, 0)) == (10 + k * 40, 0, 0)
+
+        seed = generate_image_with_sd("a girl", paths[0], width=8, height=8, client=client)
+        assert seed is not None and seed != -1
+        anime_path = str(tmp_path / "00_anime.png")
+        assert generate_with_controlnet_openpose(paths[0], "a girl", anime_path, width=8, height=8, seed=7, client=client) == 7
+        with Image.open(anime_path) as image:
+            assert image.getpixel((0, 0)) == (10, 0, 0)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert response_seeds({"images": [], "info": "not json"}, 2) == [None, None]
+    assert response_seeds({"info": {"seed": 5}}, 2) == [5, 6]
+
+
+def test_response_images_skip_only_the_grid():
+    from lib.image.sd_client import SDClient, response_images
+
+    server, url = _start_stub()
+    client = SDClient(url)
+    payload = {"width": 8, "height": 8, "batch_size": 2, "alwayson_scripts": {"controlnet": {"args": []}}}
+    try:
+        # グリッドを返さない設定: 生成画像の後ろに ControlNet の検出画像だけが付く
+        server.return_grid = False
+        response = client.txt2img(payload)
+        assert len(response["images"]) == 3
+        assert [image.getpixel((0, 0)) for image in response_images(response, 2)] == [(10, 0, 0), (50, 0, 0)]
+
+        server.return_grid = True
+        response = client.txt2img(payload)
+        assert len(response["images"]) == 4
+        assert [image.getpixel((0, 0)) for image in response_images(response, 2)] == [(10, 0, 0), (50, 0, 0)]
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    # index_of_first_image が無いレスポンスは先頭をグリッドとみなす
+    images = [_png_base64("white"), _png_base64((10, 0, 0)), _png_base64((50, 0, 0))]
+    assert [image.getpixel((0, 0)) for image in response_images({"images": images}, 2)] == [(10, 0, 0), (50, 0, 0)]
+
+
+def test_sd_pool_balances_and_fails_over(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pytest
+    import requests
+
+    from lib.image.sd_client import SDClient, SDPool, create_client
+
+    servers = [_start_stub() for _ in range(3)]
+    for server, _ in servers:
+        server.delay = 0.05
+    pool = SDPool([SDClient(url, retries=0, pool_size=4) for _, url in servers])
+    try:
+        assert pool.is_open()
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda k: pool.txt2img({"width": 8, "height": 8}), range(12)))
+        # 空いているバックエンドから順に割り振る
+        assert [len(server.requests) for server, _ in servers] == [4, 4, 4]
+        assert all(server.max_active <= 2 for server, _ in servers)
+
+        # 落ちたバックエンドのリクエストは別のバックエンドで送り直し、しばらく使わない
+        servers[0][0].shutdown()
+        servers[0][0].server_close()
+        pool.clients[0].close()  # keep-alive 中の接続も切る
+        for _ in range(4):
+            assert pool.detect({"controlnet_input_images": ["x"]})["poses"]
+        stats = pool.stats()
+        assert stats[0]["failed"] == 1 and not stats[0]["healthy"]
+        assert stats[0]["completed"] == 4 and stats[1]["completed"] + stats[2]["completed"] == 12
+        assert pool.health_check() == {url: k > 0 for k, (_, url) in enumerate(servers)}
+        assert "per min" in pool.format_stats()
+
+        # 4xx はリクエストの問題なので他のバックエンドでは送り直さない
+        with pytest.raises(requests.HTTPError):
+            pool.post("/unknown", {})
+        assert pool.stats()[1]["failed"] + pool.stats()[2]["failed"] == 1
+
+        # 全てのバックエンドで失敗したら最後のエラーを返す
+        servers[1][0].failures = servers[2][0].failures = 1
+        with pytest.raises(requests.ConnectionError):
+            pool.txt2img({"width": 8, "height": 8})
+    finally:
+        pool.close()
+        for server, _ in servers[1:]:
+            server.shutdown()
+            server.server_close()
+
+    monkeypatch.setenv("SD_WEBUI_URLS", ",".join(url for _, url in servers[:2]))
+    client = create_client(max_in_flight=2)
+    assert isinstance(client, SDPool) and client.max_in_flight == 4
+    assert isinstance(create_client([servers[0][1]]), SDClient)
+
+
+def test_openpose_detection_is_batched_and_cached(tmp_path):
+    from lib.image.controlnet import detect_openpose, run_controlnet_openpose, run_controlnet_openpose_batch
+    from lib.image.pose_cache import PoseCache
+    from lib.image.sd_client import SDClient
+
+    paths = []
+    for k, size in enumerate([(8, 8), (16, 16), (8, 8)]):
+        paths.append(str(tmp_path / f"{k}.png"))
+        Image.new("RGB", size, "white" if k < 2 else "black").save(paths[-1])
+    duplicate = str(tmp_path / "copy.png")
+    with open(paths[0], "rb") as src, open(duplicate, "wb") as dst:
+        dst.write(src.read())
+
+    server, url = _start_stub()
+    client = SDClient(url)
+    try:
+        cache = PoseCache(str(tmp_path / "poses"))
+        responses = detect_openpose(paths + [duplicate], client, cache)
+        # 中身が同じ画像は1回だけ、全て1リクエストで検出する
+        assert len(server.requests) == 1
+        sent = server.requests[0][1]["controlnet_input_images"]
+        assert len(sent) == 3
+        assert [response["poses"][0]["canvas_height"] for response in responses] == [len(sent[0]), len(sent[1]), len(sent[2]), len(sent[0])]
+
+        results = run_controlnet_openpose_batch(paths[:2], ["a.png", None], client, cache)
+        assert len(server.requests) == 1 and cache.hits == 2
+        assert results[0].base_image_path == "a.png" and len(results[1].people) == 1
+
+        # ディスクに残した結果は別のキャッシュ (次の run) からも使える
+        result = run_controlnet_openpose(paths[2], client=client, cache=PoseCache(str(tmp_path / "poses")))
+        assert len(server.requests) == 1 and result.canvas_height == len(sent[2])
+        run_controlnet_openpose(paths[2], client=client)
+        assert len(server.requests) == 2
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_sd_pool_does_not_resend_after_read_timeout():
+    import pytest
+    import requests
+
+    from lib.image.sd_client import SDClient, SDPool
+
+    servers = [_start_stub() for _ in range(2)]
+    servers[0][0].delay = 0.5
+    pool = SDPool([SDClient(url, timeout=0.1) for _, url in servers])
+    try:
+        # 生成中のバックエンドがあるので、同じリクエストを別のバックエンドに送り直さない
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            pool.txt2img({"width": 8, "height": 8})
+        assert len(servers[0][0].requests) == 1 and servers[1][0].requests == []
+        assert pool.stats()[0]["failed"] == 1 and pool.stats()[0]["healthy"]
+    finally:
+        pool.close()
+        for server, _ in servers:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,73 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from lib.scoring.clip import BACKENDS, clip_scores, encode_images, encode_prompts, export_torchscript, set_num_threads
+from lib.scoring.scorer import CLIP_MODEL_ID, get_verification_prompt, load_clip_model
+
+# Throughput (images/sec) and score drift of the CPU CLIP backends against the fp32 reference.
+#
+#   python util/benchmark_clip_backend.py --images "output/*/images/panel*/*_anime.png" --prompt "a girl in the rain"
+#   python util/benchmark_clip_backend.py --images ... --backends fp32,int8,torchscript --torchscript_path models/clip_ts --export
+
+
+def find_images(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "**", "*.png")
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def score_images(image_paths, prompt, model, processor, device, batch_size):
+    start = time.perf_counter()
+    image_embeds = encode_images(image_paths, model, processor, device, batch_size)
+    elapsed = time.perf_counter() - start
+    text_embeds = encode_prompts([prompt], model, processor, device)
+    scores = clip_scores(image_embeds, text_embeds, [(i, 0) for i in range(len(image_paths))])
+    return np.array(scores), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CPU CLIP backends against the fp32 reference")
+    parser.add_argument("--images", required=True, help="Image directory or glob pattern")
+    parser.add_argument("--prompt", default="a manga panel")
+    parser.add_argument("--model_id", default=CLIP_MODEL_ID)
+    parser.add_argument("--backends", default="fp32,int8", help=f"Comma separated subset of {BACKENDS}")
+    parser.add_argument("--torchscript_path", default=None)
+    parser.add_argument("--export", action="store_true", help="Export the fp32 model to --torchscript_path first")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--limit", type=int, default=64)
+    args = parser.parse_args()
+
+    image_paths = find_images(args.images)[:args.limit]
+    if not image_paths:
+        raise ValueError(f"No images found: {args.images}")
+    prompt = get_verification_prompt(args.prompt)
+    set_num_threads(args.threads)
+
+    reference_model, reference_processor, reference_device = load_clip_model(args.model_id, "fp32", args.threads)
+    if args.export:
+        export_torchscript(reference_model, reference_processor, args.torchscript_path)
+    reference, _ = score_images(image_paths, prompt, reference_model, reference_processor, reference_device, args.batch_size)
+    del reference_model
+
+    print(f"Images: {len(image_paths)}  batch size: {args.batch_size}  threads: {args.threads or 'default'}")
+    print(f"{'backend':<12} {'images/sec':>10} {'max drift':>10} {'mean drift':>10} {'rank agree':>10}")
+    for backend in args.backends.split(","):
+        model, processor, device = load_clip_model(args.model_id, backend, args.threads, args.torchscript_path)
+        if model is None:
+            print(f"{backend:<12} failed to load")
+            continue
+        score_images(image_paths[:args.batch_size], prompt, model, processor, device, args.batch_size)  # warm up
+        scores, elapsed = score_images(image_paths, prompt, model, processor, device, args.batch_size)
+        drift = np.abs(scores - reference)
+        # 最終スコアで使う順位 (最良の画像) が変わらないか
+        rank_agree = float(np.mean(np.argsort(-scores) == np.argsort(-reference)))
+        print(f"{backend:<12} {len(image_paths) / elapsed:>10.2f} {drift.max():>10.4f} {drift.mean():>10.4f} {rank_agree:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
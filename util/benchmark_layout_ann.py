@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from lib.layout.index import DEFAULT_ANNFILE, LayoutIndex
+from lib.layout.layout import MangaLayout, NonSpeaker, Speaker, similar_layouts
+
+# Recall@K of the ANN mode of similar_layouts against the exact (exhaustive) path.
+#
+#   python util/benchmark_layout_ann.py                       # curated_dataset/database.json
+#   python util/benchmark_layout_ann.py --synthetic 20000     # random database, no dataset needed
+
+
+def make_synthetic_database(path, size, seed=0):
+    """Random database.json with `size` layouts per bucket."""
+    rng = random.Random(seed)
+
+    def bbox(width, height):
+        x1 = rng.randint(0, width - 50)
+        y1 = rng.randint(0, height - 50)
+        return [x1, y1, rng.randint(x1 + 10, width), rng.randint(y1 + 10, height)]
+
+    ann = {}
+    for num_speakers, num_non_speakers in [(0, 1), (1, 0), (1, 1), (2, 0), (2, 1), (3, 1)]:
+        key = f"{num_speakers}_{num_non_speakers}"
+        ann[key] = []
+        for i in range(size):
+            width, height = rng.randint(300, 900), rng.randint(300, 900)
+            speakers = []
+            for _ in range(num_speakers):
+                length = rng.randint(1, 40)
+                speakers.append({"bbox": bbox(width, height), "text_length": length,
+                                 "text_info": [{"bbox": bbox(width, height), "length": length}]})
+            unrelated = rng.randint(0, 40)
+            ann[key].append({
+                "image_path": f"synthetic/{key}/{i}.png",
+                "width": width,
+                "height": height,
+                "speaker_objects": speakers,
+                "non_speaker_objects": [{"bbox": bbox(width, height)} for _ in range(num_non_speakers)],
+                "unrelated_text_length": unrelated,
+                "unrelated_text_bbox": [{"bbox": bbox(width, height), "length": unrelated}],
+            })
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(ann, f)
+
+
+def random_query(index, rng, width=512, height=768, jitter=0.05):
+    """データベースのレイアウトを1つ選び、bbox とテキスト長を揺らしたものをクエリにする"""
+    key = rng.choice([k for k in index.keys() if k != "0_0"])
+    bucket = index.bucket(key)
+    row = rng.randrange(len(bucket))
+    metadata = bucket.metadata(row)
+    sx, sy = width / metadata["width"], height / metadata["height"]
+
+    def scale(b):
+        noise = [rng.uniform(-jitter, jitter) * d for d in (width, height, width, height)]
+        return [b[0] * sx + noise[0], b[1] * sy + noise[1], b[2] * sx + noise[2], b[3] * sy + noise[3]]
+
+    elements = [Speaker(scale(s["bbox"]), max(0, s["text_length"] + rng.randint(-3, 3))) for s in metadata["speaker_objects"]]
+    elements += [NonSpeaker(scale(s["bbox"])) for s in metadata["non_speaker_objects"]]
+    unrelated = max(0, metadata["unrelated_text_length"] + rng.randint(-3, 3))
+    return MangaLayout("", width, height, elements, unrelated, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@K of ANN layout search vs exact search")
+    parser.add_argument("--annfile", default=DEFAULT_ANNFILE)
+    parser.add_argument("--synthetic", type=int, default=0, help="Benchmark on a random database of this many layouts per bucket")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--candidates", type=int, default=256)
+    parser.add_argument("--text_length_threshold", type=int, default=5)
+    parser.add_argument("--aspect_ratio_threshold", type=float, default=0.3)
+    args = parser.parse_args()
+
+    annfile = args.annfile
+    if args.synthetic:
+        annfile = os.path.join(tempfile.mkdtemp(), "database.json")
+        make_synthetic_database(annfile, args.synthetic)
+    index = LayoutIndex.get(annfile)
+
+    rng = random.Random(0)
+    queries = [random_query(index, rng) for _ in range(args.queries)]
+    options = dict(
+        text_length_threshold=args.text_length_threshold,
+        aspect_ratio_threshold=args.aspect_ratio_threshold,
+        annfile=index,
+        top_k=args.top_k,
+    )
+    for query in queries:  # warm up (KD-tree の読み込み/構築)
+        similar_layouts(query, ann=True, ann_candidates=args.candidates, **options)
+
+    recalls = []
+    exact_time = ann_time = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        exact = similar_layouts(query, **options)
+        exact_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        approx = similar_layouts(query, ann=True, ann_candidates=args.candidates, **options)
+        ann_time += time.perf_counter() - start
+
+        if len(exact) == 0:
+            continue
+        recalls.append(len(set(exact.rows.tolist()) & set(approx.rows.tolist())) / len(exact))
+
+    print(f"Queries: {len(queries)}  K: {args.top_k}  ANN candidates: {args.candidates}")
+    print(f"Recall@{args.top_k}: {np.mean(recalls):.4f}")
+    print(f"Exact: {exact_time / len(queries) * 1000:.2f} ms/query")
+    print(f"ANN:   {ann_time / len(queries) * 1000:.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
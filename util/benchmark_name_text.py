@@ -0,0 +1,73 @@
+import argparse
+import glob
+import hashlib
+import os
+import time
+
+from PIL import Image
+
+from lib.name import font as font_cache
+from lib.name import name
+
+# Vertical text rendering of name generation: per-character draw.text against the glyph atlas.
+#
+#   python util/benchmark_name_text.py                                    # examples/*.txt
+#   python util/benchmark_name_text.py --font /path/to/font.ttf --repeat 8
+
+
+def load_lines(pattern):
+    lines = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            lines += [line.strip() for line in f if line.strip()]
+    return lines
+
+
+def render(lines, repeat, use_atlas, width=512, height=768):
+    """
+    Draws every line into a bubble, `repeat` times (generate_name runs once per reference layout).
+    Returns (digests of the images, seconds spent in draw_vertical_text).
+    """
+    digests = []
+    elapsed = 0.0
+    for _ in range(repeat):
+        for k, line in enumerate(lines):
+            image = Image.new("RGB", (width, height), "white")
+            x2 = width - 20 - (k % 5) * 40
+            start = time.perf_counter()
+            name.draw_vertical_text(image, line, [x2 - 200, 40, x2, height - 40], "dialogue" if k % 2 else "monologue", use_atlas)
+            elapsed += time.perf_counter() - start
+            digests.append(hashlib.sha1(image.tobytes()).hexdigest())
+    return digests, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vertical text rendering of name generation")
+    parser.add_argument("--scripts", default="examples/*.txt")
+    parser.add_argument("--font", default=font_cache.FONTPATH)
+    parser.add_argument("--repeat", type=int, default=4)
+    args = parser.parse_args()
+
+    lines = load_lines(args.scripts)
+    if not lines:
+        raise ValueError(f"No scripts found: {args.scripts}")
+    if not os.path.exists(args.font):
+        raise FileNotFoundError(f"Font not found: {args.font}")
+    name.FONTPATH = args.font
+
+    render(lines[:4], 1, False)  # warm up (フォントの読み込み)
+    reference, reference_time = render(lines, args.repeat, False)
+    font_cache.clear_cache()
+    atlas, atlas_time = render(lines, args.repeat, True)
+    identical = reference == atlas
+
+    chars = sum(len(line) for line in lines) * args.repeat
+    print(f"Lines: {len(lines)}  characters: {chars}  repeat: {args.repeat}")
+    print(f"{'renderer':<12} {'seconds':>8} {'chars/sec':>10}")
+    print(f"{'draw.text':<12} {reference_time:>8.3f} {chars / reference_time:>10.0f}")
+    print(f"{'atlas':<12} {atlas_time:>8.3f} {chars / atlas_time:>10.0f}")
+    print(f"Pixel identical: {identical}")
+
+
+if __name__ == "__main__":
+    main()